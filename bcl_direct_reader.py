@@ -38,14 +38,25 @@ On 24th Oct 2017:
 We'd also like this module to be able to read .cbcl files, which are concatenated BCL files
 (aka. indexed gzip files). Reading these efficiently might require changing the API a little.
 
+Plain uncompressed .bcl files are also read, and here the fixed record length really
+does pay off - the file is memory-mapped and only the pages holding the requested wells
+are ever touched.  The format is picked for each cycle separately, so a run with a mixture
+of .bcl and .bcl.gz files is fine.
+
 """
 
 __version__ = 1.2
 __author__ = 'Tim Booth, Edinburgh Genomics <tim.booth@ed.ac.uk>'
 
-import os, sys, re
+import sys
 import struct
-import gzip
+import mmap
+from collections import deque
+
+from profiling import Profile, NO_PROFILE
+from inflate import Inflater
+from run_layout import RunLayout, LaneLayout
+from prefetch import ReadAhead, DEFAULT_DEPTH
 
 # This now works only in Python3 - byte semantics are totally different
 assert sys.version >= '3'
@@ -56,18 +67,27 @@ QUAL_FLAG = 1
 
 class BCLReader(object):
 
-    def __init__(self, location="."):
+    def __init__(self, location=".", inflate_backend=None, layout=None, stage=None):
         """Creates a BCLReader instance that reads from a single run.
            location: The top level data directory for the run.
            This should be the one that contains the Data directory and the
            RunInfo.xml file.
+           inflate_backend: which gunzip code to use - see inflate.py.
+           layout: a run_layout.RunLayout for the run, if you already have one.
+           stage: a staging_cache.StagingCache to keep local copies of the data.
         """
+        self.layout = layout or RunLayout(location)
+
         # Just check that we can read the expected files at this
         # location.
-        basecalls_dir = os.listdir( os.path.join(location, "Data", "Intensities", "BaseCalls") )
-        self.lanes = [ d for d in basecalls_dir if re.match('L\d\d\d$', d) ]
+        self.lanes = self.layout.lane_dirs
 
         self.location = location
+        self.stage = stage
+
+        # All the tiles from this reader inflate into the same buffer, so
+        # use a separate reader for each thread.
+        self.inflater = Inflater(backend=inflate_backend)
 
 
     def get_seq(self, lane, tile, cluster_index, start=0, end=None):
@@ -87,63 +107,56 @@ class BCLReader(object):
         # return nuc_string, flag
         return result[cluster_index]
 
-    def get_tile(self, lane, tile, in_memory=False):
+    def get_tile(self, lane, tile, in_memory=False, profile=NO_PROFILE):
         """Opens a tile for reading.  You can then call get_seqs() to actually
            fetch the data.
            Lane and tile should be specified as per the Illumina file structure,
            so lanes are 1 to 8 and tiles are eg. [12][12]{01-28} (for HiSeq 4000).
+           profile: a profiling.Profile to record timings and byte counts.
         """
-        lane_dir = str(lane)
-        if lane_dir not in self.lanes:
-            lane_dir = 'L%03d' % int(lane_dir)
-
-        data_dir = os.path.join(self.location, "Data", "Intensities", "BaseCalls", lane_dir)
+        # The directory for each lane is only scanned once, however many
+        # tiles are opened.
+        lane_layout = self.layout.lane(lane)
 
         if in_memory:
             raise RuntimeError("Preloading into memory not implemented yet")
 
-        return Tile(data_dir, tile)
+        return Tile(lane_layout.data_dir, tile, profile, self.inflater, lane_layout, self.stage)
 
 
 class Tile(object):
 
-    def __init__(self, data_dir, tile):
+    def __init__(self, data_dir, tile, profile=NO_PROFILE, inflater=None, layout=None, stage=None):
         """Fetches sequences from a single tile.
            You would not normally instantiate these directly.  Create a
            BCLReader and call get_tile() instead.
+           layout: the run_layout.LaneLayout for data_dir, if you have it,
+           which saves scanning the directory again.
+           stage: the staging_cache.StagingCache to read files through, if any.
         """
-
-        # Find the file prefix I need to be looking at.  Could infer it
-        # from the lane number but instead I'll do it by looking for the
-        # matching .filter file
-        self.bcl_filename = None
+        self.profile = profile
+        self.inflater = inflater or Inflater()
+        self.stage = stage
+        self._read_ahead = None
+        with profile.phase('open_tile'):
+            self._open(data_dir, tile, layout)
+
+    def _open(self, data_dir, tile, layout=None):
+
+        # The layout knows which files belong to this tile, based on the
+        # matching .filter file, and which format each cycle is in.
+        self.layout = layout or LaneLayout(data_dir)
         self.data_dir = data_dir
         self.tile = tile
 
-        data_dir_listing = os.listdir(data_dir)
-        for filt in data_dir_listing:
-            amatch = re.match('(.+_%s).filter' % tile, filt)
-            if amatch:
-                self.bcl_filename = amatch.group(1) + '.bcl.gz'
-                self.filter_file = os.path.join(data_dir, filt)
-                break
-
-        if not self.bcl_filename:
-            raise RuntimeError("Cannot find a .filter file for tile %s" % tile)
+        self.filter_file = self.layout.filter_file(tile)
 
-        # The CBCL filename is in the format "L00{lane}_{surface}", where the prefix
-        # should have the same name as the data_dir, and the surface is the first
-        # digit of the tile name.
-        self.cbcl_filename = "%s_%s.cbcl" % (os.path.basename(data_dir), str(tile)[0])
-
-        # Also work out the number of cycle folders.  Should be 308
-        # for HiSeq 4000
-        cycle_dirs = [ f for f in data_dir_listing if re.match('C\d+.1$', f) ]
-        self.num_cycles = len(cycle_dirs)
+        # Also the number of cycle folders.  Should be 308 for HiSeq 4000
+        self.num_cycles = self.layout.num_cycles
 
         # And also the number of clusters, which should be 4309650
         # for HiSeq 4000.  We need to snag this from the top of the .filter file
-        with open(self.filter_file, 'rb') as filt_fh:
+        with self._open_file(self.filter_file) as filt_fh:
 
             filt_header = struct.unpack('<III', filt_fh.read(12))
             # The first word should be 0, and the version byte is 3, at least
@@ -191,33 +204,199 @@ class Tile(object):
         if sorted_keys[0] < 0:
             raise IndexError("Requested cluster %i is a negative number." % sorted_keys[0])
 
+        prof = self.profile
+        prof.count('wells_requested', len(sorted_keys))
+
         # Get the accept/reject flag from the .filter file
         fo = self._get_filter_offsets()
         for idx in sorted_keys:
             flag_collector[idx] = (fo[idx] != -1)
 
-        # Now the actual basecalls
+        # Now the actual basecalls. Each cycle is done in three steps - read the
+        # compressed data, inflate it, then pick out the bases we want - which
+        # lets the profiler see where the time goes.
+        mapped_bytes_touched = None
         for cycle in range(start, end):
-            cycle_dir = os.path.join(self.data_dir, 'C%i.1' % (cycle + 1))
+            cycle_fmt, zipdata, excluded_flag = self._fetch_cycle(cycle)
+
+            if cycle_fmt == 'bcl':
+                # Nothing to inflate. Pick the bases straight out of the mapping, which
+                # only reads the header and the pages holding the wells we want.
+                if mapped_bytes_touched is None:
+                    pages = { (idx + 4) // mmap.PAGESIZE for idx in sorted_keys } | {0}
+                    mapped_bytes_touched = len(pages) * mmap.PAGESIZE
+                prof.count('bytes_read', min(mapped_bytes_touched, len(zipdata)))
+
+                with prof.phase('decode'):
+                    try:
+                        self._get_seqs_from_bcl(zipdata, cycle - start, sorted_keys, seq_collector)
+                    finally:
+                        zipdata.close()
+                continue
+
+            # The inflated data is a view on the inflater's buffer, which gets
+            # re-used on the next cycle. There is no need to inflate beyond the
+            # last well we want, which saves a lot if the targets are all near
+            # the start of the tile (see prepare_cluster_indexes.py --bands).
+            with prof.phase('inflate'):
+                if cycle_fmt == 'cbcl':
+                    data = self.inflater.inflate(zipdata, limit=sorted_keys[-1] // 2 + 1)
+                else:
+                    data = self.inflater.inflate(zipdata, limit=sorted_keys[-1] + 5)
+            prof.count('bytes_inflated', len(data))
+
+            with prof.phase('decode'):
+                if cycle_fmt == 'cbcl':
+                    self._get_seqs_from_cbcl(data, excluded_flag, cycle - start, sorted_keys, seq_collector)
+                else:
+                    self._get_seqs_from_bcl(data, cycle - start, sorted_keys, seq_collector)
+            data.release()
+
+        # Remap the arrays into strings
+        #  return dict( idx : (nuc_string, flag) )
+        with prof.phase('join'):
+            return { idx : ( ''.join(seq), flag_collector[idx] ) for idx, seq in seq_collector.items() }
+
+    def get_cycle_data(self, start=0, end=None):
+        """Yields (cycle_fmt, data, excluded_flag) for each cycle from start to end,
+           with the data inflated, for code that wants every well rather than a
+           few of them (see exhaustive.py).  This is the whole uncompressed .bcl
+           file (with its 4-byte header) or the CBCL block for this tile.  The
+           data is only valid until the next one is yielded, so don't hold on to
+           any views of it.
+        """
+        if end is None:
+            end = self.num_cycles
 
-            # Now are we looking at .bcl.gz files or NovaSeq .cbcl files??
-            cycle_file = os.path.join(cycle_dir, self.bcl_filename)
-            cbcl_file  = os.path.join(cycle_dir, self.cbcl_filename)
+        prof = self.profile
+        for cycle in range(start, end):
+            cycle_fmt, zipdata, excluded_flag = self._fetch_cycle(cycle)
+
+            if cycle_fmt == 'bcl':
+                prof.count('bytes_read', len(zipdata))
+                try:
+                    yield cycle_fmt, zipdata, excluded_flag
+                finally:
+                    zipdata.close()
+                continue
 
+            with prof.phase('inflate'):
+                data = self.inflater.inflate(zipdata)
+            prof.count('bytes_inflated', len(data))
             try:
-                with gzip.open(cycle_file, 'rb') as bcl_fh:
-                    self._get_seqs_from_bcl(bcl_fh, cycle - start, sorted_keys, seq_collector)
-            except FileNotFoundError:
-                # Try the cbcl file. If this fails allow the stack trace which will report both
-                # missing files.
+                yield cycle_fmt, data, excluded_flag
+            finally:
+                data.release()
+
+    def get_filter_flags(self):
+        """Returns the bytes of the .filter file after the header, one per well,
+           where the lowest bit says if the well passed the filter.
+        """
+        with self._open_file(self.filter_file) as filt_fh:
+
+            filt_header = filt_fh.read(12)
+            # We already saw this!
+            assert tuple(struct.unpack('<III', filt_header)) == (0, 3, self.num_clusters)
+
+            # Slurp the whole thing - file length should match the num_clusters value
+            # we already know.
+            filt_bytes = filt_fh.read()
+
+        self.profile.count('bytes_read', 12 + len(filt_bytes))
+        return filt_bytes
+
+    def filter_passed(self, cluster_indices):
+        """Returns the set of the given wells that passed the filter.  This only
+           needs the .filter file, so you can use it to leave out wells before
+           asking get_seqs() for the bases.  The filter is kept for get_seqs().
+        """
+        fo = self._get_filter_offsets()
+        return set( int(idx) for idx in cluster_indices if fo[idx] != -1 )
+
+    def prefetch(self, cycles, depth=DEFAULT_DEPTH):
+        """Starts reading the files for the given cycles (counting from 0) in the
+           background, keeping up to depth of them in memory.  Subsequent calls to
+           get_seqs() will use them, so long as the cycles are asked for in the
+           same order.  You might do this for the next tile while still working
+           on the current one.
+        """
+        self.close()
+
+        # The background thread gets its own profile, which is added to ours
+        # once it has finished.
+        self._read_ahead_prof = Profile() if self.profile.enabled else NO_PROFILE
+        self._read_ahead = ReadAhead( lambda c: self._read_cycle(c, self._read_ahead_prof),
+                                      cycles, depth, profile=self.profile )
+        self._read_ahead_iter = iter(self._read_ahead)
+        self._read_ahead_pending = deque(self._read_ahead.items)
+
+    def close(self):
+        """Stops any reading ahead.  It's not necessary to call this if get_seqs()
+           used up all the prefetched cycles.
+        """
+        if self._read_ahead:
+            self._read_ahead.close()
+            self.profile.add(self._read_ahead_prof)
+            self._read_ahead = None
+
+    def _fetch_cycle(self, cycle):
+        """Gets the result of _read_cycle(cycle), from the read-ahead queue if
+           it's the next one there.
+        """
+        if self._read_ahead:
+            if self._read_ahead_pending and self._read_ahead_pending[0] == cycle:
+                self._read_ahead_pending.popleft()
+                res = next(self._read_ahead_iter)[1]
+                if not self._read_ahead_pending:
+                    self.close()
+                return res
+
+            # Not what we expected, so give up on reading ahead.
+            self.close()
+
+        return self._read_cycle(cycle)
+
+    def _read_cycle(self, cycle, profile=None):
+        """Reads the compressed data for this tile on the given cycle (counting from 0).
+           Returns a tuple (format, compressed_bytes, excluded_flag) where format is
+           'bcl.gz', 'bcl' or 'cbcl'.  excluded_flag is only meaningful for CBCL.
+           For 'bcl' the data is an mmap of the whole file, which the caller must
+           close.
+           profile defaults to self.profile.
+        """
+        if profile is None:
+            profile = self.profile
+
+        with profile.phase('read'):
+            # Now are we looking at .bcl.gz files, plain .bcl or NovaSeq .cbcl files??
+            cycle_fmt, cycle_file = self.layout.cycle_file(self.tile, cycle)
+
+            if cycle_fmt == 'bcl.gz':
+                with self._open_file(cycle_file, profile) as bcl_fh:
+                    res = ('bcl.gz', bcl_fh.read(), False)
+            elif cycle_fmt == 'bcl':
+                with open(cycle_file, 'rb') as bcl_fh:
+                    res = ('bcl', mmap.mmap(bcl_fh.fileno(), 0, access=mmap.ACCESS_READ), False)
+            else:
                 # Note that this does result in opening the same CBCL file again and again
                 # for each tile, but each chunk is only unzipped once.
-                with open(cbcl_file, 'rb') as fh:
-                    self._get_seqs_from_cbcl(fh, cycle - start, sorted_keys, seq_collector)
+                with self._open_file(cycle_file, profile) as fh:
+                    res = ('cbcl',) + self._read_cbcl_block(fh)
 
-        # Remap the arrays into strings
-        #  return dict( idx : (nuc_string, flag) )
-        return { idx : ( ''.join(seq), flag_collector[idx] ) for idx, seq in seq_collector.items() }
+        if res[0] == 'bcl':
+            # The caller counts what actually gets read from the mapping.
+            profile.count('bytes_mapped', len(res[1]))
+        else:
+            profile.count('bytes_read', len(res[1]))
+        return res
+
+    def _open_file(self, path, profile=None):
+        """Opens a file for reading, via the staging cache if there is one.
+           Plain .bcl files don't go through here as they are memory-mapped.
+        """
+        if self.stage:
+            return self.stage.open(path, self.profile if profile is None else profile)
+        return open(path, 'rb')
 
     def _get_filter_offsets(self):
         """ Load the filter file, and convert it to a series of offsets. The actual
@@ -229,15 +408,15 @@ class Tile(object):
         if self.filter_offsets:
             return self.filter_offsets
 
-        with open(self.filter_file, 'rb') as filt_fh:
+        with self.profile.phase('filter_load'):
+            self._load_filter_offsets()
 
-            filt_header = filt_fh.read(12)
-            # We already saw this!
-            assert tuple(struct.unpack('<III', filt_header)) == (0, 3, self.num_clusters)
+        return self.filter_offsets
 
-            # Slurp the whole thing - file length should match the num_clusters value
-            # we already know.
-            filt_bytes = struct.unpack('<{}B'.format(self.num_clusters), filt_fh.read())
+    def _load_filter_offsets(self):
+
+        filt_bytes = self.get_filter_flags()
+        assert len(filt_bytes) == self.num_clusters
 
         # Make the table of offsets
         filt_offsets = [-1] * self.num_clusters
@@ -250,12 +429,9 @@ class Tile(object):
         self.filter_offsets = filt_offsets
         self.passing_wells = offset
 
-        return self.filter_offsets
-
-    def _get_seqs_from_cbcl(self, fh, cycle_idx, sorted_keys, seq_collector):
-        """ Reads from the fh to find the appropriate BCL block and then unpacks
-            it to extract the basecalls. Deals with excluded/unexcluded flag, requesting
-            the filter_offsets as necessary.
+    def _read_cbcl_block(self, fh):
+        """ Reads from the fh to find the appropriate BCL block for this tile.
+            Returns the compressed block and the excluded_flag.
             See cbcl_read.py for a more comprehensive version of CBCL reading code.
         """
         # Assume that fh is positioned at the start and read the header...
@@ -298,8 +474,12 @@ class Tile(object):
         # I only want 1 or 2 bases - seems pointless to try and optimise the
         # bases < 10 case)
         fh.seek(t_bcl_offset)
-        zipdata = gzip.GzipFile(fileobj=fh, mode='rb').read(t_usize)
+        return fh.read(t_csize), excluded_flag
 
+    def _get_seqs_from_cbcl(self, zipdata, excluded_flag, cycle_idx, sorted_keys, seq_collector):
+        """ Unpacks an inflated CBCL block to extract the basecalls. Deals with
+            excluded/unexcluded flag, requesting the filter_offsets as necessary.
+        """
         if excluded_flag:
             excluded_offsets = self._get_filter_offsets()
 
@@ -324,13 +504,12 @@ class Tile(object):
             if base_byte:
                 seq_collector[welln][cycle_idx] = ('A', 'C', 'G', 'T')[base_byte & 0b00000011]
 
-    def _get_seqs_from_bcl(self, fh, cycle_idx, sorted_keys, seq_collector):
-        """ Reads from the fh, which is presumably a gzip stream handle, and
-            adds the specified seqs to the seq_collector.
+    def _get_seqs_from_bcl(self, slurped_file, cycle_idx, sorted_keys, seq_collector):
+        """ Picks the specified seqs out of an inflated BCL file and adds them to
+            the seq_collector.
             This is intended for internal use only.
-            And obviously it can only be called once per fh.
         """
-        bcl_header = fh.read(4)
+        bcl_header = slurped_file[:4]
 
         # The BCL header should be a fixed length depending on the machine type.
         # This assertion checks that it is at least consistent with the filter
@@ -341,34 +520,22 @@ class Tile(object):
         # just reading the chunks we wanted.  Turns out for more than, say,
         # 10 reads, it's faster just to slurp the thing.  For over 10000 it's
         # considerably faster!
-        if len(sorted_keys) > 10:
-            slurped_file = fh.read()
-
-            for idx in sorted_keys:
-                base_byte = slurped_file[idx]
-
-                # base = 'N'
-                # qual = 0
-                if base_byte:
-                    # The two lowest bits give us the base call
-                    base = ('A', 'C', 'G', 'T')[base_byte & 0b00000011]
-
-                    # And the high bits give us the quality, but we're not using
-                    # it here, other than the above test which catches no-calls.
-                    # qual = base_byte >> 2
-
-                    #Collect the base
-                    seq_collector[idx][cycle_idx] = base
-        else:
-            for idx in sorted_keys:
-                fh.seek(idx + 4)
-                # Is reading bytes 1 at a time slow?  I'd imagine that internal
-                # cacheing negates any need for chunked reads at this level.
-                base_byte, = fh.read(1)
+        # (And since we now inflate the whole file in one go there is no
+        # seeking at all.)
+        # For a plain .bcl file slurped_file is an mmap, so the indexing below
+        # really does only read the pages we need.
+        for idx in sorted_keys:
+            base_byte = slurped_file[idx + 4]
 
-                # Copy-paste-ahoy!
-                if base_byte:
-                    base = ('A', 'C', 'G', 'T')[base_byte & 0b00000011]
-                    seq_collector[idx][cycle_idx] = base
+            # base = 'N'
+            # qual = 0
+            if base_byte:
+                # The two lowest bits give us the base call
+                base = ('A', 'C', 'G', 'T')[base_byte & 0b00000011]
 
+                # And the high bits give us the quality, but we're not using
+                # it here, other than the above test which catches no-calls.
+                # qual = base_byte >> 2
 
+                #Collect the base
+                seq_collector[idx][cycle_idx] = base
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the well duplicates code, run against synthetic data made by
+make_synthetic_run.py so that the numbers are reproducible on any machine.
+
+The stages timed are:
+
+  prepare_indexes  - prepare_cluster_indexes.get_indexes() on the s.locs file
+  load_targets     - target.load_targets() on a full-sized targets file
+  get_seqs_bcl     - Tile.get_seqs() on a HiSeq-style .bcl.gz tile
+  get_seqs_cbcl    - Tile.get_seqs() on a NovaSeq-style .cbcl tile
+  compare          - count_well_duplicates.count_tile_dups()
+  output_writer    - count_well_duplicates.output_writer() on a fake lane
+
+Each stage is run --repeat times and the fastest time is reported, along with
+a throughput figure.  Results can be saved as a baseline and later runs
+compared against it, so you can see if a change makes things faster or
+slower:
+
+   benchmark.py --save-baseline bench_baseline.json
+   ...hack hack hack...
+   benchmark.py --baseline bench_baseline.json
+
+The exit status is 1 if any stage is slower than the baseline by more than
+--tolerance.  Timings from different machines are not comparable, so only
+compare against a baseline made on the same box.
+"""
+__AUTHORS__ = ['Tim Booth']
+__VERSION__ = 0.1
+
+import os, sys
+import io
+import json
+import time
+import struct
+import random
+import platform
+import tempfile
+import contextlib
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+import Levenshtein
+import inflate
+import bcl_direct_reader
+import prepare_cluster_indexes
+import count_well_duplicates
+from target import load_targets
+from make_synthetic_run import make_run, write_targets
+from profiling import Profile
+
+STAGES = [ 'prepare_indexes', 'load_targets', 'get_seqs_bcl', 'get_seqs_cbcl',
+           'compare', 'output_writer' ]
+
+def log(msg):
+    print(str(msg), file=sys.stderr)
+
+def best_time(func, repeat):
+    """Runs func() repeat times and returns (fastest_seconds, last_result)
+    """
+    best = None
+    for n in range(repeat):
+        start = time.perf_counter()
+        res = func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, res
+
+class Bench:
+    """Sets up the synthetic data and runs the stages.
+    """
+    def __init__(self, args, workdir):
+        self.args = args
+        self.workdir = workdir
+        self.results = dict()
+
+        # Make the runs, unless we were given some to use
+        self.runs = dict()
+        for fmt, preset in [('bcl', 'hiseq_4000'), ('cbcl', 'novaseq')]:
+            self.runs[fmt] = run_dir = os.path.join(workdir, preset)
+            if not os.path.exists(os.path.join(run_dir, 'RunInfo.xml')):
+                log("Generating synthetic %s run in %s" % (preset, run_dir))
+                make_run( run_dir, preset=preset, surfaces=1, swaths=1, tiles=2,
+                          rows=args.rows, cols=args.cols, cycles=args.end,
+                          compresslevel=args.compresslevel )
+
+        self.targets_file = os.path.join(workdir, '%itargets.list' % args.targets)
+        if not os.path.exists(self.targets_file):
+            write_targets(self.targets_file, args.rows, args.cols, args.targets, levels=args.levels)
+
+        self.targets = load_targets(self.targets_file, levels=args.levels+1)
+        self.seq_objs = None
+
+    def record(self, name, seconds, count, unit, mb_inflated=None):
+        res = dict(seconds=seconds, rate=count/seconds, unit=unit)
+        if mb_inflated is not None:
+            res['mb_inflated_per_s'] = mb_inflated/seconds
+        self.results[name] = res
+
+    def prepare_indexes(self):
+        n = self.args.prepare_targets
+        slocs = os.path.join(self.runs['bcl'], 'Data', 'Intensities', 's.locs')
+
+        def run():
+            with open(slocs, 'rb') as fh:
+                num_clusters = struct.unpack('=ifI', fh.read(12))[2]
+                for coord in prepare_cluster_indexes.get_random_array(num_clusters, n, 13):
+                    fh.seek(12 + coord * 8)
+                    t = struct.unpack('=ff', fh.read(8))
+                    prepare_cluster_indexes.get_indexes( coord,
+                                                         int(t[0] * 10.0 + 1000.5),
+                                                         int(t[1] * 10.0 + 1000.5),
+                                                         fh, levels=self.args.levels )
+        seconds, _ = best_time(run, self.args.repeat)
+        self.record('prepare_indexes', seconds, n, 'targets/s')
+
+    def load_targets(self):
+        seconds, targets = best_time( lambda: load_targets(self.targets_file, levels=self.args.levels+1),
+                                      self.args.repeat )
+        self.record('load_targets', seconds, len(targets), 'targets/s')
+
+    def _get_seqs(self, fmt):
+        args = self.args
+        prof = Profile()
+        tile = bcl_direct_reader.BCLReader( self.runs[fmt],
+                                            inflate_backend = args.inflate ).get_tile(1, '1101', profile=prof)
+        indices = self.targets.get_all_indices()
+
+        seconds, seqs = best_time( lambda: tile.get_seqs(indices, args.start, args.end),
+                                   args.repeat )
+        self.record( 'get_seqs_' + fmt, seconds, len(indices), 'wells/s',
+                     prof.counters['bytes_inflated'] / args.repeat / 1e6 )
+        return seqs
+
+    def get_seqs_bcl(self):
+        self.seq_objs = [ self._get_seqs('bcl') ]
+
+    def get_seqs_cbcl(self):
+        self._get_seqs('cbcl')
+
+    def compare(self):
+        args = self.args
+        if not self.seq_objs:
+            self.get_seqs_bcl()
+        get_edit_distance = Levenshtein.hamming if args.hamming else Levenshtein.distance
+
+        seconds, tile_counts = best_time( lambda: count_well_duplicates.count_tile_dups(
+                                                      self.targets, self.seq_objs, args.levels,
+                                                      args.edit_distance, get_edit_distance ),
+                                          args.repeat )
+        # Only the wells actually compared, ie. out to args.levels and
+        # around centres that passed the filter
+        comparisons = sum( l[count_well_duplicates.LENGTH] for tc in tile_counts for l in tc )
+        self.record('compare', seconds, comparisons, 'comparisons/s')
+
+    def output_writer(self):
+        # A lane's worth of fake stats.  The numbers don't matter.
+        args = self.args
+        rng = random.Random(13)
+        lane_dupl = { "%i%02i" % (s, t): [ [ (int(rng.random() < 0.01), 6 * (l+1)) for l in range(args.levels) ]
+                                           for n in range(args.targets) ]
+                      for s in (11, 12, 21, 22) for t in range(1, args.lane_tiles // 4 + 1) }
+
+        def run():
+            with contextlib.redirect_stdout(io.StringIO()):
+                count_well_duplicates.output_writer(1, args.targets, lane_dupl, verbose=True)
+        seconds, _ = best_time(run, args.repeat)
+        self.record('output_writer', seconds, len(lane_dupl), 'tiles/s')
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Prints a comparison and returns the list of stages that got slower.
+    """
+    regressions = []
+    print("\nComparison with baseline from %s on %s:" % ( baseline.get('date'), baseline.get('host') ))
+    for name, res in results.items():
+        base = baseline['results'].get(name)
+        if not base:
+            print("  %-16s no baseline" % name)
+            continue
+        ratio = base['seconds'] / res['seconds']
+        verdict = ''
+        if res['seconds'] > base['seconds'] * (1 + tolerance):
+            verdict = 'REGRESSION'
+            regressions.append(name)
+        elif ratio > 1 + tolerance:
+            verdict = 'faster'
+        print("  %-16s %8.3fs -> %8.3fs  x%.2f %s" % (name, base['seconds'], res['seconds'], ratio, verdict))
+    return regressions
+
+def parse_args(args=None):
+    description = """Benchmarks the well duplicates code on synthetic data, optionally comparing
+    the results to a saved baseline.
+    """
+    parser = ArgumentParser(description=description, formatter_class=ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("-w", "--workdir",
+                        help="Where to keep the synthetic runs. They will be re-used if already there." +
+                             " By default a temporary directory is used and then removed.")
+    parser.add_argument("--stages", default=",".join(STAGES),
+                        help="Comma-separated list of stages to run.")
+    parser.add_argument("--rows", type=int, default=400,
+                        help="Rows of wells per synthetic tile.")
+    parser.add_argument("--cols", type=int, default=1000,
+                        help="Wells per row in the synthetic tiles.")
+    parser.add_argument("--compresslevel", type=int, default=6,
+                        help="gzip level for the synthetic data.")
+    parser.add_argument("-n", "--targets", type=int, default=2500,
+                        help="Number of targets per tile.")
+    parser.add_argument("--prepare_targets", type=int, default=50,
+                        help="Number of targets for the (slow) prepare_indexes stage.")
+    parser.add_argument("-l", "--levels", type=int, default=5,
+                        help="Levels to scan around each target.")
+    parser.add_argument("-e", "--edit_distance", type=int, default=2,
+                        help="Max edit distance to count as a duplicate.")
+    parser.add_argument("--hamming", action="store_true",
+                        help="Use the Hamming distance in the compare stage.")
+    parser.add_argument("-x", "--start", type=int, default=20,
+                        help="First cycle to read.")
+    parser.add_argument("-y", "--end", type=int, default=70,
+                        help="Last cycle to read.")
+    parser.add_argument("--lane_tiles", type=int, default=96,
+                        help="Number of tiles in the fake lane for the output_writer stage.")
+    parser.add_argument("--inflate", choices=['auto'] + list(inflate.BACKENDS),
+                        help="Which gunzip code to use, as for count_well_duplicates.py.")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="Number of times to run each stage.")
+    parser.add_argument("-o", "--json",
+                        help="Save the results to this file.")
+    parser.add_argument("--save-baseline",
+                        help="Save the results as a baseline to this file.")
+    parser.add_argument("-b", "--baseline",
+                        help="Compare the results with this baseline file.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Fractional slow-down allowed before a stage is flagged as a regression.")
+
+    return parser.parse_args(args)
+
+def main():
+    args = parse_args()
+
+    # prepare_cluster_indexes logs every offset it looks at, which we don't want.
+    prepare_cluster_indexes.log = lambda *a: None
+    count_well_duplicates.log = lambda *a: None
+
+    with contextlib.ExitStack() as stack:
+        workdir = args.workdir or stack.enter_context(tempfile.TemporaryDirectory())
+        bench = Bench(args, workdir)
+
+        for stage in args.stages.split(','):
+            assert stage in STAGES, "Unknown stage %s" % stage
+            log("Running %s" % stage)
+            getattr(bench, stage)()
+
+    print("%-16s %10s %16s %16s" % ('stage', 'seconds', 'rate', 'MB inflated/s'))
+    for name, res in bench.results.items():
+        print("%-16s %10.3f %16.1f %16s  %s" % (
+                name, res['seconds'], res['rate'],
+                '%.1f' % res['mb_inflated_per_s'] if 'mb_inflated_per_s' in res else '-',
+                res['unit'] ))
+
+    report = dict( date = time.strftime('%Y-%m-%d %H:%M:%S'),
+                   host = platform.node(),
+                   python = platform.python_version(),
+                   inflate = inflate.get_backend(args.inflate)[0],
+                   settings = { k: v for k, v in vars(args).items()
+                                if k not in ('json', 'save_baseline', 'baseline', 'workdir') },
+                   results = bench.results )
+
+    for out_file in (args.json, args.save_baseline):
+        if out_file:
+            with open(out_file, 'w') as fh:
+                json.dump(report, fh, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+        if baseline['settings'] != report['settings']:
+            log("Warning: the baseline was made with different settings.")
+        if compare_to_baseline(bench.results, baseline, args.tolerance):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!python3
+"""
+Per-tile checkpoints for count_well_duplicates.py, so that if a job is killed
+part way through a lane it can be re-run with --resume and only the tiles not
+yet done need to be read again.
+
+Each tile gets a small JSON file holding the tile totals (as returned by
+count_well_duplicates.tile_stats) along with a key made from the run, the
+lane, a fingerprint of the targets and the settings that affect the counts.
+A checkpoint is only used if the key matches exactly, so you can share one
+directory between lanes and runs, and changing the settings just means the
+old checkpoints are ignored.
+
+Files are written to a temporary name and then renamed, so a job killed
+while saving will not leave a partial file behind.
+
+Synopsis:
+
+   ckpt = TileCheckpoints('checkpoints', run='/path/to/run', levels=5, ...)
+   ts = ckpt.load(lane, tile)
+   if ts is None:
+       ts = ...do the work...
+       ckpt.save(lane, tile, ts)
+"""
+
+import os
+import json
+from hashlib import sha1
+
+# Bump this if the content of the checkpoints changes
+CHECKPOINT_VERSION = 1
+
+class TileCheckpoints:
+
+    def __init__(self, directory, **key):
+        """key is any number of JSON-friendly settings which must match
+           for a checkpoint to be re-used.
+        """
+        self.directory = directory
+        self.key = dict(key, version=CHECKPOINT_VERSION)
+
+        # Round-trip via JSON so that loaded keys compare equal, eg. tuples become lists.
+        self.key = json.loads(json.dumps(self.key, sort_keys=True))
+        self.key_hash = sha1(json.dumps(self.key, sort_keys=True).encode()).hexdigest()[:12]
+
+        os.makedirs(directory, exist_ok=True)
+
+    def filename(self, lane, tile):
+        return os.path.join(self.directory, "welldup_%s_lane%s_tile%s.json" % (self.key_hash, lane, tile))
+
+    def save(self, lane, tile, tile_stats):
+        filename = self.filename(lane, tile)
+        tmp_file = "%s.%i.tmp" % (filename, os.getpid())
+        with open(tmp_file, 'w') as fh:
+            json.dump(dict(key=self.key, lane=str(lane), tile=str(tile), stats=tile_stats), fh)
+        os.replace(tmp_file, filename)
+
+    def load(self, lane, tile):
+        """Returns the saved stats for the tile, or None if there is no valid checkpoint.
+        """
+        try:
+            with open(self.filename(lane, tile)) as fh:
+                saved = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if ( saved.get('key') != self.key or
+             saved.get('lane') != str(lane) or
+             saved.get('tile') != str(tile) ):
+            return None
+        return saved.get('stats')
@@ -4,11 +4,36 @@ __AUTHORS__ = ['Judith Risse', 'Tim Booth']
 __VERSION__ = 0.3
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
-import sys, re
+import os, sys, re, time
+import copy
+import json
 from itertools import islice
+from collections import namedtuple, OrderedDict
+from multiprocessing import Pool
 import Levenshtein
 import bcl_direct_reader
+import inflate
+from run_layout import RunLayout, filter_tiles, parse_cycles, lane_number
+from staging_cache import StagingCache, parse_size
 from target import load_targets
+from shared_targets import SharedTargets
+from profiling import Profile, NO_PROFILE, write_record
+from metrics import Metrics
+from checkpoint import TileCheckpoints
+from partial_result import PartialResult, merge_partials, parse_shard, shard_tiles
+from tile_sampling import stratified_order, stratified_sample, strata_sizes, RatioEstimate
+
+try:
+    import stats_engine
+except ImportError:
+    #No numpy, so we use the pure Python code
+    stats_engine = None
+
+try:
+    from exhaustive import NeighbourScan
+except ImportError:
+    #No numpy, so no --exhaustive
+    NeighbourScan = None
 
 HISEQ_4000 = "hiseq_4000"
 HISEQ_X = "hiseq_x"
@@ -24,7 +49,14 @@ QUAL_FLAG = bcl_direct_reader.QUAL_FLAG
 def log(msg):
     print(str(msg), file=sys.stderr)
 
-def output_writer(lane, sample_size, lane_dupl, levels=0, verbose=False):
+OUTPUT_FORMATS = ['text', 'json', 'tsv']
+
+TSV_COLUMNS = [ 'lane', 'tile', 'level', 'targets', 'wells', 'dups', 'hits', 'acco', 'acci',
+                'overall', 'picard_v1', 'picard_v2' ]
+
+STAT_KEYS = ['wells', 'dups', 'hits', 'acco', 'acci']
+
+def output_writer(lane, sample_size, lane_dupl, levels=0, verbose=False, fmt='text', header=True):
     """ Reports on the lane by totting up the values in lane_dupl.
         The lane and sample_size arguments are added to the report but
         are not used in any calculations.
@@ -32,241 +64,1041 @@ def output_writer(lane, sample_size, lane_dupl, levels=0, verbose=False):
         If you want to understand what this is actually doing, look at
         the test code in test_count_well_duplicates.py
 
-        Note it would be possible to output the data as it is generated
-        without gathering the whole lot in RAM, but this seems a pointless
-        optimization.
-    """
+        fmt may be 'text' (the original report), 'json' (one line per lane) or
+        'tsv' (one row per tile and level, with tile 'all' for the lane totals).
+        In TSV mode the column headings are only printed if header is set.
+        All formats report the same numbers, as calculated by LaneAggregator.
 
-    #First infer the number of levels, if not provided explicitly
-    if not levels:
-        for atile in lane_dupl.values():
-            #Could be a duff tile?
-            if len(atile) > 0:
-                #No, it's OK.  Use the length of the first target.
-                levels = len(atile[0])
-                break
+        main() no longer calls this, but feeds each tile to a LaneAggregator
+        as it is done, so there is no need to hold the whole lane in RAM.
+    """
+    agg = LaneAggregator( lane, sample_size, levels or infer_levels(lane_dupl),
+                          verbose=verbose, fmt=fmt, header=header )
+    for tile in sorted(lane_dupl.keys()):
+        agg.add_tile(tile, lane_dupl[tile])
+    agg.finish()
 
-    #Grand totals...
-    # Targets that got sampled (ie. had a valid read at the centre
-    tot_targets = 0
-    # Wells that got examined, at each level
-    tot_wells = [0] * levels
-    # Dups found at each level (total wells)
-    tot_dups = [0] * levels
-    # Dups found at each level (counting 1 per target per level)
-    tot_hits = [0] * levels
-    # Accumulated hits counting from the inside out
-    tot_acco = [0] * levels
-    # and counting from the outside in
-    tot_acci = [0] * levels
+def lane_stats(lane_dupl, levels=0):
+    """ Calculates all the figures reported for a lane, without printing
+        anything.  See LaneAggregator.stats()
+    """
+    if stats_engine:
+        res = stats_engine.lane_stats(lane_dupl, levels or infer_levels(lane_dupl))
+        res.update(picard_estimates(res['targets'], res['dups'], res['acci']))
+        return res
 
+    agg = LaneAggregator(None, 0, levels or infer_levels(lane_dupl), verbose=True, fmt=None)
     for tile in sorted(lane_dupl.keys()):
+        agg.add_tile(tile, lane_dupl[tile])
+    return agg.stats()
 
-        tile_counts = lane_dupl[tile]
-        targets = len(tile_counts)
-        tot_targets += targets
-
-        if verbose:
-            print("Lane: %s\tTile: %s\tTargets: %i/%i" % (
-                         lane,     tile,        targets,sample_size))
-
-        #AccO and AccI require an explicit loop over targets.
-        #I could tally the other things in this loop too but to me it makes
-        #the code less readable.
-        #Not that the code is pretty, but test coverage assures me it's good.
-        acco = [0] * levels
-        acci = [0] * levels
-        for targ in tile_counts:
-            seen_hit = 0
-            for lev in range(levels):
-                if targ[lev][TALLY]:
-                    seen_hit = 1
-                acco[lev] += seen_hit
-            seen_hit = 0
-            for lev in reversed(range(levels)):
-                if targ[lev][TALLY]:
-                    seen_hit = 1
-                acci[lev] += seen_hit
+def infer_levels(lane_dupl):
+    """ Infer the number of levels from the data, if not provided explicitly
+    """
+    for atile in lane_dupl.values():
+        #Could be a duff tile?
+        if len(atile) > 0:
+            #No, it's OK.  Use the length of the first target.
+            return len(atile[0])
+    return 0
 
-        for lev in range(levels):
+class LaneAggregator:
+    """ Tots up the stats for a lane one tile at a time, keeping only the
+        running totals per level.  If verbose, each tile is reported as soon
+        as it is added.  Call finish() to report the lane summary.
 
-            wells = sum(targ[lev][LENGTH] for targ in tile_counts)
-            dups = sum(targ[lev][TALLY] for targ in tile_counts)
-            hits = sum(bool(targ[lev][TALLY]) for targ in tile_counts)
+        For JSON output the per-tile totals have to be kept until the end, but
+        this is a few numbers per tile, not the (TALLY, LENGTH) list for every target.
+        With fmt=None nothing is printed and you can just call stats().
+        keep_tiles keeps the per-tile totals whatever the format, for
+        results_db.py.
+    """
+    def __init__(self, lane, sample_size, levels, verbose=False, fmt='text', header=True, out=None,
+                 keep_tiles=False):
+        self.lane = lane
+        self.sample_size = sample_size
+        self.levels = levels
+        self.verbose = verbose
+        self.fmt = fmt
+        self.keep_tiles = keep_tiles
+        # None means STDOUT
+        self.out = out
+
+        self.tile_count = 0
+        self.tiles = []
+        # Set this to a RatioEstimate.as_dict() if only a sample of tiles was looked at
+        self.sampling = None
+        self.targets = 0
+        self.totals = { k: [0] * levels for k in STAT_KEYS }
+
+        if fmt == 'tsv' and header:
+            print(*TSV_COLUMNS, sep="\t", file=out)
+
+    def add_tile(self, tile, tile_counts):
+        """ Adds the list of (TALLY, LENGTH) tuples per target for one tile,
+            as returned by count_tile_dups()
+        """
+        self.add_tile_stats(tile, tile_stats(tile_counts, self.levels))
+
+    def add_tile_stats(self, tile, ts):
+        """ Adds the totals for one tile, as returned by tile_stats()
+        """
+        self.tile_count += 1
+        self.targets += ts['targets']
+        for k in STAT_KEYS:
+            tot = self.totals[k]
+            for lev in range(self.levels):
+                tot[lev] += ts[k][lev]
+
+        if self.verbose:
+            if self.fmt == 'text':
+                write_text_tile(self.lane, self.sample_size, tile, ts, self.levels, out=self.out)
+                (self.out or sys.stdout).flush()
+            elif self.fmt == 'tsv':
+                write_tsv_rows(self.lane, tile, ts, self.levels, out=self.out)
+                (self.out or sys.stdout).flush()
 
-            if verbose:
-                print("Level: %i\tWells: %i\tDups: %i\tHit: %i\tAccO: %i\tAccI: %i" % (
-                              lev+1,     wells,    dups,    hits,     acco[lev],acci[lev]))
+        if self.keep_tiles or (self.verbose and self.fmt not in ['text', 'tsv']):
+            self.tiles.append(dict(tile=tile, **ts))
 
-            tot_wells[lev] += wells
-            tot_dups[lev] += dups
-            tot_hits[lev] += hits
+    def stats(self):
+        """ Returns a dict with 'levels', 'tile_count', 'tiles' (a list of tile_stats()
+            results, each with a 'tile' key added, if they were kept), the lane totals
+            in the same form as for a tile, and the 'overall', 'picard_v1' and 'picard_v2'
+            duplication estimates.
+        """
+        res = dict( levels = self.levels,
+                    tile_count = self.tile_count,
+                    tiles = list(self.tiles),
+                    targets = self.targets )
+        for k in STAT_KEYS:
+            res[k] = list(self.totals[k])
 
-            tot_acco[lev] += acco[lev]
-            tot_acci[lev] += acci[lev]
+        res.update(picard_estimates(self.targets, res['dups'], res['acci']))
+        if self.sampling:
+            res['sampling'] = self.sampling
+        return res
+
+    def finish(self):
+        """ Reports the lane summary and returns the stats.
+        """
+        stats = self.stats()
+
+        if self.fmt == 'json':
+            write_json(self.lane, self.sample_size, stats, self.verbose, out=self.out)
+        elif self.fmt == 'tsv':
+            write_tsv_rows(self.lane, 'all', stats, self.levels, estimates=True, out=self.out)
+        elif self.fmt == 'text':
+            write_text_summary(self.lane, self.sample_size, stats, out=self.out)
+
+        return stats
+
+def tile_stats(tile_counts, levels):
+    """ Tots up the (TALLY, LENGTH) tuples for all the targets in one tile.
+        Returns a dict of the number of targets plus lists of wells, dups,
+        hits, acco and acci, with one entry per level.
+        This uses numpy via stats_engine.py if possible.
+    """
+    if stats_engine:
+        return stats_engine.tile_stats(tile_counts, levels)
+    return py_tile_stats(tile_counts, levels)
 
-    #And finally the Picard-scaled percentage
+def py_tile_stats(tile_counts, levels):
+    """ The pure Python version of tile_stats()
+    """
+    #AccO and AccI require an explicit loop over targets.
+    #I could tally the other things in this loop too but to me it makes
+    #the code less readable.
+    #Not that the code is pretty, but test coverage assures me it's good.
+    acco = [0] * levels
+    acci = [0] * levels
+    for targ in tile_counts:
+        seen_hit = 0
+        for lev in range(levels):
+            if targ[lev][TALLY]:
+                seen_hit = 1
+            acco[lev] += seen_hit
+        seen_hit = 0
+        for lev in reversed(range(levels)):
+            if targ[lev][TALLY]:
+                seen_hit = 1
+            acci[lev] += seen_hit
+
+    return dict( targets = len(tile_counts),
+                 # Wells that got examined, at each level
+                 wells = [ sum(targ[lev][LENGTH] for targ in tile_counts) for lev in range(levels) ],
+                 # Dups found at each level (total wells)
+                 dups = [ sum(targ[lev][TALLY] for targ in tile_counts) for lev in range(levels) ],
+                 # Dups found at each level (counting 1 per target per level)
+                 hits = [ sum(bool(targ[lev][TALLY]) for targ in tile_counts) for lev in range(levels) ],
+                 # Accumulated hits counting from the inside out
+                 acco = acco,
+                 # and counting from the outside in
+                 acci = acci )
+
+def picard_estimates(tot_targets, tot_dups, tot_acci):
+    """ The Picard-scaled percentages, as fractions, plus the raw duplication
+        rate, for the lane totals.
+    """
     #I have no real justification for this calculation, other than it looked reasonable
     #at the time.
-    if tot_acci:
-        grand_tot_hits = tot_acci[0]
-        grand_tot_dups = sum(tot_dups)
-
-        peds = ( grand_tot_hits *
-                 ( 1 - grand_tot_hits / ( grand_tot_dups + grand_tot_hits ) ) /
-                 tot_targets )
-
-        #Judith came up with this: 1-1/(2imcs-2)
-        #Which simplifies to...
-        peds2= ( grand_tot_hits *
-                 ( 1 - grand_tot_hits / ( 2 * grand_tot_dups ) ) /
-                 tot_targets )
-    else:
-        grand_tot_hits = peds = peds2 = 0
+    grand_tot_hits = tot_acci[0] if tot_acci else 0
+    grand_tot_dups = sum(tot_dups)
+
+    if not grand_tot_hits:
+        return dict(overall=0.0, picard_v1=0.0, picard_v2=0.0)
+
+    peds = ( grand_tot_hits *
+             ( 1 - grand_tot_hits / ( grand_tot_dups + grand_tot_hits ) ) /
+             tot_targets )
+
+    #Judith came up with this: 1-1/(2imcs-2)
+    #Which simplifies to...
+    peds2= ( grand_tot_hits *
+             ( 1 - grand_tot_hits / ( 2 * grand_tot_dups ) ) /
+             tot_targets )
+
+    return dict(overall=grand_tot_hits/tot_targets, picard_v1=peds, picard_v2=peds2)
+
+def _frac(n, d):
+    return n / d if d else 0.0
 
+def write_text_tile(lane, sample_size, tile, ts, levels, out=None):
+    """ Prints the lines of the text report for one tile.
+    """
+    print("Lane: %s\tTile: %s\tTargets: %i/%i" % (
+                 lane,     tile,        ts['targets'],sample_size), file=out)
+    for lev in range(levels):
+        print("Level: %i\tWells: %i\tDups: %i\tHit: %i\tAccO: %i\tAccI: %i" % (
+                      lev+1,     ts['wells'][lev],
+                                           ts['dups'][lev],
+                                                     ts['hits'][lev],
+                                                              ts['acco'][lev],
+                                                                        ts['acci'][lev] ), file=out)
+
+def write_text_summary(lane, sample_size, stats, out=None):
+    """ Prints the lane summary part of the text report.
+    """
+    tot_targets = stats['targets']
 
-    #And report
     print("LaneSummary: %s\tTiles: %i\tTargets: %i/%i" % (
-                        lane,      len(lane_dupl),
+                        lane,      stats['tile_count'],
                                                 tot_targets,
-                                                   sample_size*len(lane_dupl) ))
+                                                   sample_size*stats['tile_count'] ), file=out)
 
-    for lev in range(levels):
+    for lev in range(stats['levels']):
         print("Level: %i\tWells: %i\tDups: %i (%.5f)\t" % (
-                      lev+1,     tot_wells[lev],
-                                           tot_dups[lev],
-                                               tot_dups[lev] / tot_wells[lev]) +
+                      lev+1,     stats['wells'][lev],
+                                           stats['dups'][lev],
+                                               _frac(stats['dups'][lev], stats['wells'][lev])) +
               "Hit: %i (%.5f)\tAccO: %i (%.5f)\tAccI: %i (%.5f)" % (
-                    tot_hits[lev],
-                        tot_hits[lev] / tot_targets,
-                                     tot_acco[lev],
-                                         tot_acco[lev] / tot_targets,
-                                                      tot_acci[lev],
-                                                          tot_acci[lev] / tot_targets)
-             )
+                    stats['hits'][lev],
+                        _frac(stats['hits'][lev], tot_targets),
+                                     stats['acco'][lev],
+                                         _frac(stats['acco'][lev], tot_targets),
+                                                      stats['acci'][lev],
+                                                          _frac(stats['acci'][lev], tot_targets)),
+              file=out )
 
-    raw_dup_rate = grand_tot_hits/tot_targets if grand_tot_hits else 0.0
+    print(file=out)
+    print("Overall duplication (Acc/Targets): {:.2%}".format(stats['overall']), file=out)
+    print("Picard-equivalent duplication v1:  {:.2%}".format(stats['picard_v1']), file=out)
+    print("Picard-equivalent duplication v2:  {:.2%}".format(stats['picard_v2']), file=out)
 
-    print()
-    print("Overall duplication (Acc/Targets): {:.2%}".format(raw_dup_rate))
-    print("Picard-equivalent duplication v1:  {:.2%}".format(peds))
-    print("Picard-equivalent duplication v2:  {:.2%}".format(peds2))
+    if stats.get('sampling'):
+        samp = stats['sampling']
+        print("Tiles sampled: {}/{}, targets: {}, overall duplication {:.2%} +/- {} ({:.0%} confidence)".format(
+                samp['tiles_used'], samp['tiles_total'], samp['targets_used'], samp['estimate'],
+                'n/a' if samp['half_width'] is None else '{:.2%}'.format(samp['half_width']),
+                samp['confidence'] ), file=out)
 
+def write_json(lane, sample_size, stats, verbose=False, out=None):
+    """ Prints the stats for the lane as a single line of JSON.
+    """
+    res = dict(lane=lane, sample_size=sample_size, **stats)
+    if not verbose:
+        del res['tiles']
+    print(json.dumps(res, sort_keys=True), file=out)
 
-def main():
-    # Setup options
-    args = parse_args()
+def write_tsv_rows(lane, tile, ts, levels, estimates=False, out=None):
+    """ Prints one TSV row per level for a tile, or for the lane totals
+        with 'all' in the tile column.  The last three columns are only
+        filled in for the lane totals.
+    """
+    for lev in range(levels):
+        row = [ lane, tile, lev+1, ts['targets'] ] + [ ts[k][lev] for k in STAT_KEYS ]
+        if estimates:
+            row.extend( '%.6f' % ts[k] for k in ['overall', 'picard_v1', 'picard_v2'] )
+        else:
+            row.extend( [''] * 3 )
+        print(*row, sep="\t", file=out)
 
-    if args.quiet:
-        global log
+
+# One set of the options that affect the counting.  Several of these can be
+# done in one pass over the data (see --compare).
+CountConfig = namedtuple('CountConfig', 'name edit_distance hamming level sample_size')
+
+CONFIG_KEYS = dict( e = 'edit_distance', edit_distance = 'edit_distance',
+                    l = 'level', level = 'level',
+                    n = 'sample_size', sample_size = 'sample_size' )
+
+def parse_config(spec, base):
+    """ Parses a --compare option like "e1:e=1" or "ham10k:n=10000,hamming"
+        into a CountConfig, with anything not mentioned being the same as base.
+    """
+    name, _, settings = spec.partition(':')
+    assert re.match(r'^[\w.-]+$', name), "Bad configuration name in %r" % spec
+
+    res = base._replace(name=name)
+    for setting in filter(None, settings.split(',')):
+        key, _, val = setting.partition('=')
+        if key in ['hamming', 'levenshtein']:
+            res = res._replace(hamming = (key == 'hamming'))
+        else:
+            assert key in CONFIG_KEYS, "Unknown setting %r in %r" % (key, spec)
+            res = res._replace(**{ CONFIG_KEYS[key]: int(val) })
+    return res
+
+def count_tile_dups_multi(targets, seq_objs, configs, profile=NO_PROFILE):
+    """ As count_tile_dups() but for several CountConfigs at once.  targets
+        must hold enough targets and levels for all of them.  Each distance
+        is calculated once for each metric (Hamming or Levenshtein) needed, and
+        then compared to the threshold of every configuration.
+        Returns a list of results as from count_tile_dups(), one per configuration.
+    """
+    dist_funcs = { h: Levenshtein.hamming if h else Levenshtein.distance
+                   for h in set(c.hamming for c in configs) }
+    max_level = max(c.level for c in configs)
+
+    all_counts = [ [] for c in configs ]
+    comparisons = 0
+
+    for n, target in enumerate(targets):
+
+        #Target n is only in the sample for configurations with sample_size > n,
+        #so once no configuration wants it none wants the rest either.
+        in_sample = [ i for i, c in enumerate(configs) if n < c.sample_size ]
+        if not in_sample:
+            break
+
+        center = target.get_centre()
+        if center not in seq_objs[0] or not seq_objs[0][center][QUAL_FLAG]:
+            continue
+        center_seq = ''.join(s[center][SEQUENCE] for s in seq_objs)
+
+        all_stats = { i: [None] * configs[i].level for i in in_sample }
+
+        for level in range(max_level):
+            at_level = [ i for i in in_sample if level < configs[i].level ]
+            if not at_level:
+                break
+
+            well_seqs = [ ''.join(s[well_index][SEQUENCE] for s in seq_objs)
+                          for well_index in target.get_indices(level+1) ]
+
+            dists = dict()
+            for h in set(configs[i].hamming for i in at_level):
+                dists[h] = [ dist_funcs[h](center_seq, well_seq) for well_seq in well_seqs ]
+                comparisons += len(well_seqs)
+
+            for i in at_level:
+                c = configs[i]
+                dups = sum( 1 for d in dists[c.hamming] if d <= c.edit_distance )
+                all_stats[i][level] = (dups, len(well_seqs))
+
+        for i in in_sample:
+            all_counts[i].append(all_stats[i])
+
+    profile.count('targets_valid', len(all_counts[0]))
+    profile.count('comparisons', comparisons)
+    return all_counts
+
+
+def count_tile_dups(targets, seq_objs, levels, edit_distance, get_edit_distance, profile=NO_PROFILE):
+    """ Compares the centre of each target with the wells around it, out to the
+        given number of levels.  seq_objs is a list of results from Tile.get_seqs(),
+        one per contiguous range of cycles.
+        Returns a list with an entry per valid target (ie. centre seq passed QC),
+        each being a list of (TALLY, LENGTH) tuples, one per level.
+    """
+    tile_counts = []
+    comparisons = 0
+
+    for target in targets:
+
+        center = target.get_centre()
+        #log("Center: %s"%center)
+
+        # if the center sequence does not pass the pass filter we don't assess edit distance
+        # as large number of Ns compared to other reads with large number of Ns results in
+        # small edit distance. read_tile_seqs() leaves out such targets altogether.
+        if center not in seq_objs[0] or not seq_objs[0][center][QUAL_FLAG]:
+            continue
+        center_seq = ''.join(s[center][SEQUENCE] for s in seq_objs)
+
+        #Add a placeholder for the new stats
+        target_stats = [None] * levels
+        tile_counts.append(target_stats)
+
+        for level in range(levels):
+            #The level variable now runs from 0, but the target levels run from
+            #1 because 0 is the centre, so be careful!
+            dups = 0
+            well_indices = list(target.get_indices(level+1))
+            assert len(well_indices) > 0
+            for well_index in well_indices:
+                well_seq = ''.join(s[well_index][SEQUENCE] for s in seq_objs)
+                dist = get_edit_distance(center_seq, well_seq)
+
+                #Log all the duplicates. This might get fairly large!
+                #Note that to locate the matching sequence header in a FASTQ file you need to
+                #convert the well number into co-ords. Eg for location 123456:
+                # $ dump_slocs.py datadir/Data/Intensities/s.locs | grep ^0123456
+                if dist <= edit_distance:
+                    dups += 1
+                    log("center seq at {:>07}: {}".format(center, center_seq))
+                    log("well seq at   {:>07}: {}".format(well_index, well_seq))
+                    log("edit distance: {}".format(dist))
+
+            #Save a tuple of (TALLY, LENGTH)
+            target_stats[level] = (dups, len(well_indices))
+            comparisons += len(well_indices)
+
+    profile.count('targets_valid', len(tile_counts))
+    profile.count('comparisons', comparisons)
+    return tile_counts
+
+
+def passing_target_wells(tile_bcl, targets):
+    """ Loads the filter for the tile and returns the wells of all the targets
+        whose centre passed, as a set.  The targets whose centre failed are
+        never counted, so there is no need to read the bases of their wells,
+        unless some other target wants them.  The number of wells left out is
+        counted as 'wells_pruned' in the profile.
+    """
+    passed = tile_bcl.filter_passed(t.get_centre() for t in targets)
+
+    wells = set()
+    failed = 0
+    for t in targets:
+        if t.get_centre() in passed:
+            wells.update(t.get_indices())
+        else:
+            failed += 1
+
+    pruned = len(targets.get_all_indices()) - len(wells)
+    tile_bcl.profile.count('wells_pruned', pruned)
+    log("Skipping %i wells as %i of %i target centres failed the filter." % (pruned, failed, len(targets)))
+    return wells
+
+def read_tile_seqs(tile_bcl, targets, cycles):
+    """ Reads the sequence data for the target wells from the BCL into RAM,
+        for the targets whose centre passed the filter.
+        Returns a list of results from get_seqs(), one per range of cycles.
+    """
+    wells = passing_target_wells(tile_bcl, targets)
+
+    seq_objs = []
+    for r in cycles:
+        # get_seqs() cannot do an empty list
+        seq_objs.append( tile_bcl.get_seqs(wells, *r) if wells else dict() )
+
+    log("Got %i sequences from %i contiguous cycle ranges." % (
+             sum(len(s) for s in seq_objs),
+                               len(seq_objs) ))
+    return seq_objs
+
+def compare_tile(targets, seq_objs, configs, profile=NO_PROFILE):
+    """ Counts the duplicates in a tile for each of the configurations.
+        Returns a list of tile_stats() results, one per configuration.
+        targets may hold more targets than any configuration samples.
+    """
+    with profile.phase('compare'):
+        #count_tile_dups() uses every target, so only if that is the sample
+        if len(configs) == 1 and configs[0].sample_size >= len(targets):
+            c = configs[0]
+            all_counts = [ count_tile_dups( targets, seq_objs, c.level, c.edit_distance,
+                                            Levenshtein.hamming if c.hamming else Levenshtein.distance,
+                                            profile = profile ) ]
+        else:
+            all_counts = count_tile_dups_multi(targets, seq_objs, configs, profile=profile)
+
+    with profile.phase('report'):
+        return [ tile_stats(tile_counts, c.level) for c, tile_counts in zip(configs, all_counts) ]
+
+class TileCounter:
+    """ Reads and counts whole tiles, in a worker process (see --processes).
+        Only the settings are pickled, so each worker opens the run for
+        itself, and the targets should be a SharedTargets so that the workers
+        all use the same copy.
+    """
+    def __init__( self, run, layout, targets, configs, cycles, profile=False,
+                  inflate=None, stage_dir=None, stage_size='50G', prefetch=8, quiet=False ):
+        self.run = run
+        self.inflate = inflate
+        self.stage_dir = stage_dir
+        self.stage_size = stage_size
+        self.prefetch = prefetch
+        self.quiet = quiet
+        self.layout = layout
+        self.targets = targets
+        self.configs = configs
+        self.cycles = cycles
+        self.profile = profile
+        self._readers = dict()
+
+    def __getstate__(self):
+        return dict(self.__dict__, _readers=dict())
+
+    def reader(self, run=None):
+        """ The BCLReader for the run, which is kept for the next tile.  Any
+            run other than the one we were made for gets its own RunLayout.
+        """
+        run = run or self.run
+        if run not in self._readers:
+            stage = StagingCache(self.stage_dir, parse_size(self.stage_size)) if self.stage_dir else None
+            self._readers[run] = bcl_direct_reader.BCLReader( run, inflate_backend = self.inflate,
+                                                              layout = self.layout if run == self.run else None,
+                                                              stage = stage )
+        return self._readers[run]
+
+    def count(self, lane, tile, run=None):
+        """ Returns the list of tile_stats(), one per configuration, and the Profile.
+        """
+        tile_prof = Profile() if self.profile else NO_PROFILE
+        with tile_prof.phase('tile'):
+            log("Reading tile %s in lane %s" % (tile, lane))
+            tile_bcl = self.reader(run).get_tile(lane, tile, profile=tile_prof)
+            if self.prefetch:
+                tile_bcl.prefetch([ c for s, e in self.cycles for c in range(s, e) ], self.prefetch)
+            try:
+                seq_objs = read_tile_seqs(tile_bcl, self.targets, self.cycles)
+            finally:
+                tile_bcl.close()
+
+            all_ts = compare_tile(self.targets, seq_objs, self.configs, profile=tile_prof)
+        return all_ts, tile_prof
+
+# The TileCounter for this worker process
+_counter = None
+
+def init_worker(counter):
+    global _counter, log
+    _counter = counter
+    if counter.quiet:
         log = lambda *args: None
 
-    lanes = args.lane.split(',') if args.lane else range(1, 8+1)
+def count_tile_worker(lane, tile, run=None):
+    return _counter.count(lane, tile, run)
 
+def stype_tiles(stype):
+    """ Builds a list of the tiles we expect to see given the --stype setting, which
+        may also be the highest tile number.
+    """
     max_tile = 24 #Works for Highseq X
     max_swath = 22 #Works for X and 4000
-    if args.stype == HISEQ_4000:
+    if stype == HISEQ_4000:
         max_tile = 28
     else:
         try:
-            max_tile = int(args.stype) % 100
-            max_swath = int(args.stype) // 100 or 22
+            max_tile = int(stype) % 100
+            max_swath = int(stype) // 100 or 22
         except ValueError:
             pass # Never mind. Stick with 24/22.
 
-    # Build a list of tiles we expect to see. Swaths for the older machines are [11, 12, 21, 22] but
-    # in general and to handle the Novoseq we can infer the list from the max_swath value.
+    # Swaths for the older machines are [11, 12, 21, 22] but in general and to handle the
+    # Novoseq we can infer the list from the max_swath value.
     tiles = []
     for swath in [ '{}{}'.format(s, n) for s in range(1,max_swath//10+1) for n in range(1,max_swath%10+1) ]:
         for tile in range(1,max_tile+1):
             tiles.append("%s%02d" % (swath, tile))
+    return tiles
+
+# What WellDupCounter.iter_lanes() yields for each lane.  tiles are the tiles
+# actually used, stats has the LaneAggregator.stats() for each configuration,
+# seconds is the wall time for the lane and profile is a Profile, or
+# NO_PROFILE if profiling is off.
+LaneResult = namedtuple('LaneResult', 'lane tiles stats seconds profile')
+
+DEFAULT_CONFIG = CountConfig(None, 2, False, 3, 2500)
+
+class WellDupCounter:
+    """ Does what the command line does, but as a library, so that a pipeline
+        can count many lanes (and runs) in one process without starting
+        afresh each time.  The targets, the layout and BCL reader for each
+        run, and any worker processes are kept from one call to the next.
+        Call close() when done, or use it as a context manager.
+
+        targets may be an AllTargets or the filename of a targets file, and
+        configs a CountConfig or a list of them, the first being the main one
+        and the others as for --compare.  The other options are the same as
+        on the command line.  If profile is a file handle, a profile record is
+        written to it for every tile and lane.
+
+        with WellDupCounter('/path/to/run', 'targets.list', cycles=[(50, 100)]) as counter:
+            for res in counter.run(lanes=['1', '2'], tiles='1...'):
+                print(res.lane, res.stats[0]['overall'])
+
+        Nothing is printed unless fmt is set, and then the output is just as
+        count_well_duplicates.py would give.
+    """
+    def __init__( self, run, targets=None, configs=DEFAULT_CONFIG, cycles=((50, 100),),
+                  exhaustive=False, slocs=None, inflate=None, prefetch=8,
+                  stage_dir=None, stage_size='50G', processes=1, stype=None,
+                  profile=False, quiet=False ):
+        self.run_dir = run
+        self.configs = [ configs ] if isinstance(configs, CountConfig) else list(configs)
+        self.cycles = [ tuple(c) for c in cycles ]
+        self.prefetch = prefetch
+        self.processes = processes
+        self.stype = stype
+        self.profile_fh = profile if hasattr(profile, 'write') else None
+        self.new_profile = Profile if profile else lambda: NO_PROFILE
+
+        self.scan = None
+        self.targets = None
+        if exhaustive:
+            if not NeighbourScan:
+                raise RuntimeError("Exhaustive counting needs numpy")
+            if processes > 1:
+                raise ValueError("Exhaustive counting cannot use several processes")
+            # Every passing well is a target, with the neighbours worked out from the
+            # s.locs file. This always uses the Hamming distance.
+            self.configs = [ self.configs[0]._replace(hamming=True) ]
+            self.scan = NeighbourScan( slocs or os.path.join(run, 'Data', 'Intensities', 's.locs'),
+                                       self.configs[0].level, self.configs[0].edit_distance )
+            self.sample_sizes = [ self.scan.num_wells ]
+            self.fingerprints = [ self.scan.fingerprint() ]
+        else:
+            # Load enough targets and levels for every configuration. The targets used
+            # by each configuration are just the first sample_size of them.
+            if isinstance(targets, str):
+                targets = load_targets( filename = targets,
+                                        levels = max(c.level for c in self.configs) + 1,
+                                        limit = max(c.sample_size for c in self.configs) )
+            self.targets = targets
+            self.sample_sizes = [ min(len(targets), c.sample_size) for c in self.configs ]
+            self.fingerprints = [ targets.fingerprint(limit=c.sample_size, levels=c.level+1)
+                                  for c in self.configs ]
+
+        # The layout of the run (lanes, tiles, which files are where) is worked out
+        # just once, and shared with the BCL reader.
+        self.tile_counter = TileCounter( run, RunLayout(run), self.targets, self.configs, self.cycles,
+                                         profile = bool(profile), inflate = inflate,
+                                         stage_dir = stage_dir, stage_size = stage_size,
+                                         prefetch = prefetch, quiet = quiet )
+
+        # With processes > 1, tiles are counted in parallel by worker processes,
+        # which all share one read-only copy of the targets. These are started
+        # when first needed.
+        self.pool = None
+        self.shared_targets = None
+
+    def layout(self, run=None):
+        return self.reader(run).layout
+
+    def reader(self, run=None):
+        return self.tile_counter.reader(run)
+
+    def _get_pool(self):
+        if not self.pool:
+            self.shared_targets = SharedTargets.export(self.targets)
+            counter = copy.copy(self.tile_counter)
+            counter.targets = self.shared_targets
+            self.pool = Pool(self.processes, initializer=init_worker, initargs=(counter,))
+        return self.pool
+
+    def count_keys(self, run=None):
+        """ Checkpoints and partial results are only valid if everything that
+            affects the counts is the same.  This is the key for each
+            configuration.
+        """
+        return [ dict( run = os.path.realpath(run or self.run_dir),
+                       targets = fp,
+                       levels = c.level,
+                       edit_distance = c.edit_distance,
+                       hamming = c.hamming,
+                       cycles = self.cycles )
+                 for c, fp in zip(self.configs, self.fingerprints) ]
+
+    def new_partial(self, sampling=None, shard=None, run=None):
+        """ A PartialResult to pass to iter_lanes(), to be saved afterwards.
+        """
+        return PartialResult( configs = [ dict( name = c.name,
+                                                sample_size = size,
+                                                key = k )
+                                          for c, size, k in zip(self.configs, self.sample_sizes,
+                                                                self.count_keys(run)) ],
+                              sampling = sampling,
+                              shard = shard )
+
+    def lane_tiles(self, lane, tiles=None, run=None):
+        """ The tiles in the lane, from RunInfo.xml unless stype was given.
+            tiles may be a list, or a comma-separated list of patterns as
+            for -t.
+        """
+        all_tiles = stype_tiles(self.stype) if self.stype else self.layout(run).tiles(lane)
+        if isinstance(tiles, str):
+            return filter_tiles(all_tiles, tiles)
+        return list(tiles) if tiles else all_tiles
+
+    def run(self, lanes=None, tiles=None, **kwargs):
+        """ Counts the lanes and returns a list of LaneResult.  See iter_lanes().
+        """
+        return list(self.iter_lanes(lanes, tiles, **kwargs))
+
+    def iter_lanes( self, lanes=None, tiles=None, run=None,
+                    adaptive=None, tile_fraction=None, confidence=0.95, min_tiles=8,
+                    shard=None, checkpoint=None, resume=False, partial=None,
+                    verbose=True, fmt=None, outputs=None, keep_tiles=False ):
+        """ Counts the lanes (every lane by default) one at a time, yielding a
+            LaneResult as each is done.  run may be a different run to the one
+            the counter was made for, so long as the same targets apply.
+
+            The other options are as on the command line, except that shard
+            is an (i, N) tuple, checkpoint is a directory and partial is a
+            PartialResult from new_partial().  If fmt is set the report is
+            printed as it goes, with the report for each configuration going
+            to the file in outputs (None for STDOUT).  keep_tiles keeps the
+            totals for each tile in the stats even when they are not printed.
+        """
+        run = run or self.run_dir
+        reader = self.reader(run)
+        cycles = self.cycles
+        configs = self.configs
+        lanes = lanes or reader.layout.lanes
+        outputs = outputs or [ None ] * len(configs)
+        new_profile = self.new_profile
+
+        checkpoints = [ None ] * len(configs)
+        if checkpoint:
+            checkpoints = [ TileCheckpoints(checkpoint, **k) for k in self.count_keys(run) ]
+
+        pool = self._get_pool() if self.processes > 1 else None
+
+        for lane in lanes:
+
+            lane_prof = new_profile()
+            lane_start = time.time()
+
+            lane_aggs = [ LaneAggregator( lane, size, c.level,
+                                          verbose = verbose,
+                                          fmt = fmt, header = (lane == lanes[0]), out = out,
+                                          keep_tiles = keep_tiles )
+                          for c, size, out in zip(configs, self.sample_sizes, outputs) ]
+            lane_agg = lane_aggs[0]
+
+            all_tiles = self.lane_tiles(lane, tiles, run)
+            lane_tiles = all_tiles
+            estimates = []
+            if adaptive or tile_fraction:
+                estimates = [ RatioEstimate( total_tiles = len(all_tiles),
+                                             confidence = confidence,
+                                             strata = strata_sizes(all_tiles) )
+                              for c in configs ]
+            if adaptive:
+                #Visit the tiles in an order that spreads them over the flowcell, and stop
+                #as soon as the lane estimate is good enough.
+                lane_tiles = stratified_order(all_tiles, seed=lane_number(lane))
+            elif tile_fraction:
+                #Just read a fixed fraction of the tiles, spread over the flowcell.
+                lane_tiles = stratified_sample(all_tiles, tile_fraction, seed=lane_number(lane))
+
+            if partial:
+                partial.add_lane(lane, lane_tiles, all_tiles)
+            if shard:
+                #Only do our share of the tiles. Any estimate printed is from just this
+                #shard, but the merge will work it out again from all the tiles.
+                lane_tiles = shard_tiles(lane_tiles, *shard)
+
+            #The tile only needs to be read if any configuration lacks a checkpoint.
+            def load_checkpoints(tile):
+                return [ ckpt.load(lane, tile) if resume else None for ckpt in checkpoints ]
+
+            #Opens a tile and, if prefetching is on, starts reading the cycle files in the background.
+            def open_tile(tile):
+                tile_prof = new_profile()
+                with tile_prof.phase('tile'):
+                    tile_bcl = reader.get_tile(lane, tile, profile=tile_prof)
+                    if self.prefetch:
+                        tile_bcl.prefetch([ c for s, e in cycles for c in range(s, e) ], self.prefetch)
+                return tile_prof, tile_bcl
+            opened = dict()
+
+            #With several processes, whole tiles are read and counted by the workers, a
+            #few tiles ahead of the one being reported.
+            pending = OrderedDict()
+            to_count = iter([ t for t in lane_tiles if None in load_checkpoints(t) ] if pool else [])
+            def submit_tiles():
+                for tile in islice(to_count, 2 * self.processes - len(pending)):
+                    pending[tile] = pool.apply_async(count_tile_worker, (lane, tile, run))
+
+            tiles_used = []
+            try:
+                for n, tile in enumerate(lane_tiles):
+
+                    all_ts = load_checkpoints(tile)
+                    if None not in all_ts:
+                        log("Using checkpoint for tile %s in lane %s" % (tile, lane))
+                        for agg, ts in zip(lane_aggs, all_ts):
+                            agg.add_tile_stats(tile, ts)
+                        lane_prof.count('tiles_resumed')
+                    else:
+                        if pool:
+                            submit_tiles()
+                            all_ts, tile_prof = pending.pop(tile).get()
+                        else:
+                            tile_prof, tile_bcl = opened.pop(tile, None) or open_tile(tile)
+                            with tile_prof.phase('tile'):
+                                log("Reading tile %s in lane %s" % (tile, lane))
+
+                                try:
+                                    if self.scan:
+                                        words, passing = self.scan.read_tile(tile_bcl, cycles, profile=tile_prof)
+                                    else:
+                                        seq_objs = read_tile_seqs(tile_bcl, self.targets, cycles)
+                                finally:
+                                    tile_bcl.close()
+
+                                #Start reading the next tile while this one is compared.
+                                next_tile = lane_tiles[n+1] if n+1 < len(lane_tiles) else None
+                                if self.prefetch and next_tile and None in load_checkpoints(next_tile):
+                                    opened[next_tile] = open_tile(next_tile)
+
+                                if self.scan:
+                                    all_ts = [ self.scan.stats(words, passing, profile=tile_prof) ]
+                                else:
+                                    all_ts = compare_tile(self.targets, seq_objs, configs, profile=tile_prof)
+
+                        #The results go straight into the lane totals, and are reported
+                        #right away if we are reporting every tile.
+                        with tile_prof.phase('report'):
+                            for agg, ckpt, ts in zip(lane_aggs, checkpoints, all_ts):
+                                agg.add_tile_stats(tile, ts)
+                                if ckpt:
+                                    ckpt.save(lane, tile, ts)
+
+                        if self.profile_fh:
+                            write_record(self.profile_fh, tile_prof.as_dict( record='tile', lane=lane, tile=tile,
+                                                                             inflate=reader.inflater.backend ))
+                        lane_prof.add(tile_prof)
 
-    # If tiles are specified check that all are valid.
-    if args.tile_id:
-        filtered_tiles = []
-        for tpat in args.tile_id.split(','):
-            t_match = [t for t in tiles if re.match('^'+tpat+'$', t)]
-            assert t_match, "%s matches no tile identifiers for a %s" % (t, args.stype)
-            filtered_tiles.extend(t_match)
-        tiles = sorted(set(filtered_tiles))
+                    tiles_used.append(tile)
+                    if partial:
+                        partial.add_tile(lane, tile, all_ts)
 
-    # And set cycles based on either --start/--end or --cycles
+                    #Adaptive sampling is driven by the main configuration
+                    for est, ts in zip(estimates, all_ts):
+                        est.add(ts['acci'][0], ts['targets'], tile)
+                    if adaptive and estimates[0].converged(adaptive, min_tiles):
+                        log("Estimate for lane %s has converged after %i tiles" % (lane, estimates[0].tiles()))
+                        break
+
+            finally:
+                #Any tile read ahead but then not wanted, or left open by an error. Tiles
+                #still being counted by the workers are just ignored.
+                for tile_prof, tile_bcl in opened.values():
+                    tile_bcl.close()
+                pending.clear()
+
+            #Write summary per lane
+            with lane_prof.phase('report'):
+                for agg, est in zip(lane_aggs, estimates):
+                    agg.sampling = est.as_dict()
+                all_stats = [ agg.finish() for agg in lane_aggs ]
+
+            if self.profile_fh:
+                write_record(self.profile_fh, lane_prof.as_dict( record='lane', lane=lane, tiles=lane_agg.tile_count,
+                                                                 inflate=reader.inflater.backend ))
+
+            yield LaneResult(lane, tiles_used, all_stats, time.time() - lane_start, lane_prof)
+
+    def close(self):
+        """ Stops any worker processes.
+        """
+        if self.pool:
+            self.pool.terminate()
+            self.pool = None
+        if self.shared_targets:
+            self.shared_targets.close()
+            self.shared_targets = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def main():
+    if sys.argv[1:2] == ['merge']:
+        return merge_main()
+
+    # Setup options
+    args = parse_args()
+
+    if args.quiet:
+        global log
+        log = lambda *args: None
+
+    # Set cycles based on either --start/--end or --cycles
     cycles = [(args.start, args.end)]
     if args.cycles:
-        #Minimal validation - user will get cryptic messages on bad values
-        cycles = [ (int(s), int(e)) for r in args.cycles.split(',') for s, e in (r.split('-'),) ]
+        cycles = parse_cycles(args.cycles)
 
-    # Decide how we are calculating edit distances
-    get_edit_distance = Levenshtein.hamming if args.hamming else Levenshtein.distance
+    # The main configuration, and any others to be done in the same pass
+    configs = [ CountConfig( None, args.edit_distance, args.hamming, args.level, args.sample_size ) ]
+    for spec in args.compare or []:
+        configs.append(parse_config(spec, configs[0]))
 
-    targets = load_targets( filename = args.coord_file,
-                            levels = args.level+1,
-                            limit = args.sample_size)
-    bcl_reader = bcl_direct_reader.BCLReader(args.run)
+    # Profiling output goes to a file, or to STDERR if the filename is '-'
+    profile_fh = None
+    if args.profile:
+        profile_fh = sys.stderr if args.profile == '-' else open(args.profile, 'w')
 
-    for lane in lanes:
+    # The metrics need the byte counts, so profile if either is wanted. Leaving the
+    # with block shuts down any worker processes and removes the shared targets,
+    # even if something goes wrong.
+    with WellDupCounter( args.run, args.coord_file, configs, cycles,
+                         exhaustive = args.exhaustive, slocs = args.slocs,
+                         inflate = args.inflate, prefetch = args.prefetch,
+                         stage_dir = args.stage_dir, stage_size = args.stage_size,
+                         processes = args.processes, stype = args.stype,
+                         profile = profile_fh or bool(args.metrics), quiet = args.quiet ) as counter:
 
-        lane_dupl = {}
-        for tile in tiles:
-            log("Reading tile %s in lane %s" % (tile, lane))
-            tile_bcl = bcl_reader.get_tile(lane, tile)
-
-            #This actually reads the sequence data from the BCL into RAM
-            #Now we support ranges, we might have to do this two or more times.
-            seq_objs = []
-            for r in cycles:
-                seq_objs.append( tile_bcl.get_seqs(targets.get_all_indices(), *r) )
-
-            log("Got %i sequences from %i contiguous cycle ranges." % (
-                     sum(len(s) for s in seq_objs),
-                                       len(seq_objs) ))
-
-            #Each entry in lane_dupl dict is a list of valid (ie. centre seq passed QC)
-            #targets for this tile.
-            lane_dupl[tile] = []
-
-            for target in targets:
-
-                center = target.get_centre()
-                #log("Center: %s"%center)
-
-                # if the center sequence does not pass the pass filter we don't assess edit distance
-                # as large number of Ns compared to other reads with large number of Ns results in
-                # small edit distance
-                if not seq_objs[0][center][QUAL_FLAG]:
-                    continue
-                center_seq = ''.join(s[center][SEQUENCE] for s in seq_objs)
-
-                #Add a placeholder for the new stats
-                target_stats = [None] * args.level
-                lane_dupl[tile].append(target_stats)
-
-                for level in range(args.level):
-                    #The level variable now runs from 0, but the target levels run from
-                    #1 because 0 is the centre, so be careful!
-                    dups = 0
-                    well_indices = list(target.get_indices(level+1))
-                    assert len(well_indices) > 0
-                    for well_index in well_indices:
-                        well_seq = ''.join(s[well_index][SEQUENCE] for s in seq_objs)
-                        dist = get_edit_distance(center_seq, well_seq)
-
-                        #Log all the duplicates. This might get fairly large!
-                        #Note that to locate the matching sequence header in a FASTQ file you need to
-                        #convert the well number into co-ords. Eg for location 123456:
-                        # $ dump_slocs.py datadir/Data/Intensities/s.locs | grep ^0123456
-                        if dist <= args.edit_distance:
-                            dups += 1
-                            log("center seq at {:>07}: {}".format(center, center_seq))
-                            log("well seq at   {:>07}: {}".format(well_index, well_seq))
-                            log("edit distance: {}".format(dist))
-
-                    #Save a tuple of (TALLY, LENGTH)
-                    target_stats[level] = (dups, len(well_indices))
-
-            #log(lane_dupl)
-        #Write output per lane
-        output_writer(lane, len(targets), lane_dupl, verbose = not args.summary_only)
+        # The main report goes to STDOUT and the others to files named for each configuration.
+        outputs = [ None ]
+        for c in configs[1:]:
+            ext = 'txt' if args.format == 'text' else args.format
+            outputs.append(open(os.path.join(args.compare_dir, c.name + '.' + ext), 'w'))
+
+        # With --partial the raw tile totals are saved so that the results of
+        # several shards can be merged later.
+        partial = None
+        if args.partial:
+            partial = counter.new_partial( sampling = dict( tile_fraction = args.tile_fraction,
+                                                            confidence = args.confidence ) if args.tile_fraction else None,
+                                           shard = args.shard )
+
+        metrics = None
+        if args.metrics:
+            metrics = Metrics()
+            run_name = os.path.basename(os.path.realpath(args.run))
+            metrics.set('welldup_run_success', 0, "1 if the last count finished without error", run=run_name)
+            metrics.write(args.metrics)
+
+        # Results go in the database as each lane is done
+        results_db = None
+        if args.results_db:
+            from results_db import ResultsDB, format_cycles, parse_run_name
+            results_db = ResultsDB(args.results_db)
+            layout = counter.layout(args.run)
+            run_name = os.path.basename(os.path.realpath(args.run))
+            results_db.add_run( run_name, run_date = parse_run_name(layout.run_id or '')[0],
+                                instrument = layout.instrument, flowcell = layout.flowcell )
+
+        try:
+            lane_results = counter.iter_lanes( lanes = args.lane.split(',') if args.lane else None,
+                                               tiles = args.tile_id,
+                                               adaptive = args.adaptive,
+                                               tile_fraction = args.tile_fraction,
+                                               confidence = args.confidence,
+                                               min_tiles = args.min_tiles,
+                                               shard = parse_shard(args.shard) if args.shard else None,
+                                               checkpoint = args.checkpoint,
+                                               resume = args.resume,
+                                               partial = partial,
+                                               verbose = not args.summary_only,
+                                               fmt = args.format,
+                                               outputs = outputs,
+                                               keep_tiles = bool(results_db) )
+            for res in lane_results:
+                if results_db:
+                    for c, size, stats in zip(configs, counter.sample_sizes, res.stats):
+                        results_db.add_lane( run_name, res.lane, stats, size,
+                                             params = dict( edit_distance = c.edit_distance,
+                                                            hamming = c.hamming or args.exhaustive,
+                                                            cycles = format_cycles(cycles) ),
+                                             source = os.path.realpath(args.coord_file or args.slocs or args.run) )
+                if metrics:
+                    lane_metrics(metrics, run_name, res.lane, len(res.tiles), res.seconds, res.profile)
+                    metrics.write(args.metrics)
+        finally:
+            for out in outputs[1:]:
+                out.close()
+            if results_db:
+                results_db.close()
+
+    if partial:
+        partial.save(args.partial)
+
+    if profile_fh and profile_fh is not sys.stderr:
+        profile_fh.close()
+
+    if metrics:
+        metrics.set('welldup_run_success', 1, run=run_name)
+        metrics.set('welldup_run_end_timestamp_seconds', time.time(),
+                    "When the last count finished", run=run_name)
+        metrics.write(args.metrics)
+
+def merge_main():
+    """ The 'merge' subcommand, which puts together the --partial results from
+        several shards and prints the report a single job would have given.
+    """
+    args = parse_merge_args()
+    try:
+        merged = merge_partials([ PartialResult.load(f) for f in args.partials ])
+    except ValueError as e:
+        sys.exit("Cannot merge partial results: %s" % e)
+
+    write_partial_report(merged, verbose=not args.summary_only, fmt=args.format, compare_dir=args.compare_dir)
+
+def write_partial_report(partial, verbose=False, fmt='text', compare_dir='.'):
+    """ Prints the report for every lane in a PartialResult, in the same way
+        as main() does as it goes along.  The reports for any --compare
+        configurations are written to files in compare_dir.
+    """
+    configs = partial.configs
+    outputs = [ None ]
+    for c in configs[1:]:
+        ext = 'txt' if fmt == 'text' else fmt
+        outputs.append(open(os.path.join(compare_dir, c['name'] + '.' + ext), 'w'))
+
+    for n, pl in enumerate(partial.lanes):
+        for c, out, stats in zip(configs, outputs, pl['stats']):
+            agg = LaneAggregator( pl['lane'], c['sample_size'], c['key']['levels'],
+                                  verbose = verbose, fmt = fmt, header = (n == 0), out = out )
+            est = None
+            if partial.sampling:
+                est = RatioEstimate( total_tiles = len(pl['population']),
+                                     confidence = partial.sampling['confidence'],
+                                     strata = strata_sizes(pl['population']) )
+            for tile in pl['tiles']:
+                agg.add_tile_stats(tile, stats[tile])
+                if est:
+                    est.add(stats[tile]['acci'][0], stats[tile]['targets'], tile)
+            if est:
+                agg.sampling = est.as_dict()
+            agg.finish()
+
+    for out in outputs[1:]:
+        out.close()
+
+def lane_metrics(metrics, run_name, lane, tiles, seconds, lane_prof):
+    """ Adds the figures for one lane to metrics, for the Prometheus textfile collector.
+    """
+    seconds = seconds or 1e-9
+    labels = dict(run=run_name, lane=lane)
+    metrics.set('welldup_lane_seconds', seconds, "Wall time to count duplicates in a lane", **labels)
+    metrics.set('welldup_lane_tiles', tiles, "Tiles read in a lane", **labels)
+    metrics.set('welldup_tiles_per_second', tiles / seconds, "Tiles read per second", **labels)
+    metrics.set('welldup_read_megabytes_per_second', lane_prof.counters['bytes_read'] / 1e6 / seconds,
+                "Compressed data read from disk per second", **labels)
+    metrics.set('welldup_inflated_megabytes_per_second', lane_prof.counters['bytes_inflated'] / 1e6 / seconds,
+                "Data inflated per second", **labels)
+    metrics.set('welldup_read_seconds', lane_prof.wall['read'],
+                "Wall time spent reading BCL files in a lane", **labels)
+    metrics.set('welldup_wells_pruned', lane_prof.counters['wells_pruned'],
+                "Wells not read because the target centres failed the filter", **labels)
 
 
 def parse_args():
@@ -277,8 +1109,8 @@ def parse_args():
 
     parser = ArgumentParser(description=description, formatter_class=ArgumentDefaultsHelpFormatter)
 
-    parser.add_argument("-f", "--coord_file", dest="coord_file", required=True,
-                        help="The file containing the random sample per tile.")
+    parser.add_argument("-f", "--coord_file", dest="coord_file",
+                        help="The file containing the random sample per tile. Required unless --exhaustive.")
     parser.add_argument("-e", "--edit_distance", dest="edit_distance", type=int, default=2,
                         help="max edit distance between two reads to count as duplicate")
     parser.add_argument("-n", "--sample_size", dest="sample_size", type=int, default=2500,
@@ -286,9 +1118,10 @@ def parse_args():
                              " of prepared clusters is 10000 at the moment)")
     parser.add_argument("-l", "--level", dest="level", type=int, default=3,
                         help="levels around central spot to test, max = 5")
-    parser.add_argument("-s", "--stype", dest="stype", required=True,
+    parser.add_argument("-s", "--stype", dest="stype",
                         help=("Sequencer model. Can be {HISEQ_4000} or {HISEQ_X} or else the highest tile" +
-                              " number in which case the tile/swath configuration will be inferred.").format(**globals()))
+                              " number in which case the tile/swath configuration will be inferred. By" +
+                              " default the tiles are listed from RunInfo.xml.").format(**globals()))
     parser.add_argument("-r", "--run", dest="run", required=True,
                         help="path to base of run, i.e /ifs/seqdata/150715_K00169_0016_BH3FGFBBXX")
     parser.add_argument("-t", "--tile", dest="tile_id", type=str,
@@ -310,11 +1143,117 @@ def parse_args():
                         help="Compare sequences using the Hamming distance rather than the Levenshtein edit distance.")
     parser.add_argument("-S", "--summary-only", action="store_true",
                         help="Only print the summary per lane, not for every tile")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default="text",
+                        help="Output format. 'json' gives one line per lane and 'tsv' one row per tile" +
+                             " and level, both with the same figures as the text report.")
     parser.add_argument("-q", "--quiet", action="store_true",
                         help="No log output")
+    parser.add_argument("--adaptive", type=float, metavar="PRECISION",
+                        help="Stop reading tiles once the lane duplication rate is known to within" +
+                             " +/- PRECISION, eg. 0.001 for +/-0.1%%. Tiles are visited in a random order" +
+                             " spread over the surfaces and swaths.")
+    parser.add_argument("--tile-fraction", type=float, metavar="FRACTION",
+                        help="Only read this fraction of the tiles, spread over the surfaces and swaths," +
+                             " and estimate the lane duplication rate with a confidence interval.")
+    parser.add_argument("--confidence", type=float, default=0.95,
+                        help="Confidence level for --adaptive and --tile-fraction.")
+    parser.add_argument("--min-tiles", type=int, default=8,
+                        help="Always read at least this many tiles per lane in --adaptive mode.")
+    parser.add_argument("--exhaustive", action="store_true",
+                        help="Rather than a sample of targets, compare every passing well in each tile with" +
+                             " all its neighbours, found from the s.locs file. This needs numpy, always uses" +
+                             " the Hamming distance, and takes some seconds per tile, so you may want -t too.")
+    parser.add_argument("--slocs",
+                        help="The s.locs file for --exhaustive, if not the one in the run.")
+    parser.add_argument("--compare", action="append", metavar="NAME:SETTINGS",
+                        help="Also count with different settings, in the same pass over the data, and" +
+                             " write the report to NAME.txt (or .json/.tsv). SETTINGS is a comma-separated" +
+                             " list of e=EDIT_DISTANCE, l=LEVEL, n=SAMPLE_SIZE, hamming or levenshtein," +
+                             " eg. e1ham:e=1,hamming. May be given several times.")
+    parser.add_argument("--compare-dir", default=".",
+                        help="Where to write the --compare reports.")
+    parser.add_argument("--checkpoint",
+                        help="Save the results for each tile in this directory as it is done.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Use results saved by --checkpoint rather than re-reading tiles. The results" +
+                             " are only used if the targets and settings are the same.")
+    parser.add_argument("--metrics",
+                        help="Write timings and throughput to this file in Prometheus textfile format.")
+    parser.add_argument("--inflate", choices=['auto'] + list(inflate.BACKENDS),
+                        help="Which gunzip code to use. By default this is taken from $%s," % inflate.BACKEND_ENV +
+                             " or failing that the fastest one installed.")
+    parser.add_argument("--prefetch", type=int, default=8, metavar="DEPTH",
+                        help="Read up to DEPTH cycle files ahead in the background, including those for the" +
+                             " next tile while the current one is compared. 0 to turn this off.")
+    parser.add_argument("--processes", type=int, default=1, metavar="N",
+                        help="Read and count N tiles at once in separate processes. The targets are" +
+                             " put in shared memory so each process does not end up with its own copy.")
+    parser.add_argument("--stage-dir",
+                        help="Keep copies of the data read in this directory, ideally on a local disk, and" +
+                             " read from there next time if the run files are unchanged.")
+    parser.add_argument("--stage-size", default="50G",
+                        help="Size limit for --stage-dir. The least recently used data is removed to keep" +
+                             " within this.")
+    parser.add_argument("--shard", metavar="i/N",
+                        help="Only do the ith of N shares of the tiles in each lane, eg. 3/8. Use with" +
+                             " --partial and then 'count_well_duplicates.py merge' to get the full report.")
+    parser.add_argument("--partial", metavar="FILE",
+                        help="Save the totals for each tile to FILE, to be put together with those from" +
+                             " other shards by 'count_well_duplicates.py merge'.")
+    parser.add_argument("--results-db", metavar="FILE",
+                        help="Also add the results for each lane, and each tile, to this SQLite database." +
+                             " See results_db.py for how to look at trends across runs.")
+    parser.add_argument("--profile", nargs="?", const="-",
+                        help="Report timings and byte counts for each phase of the work, per tile and per lane," +
+                             " as lines of JSON. Give a filename to save them, otherwise they go to STDERR.")
     parser.add_argument("--version", action="version", version=str(__VERSION__))
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if not (args.coord_file or args.exhaustive):
+        parser.error("a targets file must be given with -f, unless using --exhaustive")
+    if args.exhaustive:
+        if not NeighbourScan:
+            parser.error("--exhaustive needs numpy")
+        if args.compare or args.processes > 1:
+            parser.error("--exhaustive cannot be used with --compare or --processes")
+    if args.resume and not args.checkpoint:
+        parser.error("--resume needs a --checkpoint directory")
+    if args.adaptive and args.tile_fraction:
+        parser.error("--adaptive and --tile-fraction cannot be used together")
+    if args.adaptive and (args.shard or args.partial):
+        parser.error("--adaptive needs the whole lane, so cannot be used with --shard or --partial")
+    if args.results_db and args.shard:
+        parser.error("--results-db needs the whole lane, so add the merged report with 'results_db.py import'")
+    if args.shard:
+        try:
+            parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+    try:
+        parse_size(args.stage_size)
+    except ValueError as e:
+        parser.error(str(e))
+
+    return args
+
+def parse_merge_args():
+    description = """Puts together the --partial results from several shards of a run and prints
+    the same report as if the run had been done in one go.
+    """
+
+    parser = ArgumentParser( prog = "count_well_duplicates.py merge", description = description,
+                             formatter_class = ArgumentDefaultsHelpFormatter )
+
+    parser.add_argument("partials", nargs="+", metavar="PARTIAL",
+                        help="Files saved by --partial. All the shards of a lane must be given.")
+    parser.add_argument("-S", "--summary-only", action="store_true",
+                        help="Only print the summary per lane, not for every tile")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default="text",
+                        help="Output format, as for the main command.")
+    parser.add_argument("--compare-dir", default=".",
+                        help="Where to write the reports for any --compare settings.")
+
+    return parser.parse_args(sys.argv[2:])
 
 if __name__ == "__main__":
     main()
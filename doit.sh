@@ -81,23 +81,70 @@ fi
 SNAKEFILE="$(dirname $(readlink -f $0))"/Snakefile.count_and_push
 export CLUSTER_QUEUE=casava
 
+# If METRICS_DIR is set (normally to the node-exporter textfile collector directory),
+# write metrics there so that the cron job can be monitored.
+METRICS_DIR="${METRICS_DIR:-}"
+METRICS_PY="$(dirname $(readlink -f $0))"/metrics.py
+runs_pending=0 ; runs_done=0 ; runs_failed=0
+cron_start=`date +%s`
+
+write_cron_metrics(){
+    [ -n "$METRICS_DIR" ] || return 0
+    cat > "$METRICS_DIR/welldup_cron.prom.$$.tmp" <<END
+# HELP welldup_cron_runs_pending Runs with no results at the start of the last cron job
+# TYPE welldup_cron_runs_pending gauge
+welldup_cron_runs_pending $runs_pending
+# HELP welldup_cron_runs_processed Runs successfully processed by the last cron job
+# TYPE welldup_cron_runs_processed gauge
+welldup_cron_runs_processed $runs_done
+# HELP welldup_cron_runs_failed Runs that failed in the last cron job
+# TYPE welldup_cron_runs_failed gauge
+welldup_cron_runs_failed $runs_failed
+# HELP welldup_cron_seconds Wall time of the last cron job
+# TYPE welldup_cron_seconds gauge
+welldup_cron_seconds $(( `date +%s` - $cron_start ))
+# HELP welldup_cron_last_timestamp_seconds When the last cron job finished
+# TYPE welldup_cron_last_timestamp_seconds gauge
+welldup_cron_last_timestamp_seconds `date +%s`
+END
+    mv "$METRICS_DIR/welldup_cron.prom.$$.tmp" "$METRICS_DIR/welldup_cron.prom"
+}
+
 echo "=== Running at `date`. PID=$$, SNAKEFILE=$SNAKEFILE, CLUSTER_QUEUE=$CLUSTER_QUEUE ==="
 
+# The queue depth is the number of runs not yet given a workdir
+for f in "$SEQDATA"/??????_[AKE]00* ; do
+    [ -e "$WORKDIR_ROOT/`basename $f`" ] || runs_pending=$(( $runs_pending + 1 ))
+done
+
 for f in "$SEQDATA"/??????_[AKE]00* ; do
     echo "Trying to process $f"
     export WORKDIR="$WORKDIR_ROOT/`basename $f`"
+    was_pending=0 ; [ -e "$WORKDIR" ] || was_pending=1
 
     #If processing the run fails we do want to continue.
     #This makes it annoying if you want to cancel the whole thing but is important
     #to ensure one problem run doesn't gum up the whole pipeline.
+    #Runs that are not ready or were already done also "fail", so only count
+    #the ones that were pending.
     if ( cd "$f" && "$SNAKEFILE" 2>&1 ) ; then
+        if [ "$was_pending" = 1 ] ; then
+            runs_done=$(( $runs_done + 1 ))
+            if [ -n "$METRICS_DIR" ] ; then
+                "$METRICS_PY" merge "$METRICS_DIR/welldup_last_run.prom" "$WORKDIR"/*targets_lane*.prom || true
+            fi
+        fi
         if [ "${DO_JUST_ONE:-0}" != 0 ] ; then
             echo "Exiting as DO_JUST_ONE was set."
+            write_cron_metrics
             exit 0
         fi
+    elif [ "$was_pending" = 1 ] && [ -e "$WORKDIR" ] ; then
+        runs_failed=$(( $runs_failed + 1 ))
     fi
 
 done
+write_cron_metrics
 
 # Copying to web1 has been removed. See GIT on 21/2/17 for the old version.
 
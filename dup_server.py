@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+A long-running service for interactive questions like "what's the dup rate
+on tile 2223 at 5 levels with edit distance 1?"  Running
+count_well_duplicates.py for each one means loading the targets, listing the
+run and reading and inflating the BCL files every time.  The service keeps all
+of these in memory between queries:
+
+  * the targets, for each targets file (all levels and all targets, so any
+    sample size and number of levels can be answered from them)
+  * the BCLReader and RunLayout for each run
+  * the sequences read for each tile, lane, range of cycles and targets file
+
+so once a tile has been read, asking about it again with other settings only
+costs the comparisons, which takes well under a second.  Each cache drops the
+least recently used entries when it is full.  The sequences take the most
+memory (around 100MB per tile with 10000 targets at 5 levels) so see
+--cache-tiles.
+
+Queries are HTTP GET requests, on localhost or on a Unix socket, and the
+answers are JSON:
+
+  /count?run=RUN&targets=FILE&lane=1&tile=2223&l=5&e=1&n=2500&cycles=50-100&hamming=1
+
+    run and targets are required.  lane (comma-separated) defaults to every
+    lane and tile to every tile, using the same patterns as -t.  The others
+    default as for count_well_duplicates.py, and add tiles=1 to get the
+    figures for each tile too.  The result has the same figures as
+    count_well_duplicates.py --format json for each lane.
+
+  /status
+
+    What is in the caches, and how often they were used.
+
+  /clear
+
+    Empties the caches.
+
+Only one query is run at a time.  Nothing stops other users on the machine
+from querying a localhost port, so use --socket to control access with file
+permissions.
+
+Synopsis:
+
+   dup_server.py --port 8642 &
+   curl 'http://localhost:8642/count?run=/path/to/run&targets=targets.list&tile=2223&l=5'
+
+   dup_server.py --socket /tmp/welldup.sock &
+   curl --unix-socket /tmp/welldup.sock 'http://localhost/status'
+"""
+__AUTHORS__ = ['Tim Booth']
+__VERSION__ = 0.1
+
+import os, sys
+import json
+import time
+import socket
+import socketserver
+from collections import OrderedDict
+from urllib.parse import urlsplit, parse_qs
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+import bcl_direct_reader
+import count_well_duplicates
+import inflate
+from run_layout import RunLayout
+from target import load_targets
+from count_well_duplicates import ( CountConfig, LaneAggregator, compare_tile, filter_tiles, parse_cycles,
+                                    passing_target_wells )
+
+DEFAULT_PORT = 8642
+
+def log(msg):
+    print(str(msg), file=sys.stderr)
+
+class LRUCache:
+    """ A dict of at most maxsize items, dropping the least recently used.
+        Counts hits and misses for the status report.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, make):
+        """ Returns the item for key, calling make() to create it if need be.
+        """
+        if key in self.items:
+            self.hits += 1
+            self.items.move_to_end(key)
+            return self.items[key]
+
+        self.misses += 1
+        value = make()
+        self.items[key] = value
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+        return value
+
+    def clear(self):
+        self.items.clear()
+
+    def status(self):
+        return dict(size=len(self.items), maxsize=self.maxsize, hits=self.hits, misses=self.misses)
+
+class DupService:
+    """ Answers the queries, keeping everything it can for next time.  The
+        HTTP side is in DupRequestHandler.
+    """
+    def __init__(self, cache_tiles=64, cache_runs=8, cache_targets=4, inflate_backend=None):
+        self.inflate_backend = inflate_backend
+        self.start_time = time.time()
+        self.queries = 0
+        self.caches = OrderedDict([ ('targets', LRUCache(cache_targets)),
+                                    ('runs', LRUCache(cache_runs)),
+                                    ('seqs', LRUCache(cache_tiles)) ])
+
+    def get_targets(self, filename):
+        """ Returns (key, targets).  A changed file is loaded again.
+        """
+        filename = os.path.realpath(filename)
+        key = (filename, os.stat(filename).st_mtime_ns)
+        return key, self.caches['targets'].get(key, lambda: load_targets(filename))
+
+    def get_reader(self, run):
+        run = os.path.realpath(run)
+        return self.caches['runs'].get( run, lambda: bcl_direct_reader.BCLReader(
+                                                            run, inflate_backend = self.inflate_backend,
+                                                            layout = RunLayout(run) ) )
+
+    def get_seqs(self, reader, lane, tile, targets_key, targets, cycles):
+        """ The sequences of all the targets in one tile whose centre passed
+            the filter, as a list of results from Tile.get_seqs(), one per
+            range of cycles.  The tile is opened, and the filter read, at most
+            once for all the ranges not already cached.
+        """
+        opened = []
+        def read(start, end):
+            if not opened:
+                log("Reading tile %s in lane %s" % (tile, lane))
+                opened.append(reader.get_tile(lane, tile))
+                opened.append(passing_target_wells(opened[0], targets))
+            tile_bcl, wells = opened
+            return tile_bcl.get_seqs(wells, start, end) if wells else dict()
+
+        try:
+            return [ self.caches['seqs'].get( (reader.location, str(lane), tile, targets_key, start, end),
+                                              lambda: read(start, end) )
+                     for start, end in cycles ]
+        finally:
+            if opened:
+                opened[0].close()
+
+    def count(self, run, targets, lane=None, tile=None, l=3, e=2, n=2500, hamming=False,
+              cycles='50-100', tiles=False):
+        """ Runs a query.  The arguments are as for the /count query, and all
+            may be strings.  Raises ValueError if any is no good.
+        """
+        self.queries += 1
+        start_time = time.time()
+
+        config = CountConfig(None, int(e), bool(int(hamming)), int(l), int(n))
+        cycles = parse_cycles(cycles)
+        targets_key, all_targets = self.get_targets(targets)
+        if not 0 < config.level < all_targets.levels:
+            raise ValueError("The targets file only has %i levels" % (all_targets.levels - 1))
+
+        reader = self.get_reader(run)
+        layout = reader.layout
+        lanes = lane.split(',') if lane else layout.lanes
+
+        res = []
+        for lane in lanes:
+            lane_tiles = layout.tiles(lane)
+            if tile:
+                lane_tiles = filter_tiles(lane_tiles, tile)
+
+            agg = LaneAggregator( lane, min(len(all_targets), config.sample_size), config.level,
+                                  verbose = bool(int(tiles)), fmt = None )
+            for t in lane_tiles:
+                seq_objs = self.get_seqs(reader, lane, t, targets_key, all_targets, cycles)
+                agg.add_tile_stats(t, compare_tile(all_targets, seq_objs, [config])[0])
+
+            stats = agg.stats()
+            if not int(tiles):
+                del stats['tiles']
+            res.append(dict(lane=lane, sample_size=agg.sample_size, **stats))
+
+        return dict(lanes=res, seconds=time.time() - start_time)
+
+    def status(self):
+        return dict( uptime = time.time() - self.start_time,
+                     queries = self.queries,
+                     caches = { k: c.status() for k, c in self.caches.items() } )
+
+    def clear(self):
+        for c in self.caches.values():
+            c.clear()
+        return self.status()
+
+class DupRequestHandler(BaseHTTPRequestHandler):
+    """ Turns GET requests into calls on server.service.  Bad queries get a
+        400 response, and anything else that goes wrong a 500, both with the
+        error message as JSON.
+    """
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = { k: v[-1] for k, v in parse_qs(url.query).items() }
+        service = self.server.service
+        try:
+            if url.path == '/count':
+                self.send_json(200, service.count(**params))
+            elif url.path == '/status':
+                self.send_json(200, service.status())
+            elif url.path == '/clear':
+                self.send_json(200, service.clear())
+            else:
+                self.send_json(404, dict(error="No such query %s" % url.path))
+        except (TypeError, ValueError, KeyError, IndexError, AssertionError, OSError) as e:
+            self.send_json(400, dict(error=str(e)))
+        except Exception as e:
+            self.send_json(500, dict(error=repr(e)))
+
+    def send_json(self, code, res):
+        body = json.dumps(res, sort_keys=True).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'local'
+
+    def log_message(self, format, *args):
+        log("%s - %s" % (self.address_string(), format % args))
+
+class UnixHTTPServer(HTTPServer):
+    """ HTTPServer listening on a Unix socket rather than a port.
+    """
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        # HTTPServer.server_bind() wants a host and port
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+def make_server(service, port=DEFAULT_PORT, socket_path=None):
+    """ Returns the HTTPServer, with the service attached.  Call
+        serve_forever() on it.  With port=0 any free port is used, and you
+        can see which in server.server_port.
+    """
+    if socket_path:
+        server = UnixHTTPServer(socket_path, DupRequestHandler)
+    else:
+        server = HTTPServer(('localhost', port), DupRequestHandler)
+    server.service = service
+    return server
+
+def main():
+    args = parse_args()
+
+    if args.quiet:
+        global log
+        log = lambda *args: None
+
+    # Logging every duplicate found is no use here
+    count_well_duplicates.log = lambda *args: None
+
+    service = DupService( cache_tiles = args.cache_tiles, cache_runs = args.cache_runs,
+                          cache_targets = args.cache_targets, inflate_backend = args.inflate )
+    server = make_server(service, args.port, args.socket)
+    log("Listening on %s" % (args.socket or "localhost:%i" % server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def parse_args():
+    description = """Runs a local service that answers queries about well duplicates in any run,
+    keeping the targets, run layouts and tile sequences in memory so that repeat queries are quick.
+    """
+    parser = ArgumentParser(description=description, formatter_class=ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                        help="Port to listen on, on localhost only.")
+    parser.add_argument("--socket",
+                        help="Listen on this Unix socket instead of a port.")
+    parser.add_argument("--cache-tiles", type=int, default=64,
+                        help="How many sets of tile sequences (per tile and range of cycles) to keep.")
+    parser.add_argument("--cache-runs", type=int, default=8,
+                        help="How many run layouts and readers to keep.")
+    parser.add_argument("--cache-targets", type=int, default=4,
+                        help="How many targets files to keep.")
+    parser.add_argument("--inflate", choices=['auto'] + list(inflate.BACKENDS),
+                        help="Which library to use for gunzipping.")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="Do not log the queries to STDERR.")
+    parser.add_argument("--version", action="version", version=str(__VERSION__))
+
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    main()
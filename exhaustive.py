@@ -0,0 +1,240 @@
+#!python3
+"""
+Exhaustive duplicate counting, where every passing well in the tile is a
+target, rather than a sample of a few thousand.  On a lane with very little
+duplication the sampled figures are mostly noise, and this gives the exact
+numbers for the tile instead.  It needs numpy.
+
+The neighbours of each well are worked out from the s.locs file in the same
+way as prepare_cluster_indexes.py does it, by the distance between the wells.
+But rather than searching around every well, we note that on a patterned
+flowcell the wells are numbered along the rows of a regular lattice, so the
+neighbours of a well are found at the same few offsets in the numbering (well
+n+1, n+3200, n+3201...).  These offsets are found by searching around a sample
+of the wells, and then for each offset d the distance from every well n to
+well n+d is checked at once.  Pairs that wrap around the end of a row, or fall
+off the edge of the tile, are just too far apart, so the edges take care of
+themselves and wells there simply have fewer neighbours.
+
+The bases for the chosen cycles are packed 21 to a 64-bit word, at 3 bits each
+so that N differs from all four bases, giving a (words x wells) array for the
+tile.  Then for each offset the number of mismatching bases between every pair
+of wells is found with XOR and a population count, which is the Hamming
+distance.  Comparing millions of sequences by the Levenshtein distance is not
+practical, so unlike the sampled counting this always uses the Hamming
+distance.
+
+Each pair of neighbours counts for both wells, so only positive offsets are
+needed.  The result is a (TALLY, LENGTH) per well and level just as for the
+sampled targets, which goes through the same sums (see stats_engine.py) to
+give the usual report.
+
+Synopsis:
+
+   scan = NeighbourScan('run/Data/Intensities/s.locs', levels=3, edit_distance=2)
+   ts = scan.tile_stats(BCLReader('run').get_tile(1, 1101), [(20, 70)])
+"""
+
+from hashlib import sha1
+
+import numpy as np
+
+from profiling import NO_PROFILE
+from stats_engine import reduce_counts, STAT_KEYS
+from prepare_cluster_indexes import MAX_DISTS
+
+# Packing of the bases. The codes are 0 for N and 1-4 for A, C, G, T.
+BASE_BITS = 3
+BASES_PER_WORD = 64 // BASE_BITS
+LOW_BITS = np.uint64(sum(1 << (BASE_BITS * k) for k in range(BASES_PER_WORD)))
+
+# As in prepare_cluster_indexes.get_indexes, neighbours are never looked for
+# further away than this in the well numbering.
+MAX_SEARCH_AREA = 20000
+
+# How many wells to search around to find the neighbour offsets.
+OFFSET_SAMPLES = 1000
+
+def load_slocs(filename):
+    """ Reads all the well positions from an s.locs file, as (x, y) integer
+        arrays, converted in the same way as prepare_cluster_indexes.py does.
+    """
+    with open(filename, 'rb') as fh:
+        header = np.frombuffer(fh.read(12), dtype='<u4')
+        locs = np.frombuffer(fh.read(), dtype='<f4', count=int(header[2]) * 2).reshape(-1, 2)
+
+    # int() in Python rounds towards zero, as does astype()
+    coords = (locs.astype(np.float64) * 10.0 + 1000.5).astype(np.int64)
+    return coords[:, 0].copy(), coords[:, 1].copy()
+
+def popcount(a):
+    """ Number of bits set in each element of a uint64 array.
+    """
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(a)
+    # Older numpy. Count the bits in each byte with a lookup table.
+    table = np.array([ bin(n).count('1') for n in range(256) ], dtype=np.uint8)
+    return table[a.view(np.uint8)].reshape(a.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+def mismatches(x):
+    """ Given the XOR of two packed words, the number of bases that differ.
+    """
+    return popcount((x | (x >> np.uint64(1)) | (x >> np.uint64(2))) & LOW_BITS).astype(np.uint8)
+
+def hamming(words, a, b):
+    """ The number of bases that differ between wells a and b, for the packed
+        (words x wells) array.  a and b may be arrays of wells or slices.  The
+        sum is kept as int32, since reads of 256 bases or more would overflow
+        the uint8 counts for each word.
+    """
+    res = None
+    for w in words:
+        m = mismatches(w[a] ^ w[b])
+        res = m.astype(np.int32) if res is None else res + m
+    return res
+
+def read_tile_words(tile, cycles, num_wells, profile=NO_PROFILE):
+    """ Reads the given ranges of cycles for every well in the tile.
+        Returns the packed (words x wells) array of bases and a bool array
+        saying which wells passed the filter.
+    """
+    if tile.num_clusters != num_wells:
+        raise ValueError( "Tile %s has %i wells but the s.locs file has %i" %
+                          (tile.tile, tile.num_clusters, num_wells) )
+
+    passing = (np.frombuffer(tile.get_filter_flags(), dtype=np.uint8) & 1).astype(bool)
+    n_passing = int(passing.sum())
+
+    all_cycles = sum(e - s for s, e in cycles)
+    words = np.zeros(((all_cycles - 1) // BASES_PER_WORD + 1, num_wells), dtype=np.uint64)
+
+    k = 0
+    for start, end in cycles:
+        for cycle_fmt, data, excluded_flag in tile.get_cycle_data(start, end):
+            with profile.phase('decode'):
+                codes = _decode(cycle_fmt, data, excluded_flag, passing, n_passing)
+                shift = np.uint64(BASE_BITS * (k % BASES_PER_WORD))
+                words[k // BASES_PER_WORD] |= codes.astype(np.uint64) << shift
+            k += 1
+
+    return words, passing
+
+def _decode(cycle_fmt, data, excluded_flag, passing, n_passing):
+    """ Turns the data for one cycle into an array of base codes.
+    """
+    n = len(passing)
+    if cycle_fmt == 'cbcl':
+        # Two wells per byte, low bits first, and if excluded_flag is set only
+        # the passing wells are there.
+        wanted = n_passing if excluded_flag else n
+        packed = np.frombuffer(data, dtype=np.uint8, count=(wanted + 1) // 2)
+        base_bytes = np.empty(len(packed) * 2, dtype=np.uint8)
+        base_bytes[0::2] = packed & 0b00001111
+        base_bytes[1::2] = packed >> 4
+        base_bytes = base_bytes[:wanted]
+    else:
+        base_bytes = np.frombuffer(data, dtype=np.uint8, count=n, offset=4)
+
+    codes = np.where(base_bytes == 0, 0, (base_bytes & 0b00000011) + 1).astype(np.uint8)
+    if cycle_fmt == 'cbcl' and excluded_flag:
+        # Wells that failed the filter are N
+        all_codes = np.zeros(n, dtype=np.uint8)
+        all_codes[passing] = codes
+        codes = all_codes
+    return codes
+
+class NeighbourScan:
+
+    def __init__(self, slocs, levels, edit_distance, samples=OFFSET_SAMPLES):
+        """ slocs is the s.locs filename, which is read just once.  Neighbours are
+            found out to the given number of levels.
+        """
+        self.levels = levels
+        self.edit_distance = edit_distance
+        self.x, self.y = load_slocs(slocs)
+        self.num_wells = len(self.x)
+
+        # Squared distances bounding each level, so level l is the wells with
+        # sq_dists[l-1] < d^2 <= sq_dists[l]
+        self.sq_dists = np.array(MAX_DISTS[:levels+1], dtype=np.int64) ** 2
+        self.offsets = self._find_offsets(samples)
+
+    def fingerprint(self):
+        """ A hex digest identifying the well positions and levels, in place of
+            the targets fingerprint.
+        """
+        h = sha1(b'exhaustive:%i:' % self.levels)
+        h.update(self.x.tobytes())
+        h.update(self.y.tobytes())
+        return h.hexdigest()
+
+    def _find_offsets(self, samples):
+        """ Finds all the positive offsets in the well numbering at which a
+            neighbour turned up for any of a sample of wells.
+        """
+        offsets = set()
+        n = self.num_wells
+        for well in np.linspace(0, n - 1, min(samples, n)).astype(np.int64):
+            lo, hi = max(0, well - MAX_SEARCH_AREA), min(n, well + MAX_SEARCH_AREA + 1)
+            d2 = (self.x[lo:hi] - self.x[well]) ** 2 + (self.y[lo:hi] - self.y[well]) ** 2
+            near = np.nonzero((d2 > self.sq_dists[0]) & (d2 <= self.sq_dists[-1]))[0] + lo - well
+            offsets.update(abs(int(d)) for d in near)
+        return sorted(offsets)
+
+    def read_tile(self, tile, cycles, profile=NO_PROFILE):
+        """ See read_tile_words().
+        """
+        return read_tile_words(tile, cycles, self.num_wells, profile)
+
+    def count(self, words, profile=NO_PROFILE):
+        """ Compares every well with its neighbours.  Returns (tally, length)
+            arrays of shape (wells x levels).
+        """
+        n = self.num_wells
+        tally = np.zeros((self.levels, n), dtype=np.uint8)
+        length = np.zeros((self.levels, n), dtype=np.uint8)
+
+        comparisons = 0
+        for d in self.offsets:
+            if d >= n:
+                break
+            d2 = (self.x[d:] - self.x[:-d]) ** 2 + (self.y[d:] - self.y[:-d]) ** 2
+            level = np.searchsorted(self.sq_dists, d2)
+            in_range = (level > 0) & (level <= self.levels)
+            if not in_range.any():
+                continue
+
+            is_dup = hamming(words, slice(None, -d), slice(d, None)) <= self.edit_distance
+
+            for lev in range(self.levels):
+                at_level = level == lev + 1
+                dup_at_level = at_level & is_dup
+                length[lev, :-d] += at_level
+                length[lev, d:] += at_level
+                tally[lev, :-d] += dup_at_level
+                tally[lev, d:] += dup_at_level
+            comparisons += int(in_range.sum())
+
+        profile.count('comparisons', comparisons)
+        return tally.T, length.T
+
+    def tile_stats(self, tile, cycles, profile=NO_PROFILE):
+        """ Does the whole tile.  Returns the totals in the same form as
+            count_well_duplicates.tile_stats(), with every passing well as a target.
+        """
+        words, passing = self.read_tile(tile, cycles, profile)
+        return self.stats(words, passing, profile)
+
+    def stats(self, words, passing, profile=NO_PROFILE):
+        """ The second half of tile_stats(), if you already did read_tile().
+        """
+        with profile.phase('compare'):
+            tally, length = self.count(words, profile)
+        profile.count('targets_valid', int(passing.sum()))
+
+        with profile.phase('report'):
+            sums = reduce_counts(tally[passing], length[passing])
+            res = dict(targets = int(passing.sum()))
+            for k in STAT_KEYS:
+                res[k] = sums[k].tolist()
+        return res
@@ -0,0 +1,168 @@
+#!python3
+"""
+Gunzipping into a buffer that is kept from one cycle to the next.
+
+gzip.decompress() hands back a new bytes object for every file it inflates,
+which for a HiSeq 4000 tile is 4MB per cycle and for a NovaSeq CBCL block
+rather more.  Reading a lane means thousands of these, and with several tiles
+on the go at once the allocator never gets to settle down.  An Inflater
+instead inflates a chunk at a time with zlib.decompressobj and copies each
+chunk into a bytearray that it keeps, only ever growing it when a bigger file
+comes along.  Python's zlib can't inflate into a buffer it is given, so that
+one copy of each chunk remains.  The bases are then picked straight out of that buffer.
+
+An Inflater is not thread safe, and the view it returns is only good until
+the next call to inflate(), so each thread (or each BCLReader) needs its own.
+
+The actual inflating can be done by the standard zlib module or by one of the
+faster drop-in replacements, ISA-L (pip install isal) or zlib-ng (pip install
+zlib-ng), which give exactly the same output.  By default the fastest one
+installed is used, or set $WELLDUP_INFLATE to one of the names in BACKENDS.
+
+Synopsis:
+
+   inf = Inflater()
+   for zdata in cycles:
+       data = inf.inflate(zdata)
+       base_byte = data[idx + 4]
+"""
+
+import os
+import zlib
+import struct
+import importlib
+from collections import OrderedDict
+
+# How much to inflate in one go.  Small enough to be recycled by the
+# allocator, big enough that the Python overhead per chunk doesn't matter.
+CHUNK_SIZE = 256 * 1024
+
+# Tell zlib to expect a gzip header and trailer.
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# The size in the gzip trailer is only believed up to this compression ratio.
+# A truncated file has junk in place of the trailer, and we don't want to
+# allocate gigabytes only to find that out.  Data that really does compress
+# better than this just makes the buffer grow as it goes.
+MAX_HINT_RATIO = 64
+
+# Modules with the same decompressobj() interface as zlib, fastest first.
+BACKENDS = OrderedDict([ ('isal',    'isal.isal_zlib'),
+                         ('zlib-ng', 'zlib_ng.zlib_ng'),
+                         ('zlib',    'zlib') ])
+
+BACKEND_ENV = 'WELLDUP_INFLATE'
+
+def available_backends():
+    """ Names of the backends that can be imported here, fastest first.
+    """
+    res = []
+    for name, module in BACKENDS.items():
+        try:
+            importlib.import_module(module)
+            res.append(name)
+        except ImportError:
+            pass
+    return res
+
+def get_backend(name=None):
+    """ Returns (name, module) for the named backend, or for the one named in
+        $WELLDUP_INFLATE if name is None, or the fastest available if that is
+        not set either or is set to 'auto'.
+    """
+    if name is None:
+        name = os.environ.get(BACKEND_ENV) or 'auto'
+    if name == 'auto':
+        name = available_backends()[0]
+    if name not in BACKENDS:
+        raise ValueError("Unknown inflate backend %r. Choose from: auto, %s" % (name, ', '.join(BACKENDS)))
+
+    # If the module is missing let the ImportError through, as the user
+    # asked for it specifically.
+    return name, importlib.import_module(BACKENDS[name])
+
+class Inflater:
+
+    def __init__(self, chunk_size=CHUNK_SIZE, backend=None):
+        """ backend is a name as for get_backend()
+        """
+        self.chunk_size = chunk_size
+        self.backend, self._zlib = get_backend(backend)
+        self.buffer = bytearray()
+        self._view = memoryview(self.buffer)
+        self.reallocations = 0
+
+    def _reserve(self, size):
+        """ Makes sure the buffer holds at least size bytes.  This is done
+            before inflating anything, so what is in the buffer now is not kept.
+        """
+        if len(self.buffer) >= size:
+            return
+
+        # A new bytearray is allocated zeroed in one go, whereas growing the
+        # old one would need a bytes of padding made and copied in.  If the
+        # caller is still holding an old view, that keeps the old buffer alive.
+        self._view.release()
+        self.buffer = bytearray(max(size, len(self.buffer) * 2))
+        self._view = memoryview(self.buffer)
+        self.reallocations += 1
+
+    def _append(self, pos, chunk):
+        """ Puts chunk at pos when it would run off the end of the buffer.
+            Assigning to the slice grows the buffer with the chunk itself, so
+            nothing is written twice.
+        """
+        # A bytearray can't be resized while there is a view on it.  If the
+        # caller is still holding an old view, copy to a new buffer.
+        self._view.release()
+        try:
+            self.buffer[pos:] = chunk
+        except BufferError:
+            self.buffer = self.buffer[:pos]
+            self.buffer += chunk
+        self._view = memoryview(self.buffer)
+        self.reallocations += 1
+
+    def inflate(self, zipdata, size_hint=None, limit=None):
+        """ Inflates gzipped data, which may have several members as
+            gzip.decompress() allows.  Returns a memoryview on the internal
+            buffer, which is overwritten on the next call.
+            size_hint is the expected inflated size.  If not given, the size
+            in the gzip trailer is used, if it looks plausible.
+            If limit is given, inflating stops as soon as at least that many
+            bytes are done, so you may get a little more than you asked for but
+            never less, unless the data is shorter.
+        """
+        if size_hint is None and len(zipdata) >= 4:
+            size_hint, = struct.unpack('<I', zipdata[-4:])
+            if size_hint > len(zipdata) * MAX_HINT_RATIO:
+                size_hint = None
+        if limit is not None and size_hint:
+            size_hint = min(size_hint, limit + self.chunk_size)
+        self._reserve(size_hint or 0)
+
+        pos = 0
+        data = zipdata
+        dobj = self._zlib.decompressobj(GZIP_WBITS)
+        while True:
+            chunk = dobj.decompress(data, self.chunk_size)
+            if chunk:
+                if pos + len(chunk) > len(self.buffer):
+                    self._append(pos, chunk)
+                else:
+                    self._view[pos:pos + len(chunk)] = chunk
+                pos += len(chunk)
+                if limit is not None and pos >= limit:
+                    break
+            data = dobj.unconsumed_tail
+
+            if dobj.eof:
+                # Allow for more gzip members after this one.
+                data = dobj.unused_data
+                if not data:
+                    break
+                dobj = self._zlib.decompressobj(GZIP_WBITS)
+            elif not (data or chunk):
+                raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+
+        return self._view[:pos]
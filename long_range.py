@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""
+Finds duplicates anywhere on a tile, not just among the neighbours of each
+well, and reports how the duplicate rate depends on the distance between the
+two wells.  Library duplicates can turn up anywhere on the flowcell, while pad
+hopping only gives copies a few wells away, so this is how the two are told
+apart.  It needs numpy.
+
+Comparing every passing well with every other is far too slow (10^13 pairs
+on a NovaSeq tile), so the sequences are hashed instead.  The bases for the
+chosen cycles are read for every well as in exhaustive.py, then split into
+some number of parts, more than edit_distance.  Two reads within the Hamming
+distance must be identical in all but edit_distance of the parts, so a key is
+made for each combination of that many parts, and sorting the wells by each
+key in turn brings every candidate pair together.  The candidates are then
+checked against the whole read.  This is close to linear in the number of
+wells.  For long reads edit_distance + 1 parts is enough, but if the keys
+would be too short to tell millions of wells apart, more parts are used (see
+choose_parts()).
+
+Only wells that passed the filter are compared, at both ends of the pair,
+whereas count_well_duplicates.py also looks at neighbours that failed.
+
+Very large buckets of identical keys (eg. poly-G or no-call reads) would
+give millions of pairs, so any bucket bigger than max_bucket is skipped and
+its wells are reported as crowded.  Pairs involving these wells may be missed.
+
+The distance between each pair of duplicates comes from the s.locs file, in
+the same units as MAX_DISTS in prepare_cluster_indexes.py, and the pairs are
+counted in distance bins.  The first bins are the usual levels, so the local
+figures can be compared with count_well_duplicates.py.  To turn the counts
+into a rate, the number of pairs of passing wells in each bin is estimated
+from a sample of wells.
+
+As with exhaustive.py this only uses the Hamming distance.  The index is
+built afresh for each tile, since the s.locs positions say nothing about the
+distance between wells on different tiles.
+
+Synopsis:
+
+   scan = LongRangeScan('run/Data/Intensities/s.locs', edit_distance=2)
+   ts = scan.tile_stats(BCLReader('run').get_tile(1, 1101), [(20, 70)])
+
+or:
+
+   long_range.py -r run -i 1 -t 1101,2101 --cycles 20-70
+"""
+__AUTHORS__ = ['Tim Booth']
+__VERSION__ = 0.1
+
+import os, sys
+import json
+import math
+from itertools import combinations
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+import numpy as np
+
+import bcl_direct_reader
+import inflate
+from run_layout import RunLayout, filter_tiles, parse_cycles
+from profiling import NO_PROFILE
+from prepare_cluster_indexes import MAX_DISTS
+from exhaustive import load_slocs, read_tile_words, hamming, BASE_BITS, BASES_PER_WORD
+
+# Bins beyond the local levels. The last bin has no upper limit.
+FAR_EDGES = [200, 500, 1000, 2000, 5000, 10000, 20000, 50000]
+
+# Buckets of more wells than this are not searched for pairs.
+MAX_BUCKET = 1000
+
+# How many wells to sample to estimate the number of well pairs in each bin.
+PAIR_SAMPLES = 50
+
+# Bases in each key beyond those needed to number every well, so that most
+# buckets hold just one well.
+KEY_SPARE_BASES = 2
+
+# For combining the words of a part into one key.
+KEY_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+# Totals for each tile, which are summed for the lane
+COUNT_KEYS = ['wells', 'crowded', 'dup_wells', 'local_wells', 'distant_wells']
+BIN_KEYS = ['pairs', 'well_pairs']
+
+def log(msg):
+    print(str(msg), file=sys.stderr)
+
+def choose_parts(bases, edit_distance, num_wells):
+    """ The fewest parts to split the bases into so that the keys, which
+        leave out edit_distance parts, are long enough to tell the wells
+        apart.  This is never more than edit_distance + 6.
+    """
+    wanted = math.log(max(num_wells, 2), 4) + KEY_SPARE_BASES
+    for parts in range(edit_distance + 1, edit_distance + 7):
+        if bases * (parts - edit_distance) // parts >= wanted:
+            break
+    return min(parts, bases)
+
+def part_keys(words, bases, parts, edit_distance):
+    """ Splits the bases packed in words into parts and yields an array of
+        keys for each combination of all but edit_distance of the parts, such
+        that wells with the same bases in those parts have the same key.
+        Different bases may very rarely give the same key too, which costs a
+        little time but never a false duplicate.
+    """
+    if parts > bases or parts <= edit_distance:
+        raise ValueError("Cannot split %i bases into %i parts" % (bases, parts))
+    bounds = np.linspace(0, bases, parts + 1).astype(int)
+    for chosen in combinations(range(parts), parts - edit_distance):
+        key = np.zeros(words.shape[1], dtype=np.uint64)
+        for start, end in ( (bounds[p], bounds[p+1]) for p in chosen ):
+            for w in range(start // BASES_PER_WORD, (end - 1) // BASES_PER_WORD + 1):
+                lo = max(start - w * BASES_PER_WORD, 0)
+                hi = min(end - w * BASES_PER_WORD, BASES_PER_WORD)
+                mask = np.uint64(((1 << (BASE_BITS * hi)) - 1) ^ ((1 << (BASE_BITS * lo)) - 1))
+                key = key * KEY_MIX + (words[w] & mask)
+        yield key
+
+def bucket_pairs(keys, wells, max_bucket=MAX_BUCKET):
+    """ Finds every pair of wells with the same key.  Returns the two arrays
+        of wells for the pairs, and the wells in buckets that were too big.
+    """
+    order = np.argsort(keys, kind='stable')
+    wells = wells[order]
+    uniq, starts, sizes = np.unique(keys[order], return_index=True, return_counts=True)
+
+    crowded = sizes > max_bucket
+    crowded_wells = wells[np.repeat(crowded, sizes)]
+
+    # The pairs within each bucket, doing all the buckets of the same size at
+    # once. Most buckets hold one well, and there are few different sizes, so
+    # the work is in proportion to the number of pairs.
+    res_a, res_b = [], []
+    for size in np.unique(sizes[(sizes > 1) & ~crowded]):
+        first = starts[sizes == size]
+        i, j = np.triu_indices(size, 1)
+        res_a.append(wells[(first[:, None] + i).ravel()])
+        res_b.append(wells[(first[:, None] + j).ravel()])
+
+    if not res_a:
+        empty = np.zeros(0, dtype=wells.dtype)
+        return empty, empty, crowded_wells
+    return np.concatenate(res_a), np.concatenate(res_b), crowded_wells
+
+class LongRangeScan:
+
+    def __init__(self, slocs, edit_distance, levels=3, max_bucket=MAX_BUCKET, pair_samples=PAIR_SAMPLES):
+        """ slocs is the s.locs filename, which is read just once.  Pairs up to
+            MAX_DISTS[levels] apart are counted as local.
+        """
+        self.edit_distance = edit_distance
+        self.levels = levels
+        self.max_bucket = max_bucket
+        self.pair_samples = pair_samples
+        self.x, self.y = load_slocs(slocs)
+        self.num_wells = len(self.x)
+
+        # Bin i holds the pairs with edges[i] < distance <= edges[i+1], and the
+        # last bin everything further apart.
+        self.edges = MAX_DISTS[:levels+1] + [ e for e in FAR_EDGES if e > MAX_DISTS[levels] ]
+        self.sq_edges = np.array(self.edges, dtype=np.int64) ** 2
+
+    def bin_names(self):
+        return [ '%i-%s' % (lo, hi) for lo, hi in zip(self.edges, self.edges[1:] + ['']) ]
+
+    def _bins(self, a, b):
+        """ The bin for each pair of wells, or -1 if they are no more than
+            edges[0] apart.
+        """
+        d2 = (self.x[a] - self.x[b]) ** 2 + (self.y[a] - self.y[b]) ** 2
+        return np.searchsorted(self.sq_edges, d2, side='left') - 1
+
+    def read_tile(self, tile, cycles, profile=NO_PROFILE):
+        """ See exhaustive.read_tile_words().
+        """
+        return read_tile_words(tile, cycles, self.num_wells, profile)
+
+    def find_pairs(self, words, passing, bases, profile=NO_PROFILE):
+        """ Finds every pair of passing wells no more than edit_distance apart.
+            Returns the two arrays of wells, with a < b, and the number of
+            crowded wells.
+        """
+        wells = np.nonzero(passing)[0]
+        all_a, all_b = [], []
+        crowded = np.zeros(self.num_wells, dtype=bool)
+        parts = choose_parts(bases, self.edit_distance, len(wells))
+        for keys in part_keys(words[:, wells], bases, parts, self.edit_distance):
+            a, b, crowded_wells = bucket_pairs(keys, wells, self.max_bucket)
+            all_a.append(np.minimum(a, b))
+            all_b.append(np.maximum(a, b))
+            crowded[crowded_wells] = True
+
+        # A pair may be found by several parts
+        pair_ids = np.unique(np.concatenate(all_a) * self.num_wells + np.concatenate(all_b))
+        a, b = np.divmod(pair_ids, self.num_wells)
+        profile.count('candidate_pairs', len(a))
+
+        is_dup = hamming(words, a, b) <= self.edit_distance
+
+        return a[is_dup], b[is_dup], int(crowded.sum())
+
+    def well_pairs(self, passing):
+        """ Estimates how many pairs of passing wells there are in each bin,
+            by counting around a sample of the wells.
+        """
+        wells = np.nonzero(passing)[0]
+        if not len(wells):
+            return [ 0 ] * len(self.edges)
+        sample = wells[np.linspace(0, len(wells) - 1, min(self.pair_samples, len(wells))).astype(np.int64)]
+        counts = np.zeros(len(self.edges), dtype=np.int64)
+        for well in sample:
+            bins = self._bins(well, wells)
+            counts += np.bincount(bins[bins >= 0], minlength=len(self.edges))
+        # Each pair has two ends
+        return [ int(round(c * len(wells) / len(sample) / 2)) for c in counts ]
+
+    def tile_stats(self, tile, cycles, profile=NO_PROFILE):
+        """ Does the whole tile.  Returns a dict of totals, see stats().
+        """
+        words, passing = self.read_tile(tile, cycles, profile)
+        return self.stats(words, passing, sum(e - s for s, e in cycles), profile)
+
+    def stats(self, words, passing, bases, profile=NO_PROFILE):
+        """ The second half of tile_stats(), if you already did read_tile().
+            The dict has the number of passing wells, how many were crowded,
+            how many had a duplicate at all, within the local levels, or
+            only further away, plus the pairs found and the estimated well
+            pairs in each distance bin.
+        """
+        with profile.phase('compare'):
+            a, b, crowded = self.find_pairs(words, passing, bases, profile)
+
+        with profile.phase('report'):
+            bins = self._bins(a, b)
+            local = (bins >= 0) & (bins < self.levels)
+
+            has_dup = np.zeros(self.num_wells, dtype=bool)
+            has_dup[a] = has_dup[b] = True
+            has_local = np.zeros(self.num_wells, dtype=bool)
+            has_local[a[local]] = has_local[b[local]] = True
+
+            return dict( wells = int(passing.sum()),
+                         crowded = crowded,
+                         dup_wells = int(has_dup.sum()),
+                         local_wells = int(has_local.sum()),
+                         distant_wells = int((has_dup & ~has_local).sum()),
+                         pairs = np.bincount(bins[bins >= 0], minlength=len(self.edges)).tolist(),
+                         well_pairs = self.well_pairs(passing) )
+
+def sum_stats(all_ts):
+    """ Adds up the tile stats for a lane.
+    """
+    res = { k: sum(ts[k] for ts in all_ts) for k in COUNT_KEYS }
+    for k in BIN_KEYS:
+        res[k] = [ sum(c) for c in zip(*(ts[k] for ts in all_ts)) ]
+    return res
+
+def _frac(n, d):
+    return n / d if d else 0.0
+
+def write_text(heading, ts, bin_names, out=None):
+    print("%s\tWells: %i\tCrowded: %i" % (heading, ts['wells'], ts['crowded']), file=out)
+    print("DupWells: %i (%.5f)\tLocal: %i (%.5f)\tDistantOnly: %i (%.5f)" % (
+            ts['dup_wells'], _frac(ts['dup_wells'], ts['wells']),
+            ts['local_wells'], _frac(ts['local_wells'], ts['wells']),
+            ts['distant_wells'], _frac(ts['distant_wells'], ts['wells']) ), file=out)
+    for name, pairs, well_pairs in zip(bin_names, ts['pairs'], ts['well_pairs']):
+        print("Distance: %s\tPairs: %i\tWellPairs: %i\tRate: %.3g" % (
+                name, pairs, well_pairs, _frac(pairs, well_pairs) ), file=out)
+
+def main():
+    args = parse_args()
+
+    if args.quiet:
+        global log
+        log = lambda *args: None
+
+    layout = RunLayout(args.run)
+    bcl_reader = bcl_direct_reader.BCLReader(args.run, inflate_backend=args.inflate, layout=layout)
+    lanes = args.lane.split(',') if args.lane else layout.lanes
+
+    cycles = [(args.start, args.end)]
+    if args.cycles:
+        cycles = parse_cycles(args.cycles)
+
+    scan = LongRangeScan( args.slocs or os.path.join(args.run, 'Data', 'Intensities', 's.locs'),
+                          args.edit_distance, args.level,
+                          max_bucket = args.max_bucket, pair_samples = args.pair_samples )
+    bin_names = scan.bin_names()
+
+    for lane in lanes:
+        tiles = layout.tiles(lane)
+        if args.tile_id:
+            tiles = filter_tiles(tiles, args.tile_id)
+
+        all_ts = []
+        for tile in tiles:
+            log("Reading tile %s" % tile)
+            ts = scan.tile_stats(bcl_reader.get_tile(lane, tile), cycles)
+            all_ts.append(ts)
+            if args.format == 'text' and not args.summary_only:
+                write_text("Lane: %s\tTile: %s" % (lane, tile), ts, bin_names)
+
+        lane_ts = sum_stats(all_ts)
+        if args.format == 'json':
+            print(json.dumps(dict(lane_ts, lane=lane, tile_count=len(tiles), bins=bin_names), sort_keys=True))
+        else:
+            write_text("LaneSummary: %s\tTiles: %i" % (lane, len(tiles)), lane_ts, bin_names)
+            print()
+
+def parse_args():
+    description = """Finds duplicate reads anywhere on each tile and reports the duplicate rate
+    by the distance between the wells, to tell local duplication (pad hopping) from library
+    duplication.  Needs numpy.
+    """
+    parser = ArgumentParser(description=description, formatter_class=ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("-r", "--run", required=True,
+                        help="The run directory.")
+    parser.add_argument("-i", "--lane", type=str,
+                        help="Comma-separated lanes to read. The default is every lane.")
+    parser.add_argument("-t", "--tile", dest="tile_id", type=str,
+                        help="Tiles to read, as for count_well_duplicates.py. The whole tile is" +
+                             " read for every tile, so you probably want to pick a few.")
+    parser.add_argument("-e", "--edit_distance", type=int, default=2,
+                        help="Max Hamming distance between two sequences to be considered duplicates.")
+    parser.add_argument("-l", "--level", type=int, default=3,
+                        help="Pairs up to this many levels apart are counted as local.")
+    parser.add_argument("-x", "--start", type=int, default=50,
+                        help="The first cycle to read, counting from 0.")
+    parser.add_argument("-y", "--end", type=int, default=100,
+                        help="The cycle to stop at, as for count_well_duplicates.py.")
+    parser.add_argument("--cycles",
+                        help="Comma-separated ranges of cycles, eg. 20-45,65-90, instead of -x and -y.")
+    parser.add_argument("--slocs",
+                        help="The s.locs file, if not the one in the run.")
+    parser.add_argument("--max-bucket", type=int, default=MAX_BUCKET,
+                        help="Skip groups of more than this many wells sharing a key.")
+    parser.add_argument("--pair-samples", type=int, default=PAIR_SAMPLES,
+                        help="Wells to sample to estimate the number of well pairs at each distance.")
+    parser.add_argument("-S", "--summary-only", action="store_true",
+                        help="Only print the summary for each lane.")
+    parser.add_argument("--format", choices=['text', 'json'], default="text",
+                        help="Output format.")
+    parser.add_argument("--inflate", choices=['auto'] + list(inflate.BACKENDS),
+                        help="Which library to use for gunzipping.")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="No progress messages on STDERR.")
+    parser.add_argument("--version", action="version", version=str(__VERSION__))
+
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    main()
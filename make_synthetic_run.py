@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""
+Writes a synthetic Illumina run folder that bcl_direct_reader.py and
+prepare_cluster_indexes.py can read, with duplicates planted at known
+distances.  The point is to be able to test and benchmark the reader and the
+counting loop without access to real sequencer output.
+
+The layout follows the real thing closely enough for our code:
+
+    RUN/RunInfo.xml
+    RUN/Data/Intensities/s.locs
+    RUN/Data/Intensities/BaseCalls/L001/s_1_1101.filter
+    RUN/Data/Intensities/BaseCalls/L001/C1.1/s_1_1101.bcl.gz   (HiSeq 4000/X)
+    RUN/Data/Intensities/BaseCalls/L001/C1.1/L001_1.cbcl       (NovaSeq)
+
+Wells are laid out row by row on a honeycomb with 20 pixel spacing along
+the rows and 17 pixels between rows, which is what we see on real HiSeq 4000
+flowcells (see plan.md).  With that spacing the rings of the honeycomb fall
+neatly into the MAX_DISTS bands used by prepare_cluster_indexes.py, so
+"level N" and "ring N of the honeycomb" mean the same thing.
+
+A truth.json file is written alongside RunInfo.xml, listing for every tile
+the duplicates that were planted as [source_well, copy_well, level].  With
+far_rate, some copies are also planted anywhere on the tile, and these are
+listed with level 0.
+
+Synopsis:
+
+   make_synthetic_run.py -o /tmp/fake_run --preset novaseq --rows 100 --cols 300
+
+or from Python:
+
+   truth = make_run("/tmp/fake_run", preset="hiseq_4000", rows=50, cols=200)
+"""
+__AUTHORS__ = ['Tim Booth']
+__VERSION__ = 0.1
+
+import os, sys
+import struct
+import gzip
+import json
+import math
+import random
+from itertools import compress
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+from prepare_cluster_indexes import MAX_DISTS
+
+# Pixel geometry of the honeycomb, in the units used after the
+# int(t * 10 + 1000.5) conversion applied by the s.locs readers.
+X_SPACING = 20
+Y_SPACING = 17
+ORIGIN = 1000
+
+# Settings for the instruments we care about.  The well counts are the real
+# ones, but these are far too big for tests so normally you'll override
+# rows and cols.
+PRESETS = dict(
+    hiseq_4000 = dict( fmt='bcl.gz', surfaces=2, swaths=2, tiles=28, lanes=8,
+                       instrument='K00166', rows=2743, cols=1571 ),
+    hiseq_x    = dict( fmt='bcl.gz', surfaces=2, swaths=2, tiles=24, lanes=8,
+                       instrument='E00306', rows=2743, cols=1571 ),
+    novaseq    = dict( fmt='cbcl',   surfaces=2, swaths=4, tiles=78, lanes=4,
+                       instrument='A00291', rows=2604, cols=1571 ),
+)
+
+# NovaSeq records the first 25 cycles in full, then drops the wells that
+# failed the filter.
+UNEXCLUDED_CYCLES = 25
+
+# Every well on every cycle is represented by a single random byte, which
+# then gets mapped to a base call (or no-call) and a quality.  Duplicates are
+# planted by copying these bytes.  The tables are built once, below.
+NO_CALL_BYTES = 2    # out of 256, so about 0.8% no-calls
+BASES = 'ACGT'
+
+def _build_tables():
+    base_of = []
+    bcl_of = []
+    nibble_of = []
+    # Binned qualities as seen on the HiSeq 4000, mostly high.
+    quals = [12] * 16 + [23] * 32 + [37] * 208
+    for r in range(256):
+        if r < NO_CALL_BYTES:
+            base_of.append('N')
+            bcl_of.append(0)
+            nibble_of.append(0)
+            continue
+        b = r & 0b11
+        q = quals[r]
+        base_of.append(BASES[b])
+        bcl_of.append(q << 2 | b)
+        # 2-bit quality for CBCL, which must be non-zero for a call
+        nibble_of.append((1 if q < 20 else 2 if q < 30 else 3) << 2 | b)
+    return base_of, bytes(bcl_of), bytes(nibble_of)
+
+BASE_OF, BCL_TABLE, NIBBLE_TABLE = _build_tables()
+SHIFT4_TABLE = bytes( (n << 4) & 0xff for n in range(256) )
+
+def well_coords(rows, cols):
+    """Yields the pixel (x, y) position of every well in order.
+    """
+    for row in range(rows):
+        for col in range(cols):
+            yield ( ORIGIN + col * X_SPACING + (X_SPACING // 2 if row % 2 else 0),
+                    ORIGIN + row * Y_SPACING )
+
+def neighbours(well, level, rows, cols):
+    """Lists the wells in ring 'level' around 'well', classified in the same way
+       as prepare_cluster_indexes.get_indexes() would do it.
+    """
+    row, col = divmod(well, cols)
+    x0 = col * X_SPACING + (X_SPACING // 2 if row % 2 else 0)
+    y0 = row * Y_SPACING
+    res = []
+    for r in range(max(0, row - level - 1), min(rows, row + level + 2)):
+        for c in range(max(0, col - level - 1), min(cols, col + level + 2)):
+            x = c * X_SPACING + (X_SPACING // 2 if r % 2 else 0)
+            dist = math.sqrt((x - x0)**2 + (r * Y_SPACING - y0)**2)
+            if MAX_DISTS[level-1] < dist <= MAX_DISTS[level]:
+                res.append(r * cols + c)
+    return res
+
+def tile_names(surfaces, swaths, tiles):
+    return [ "%i%i%02i" % (s, w, t) for s in range(1, surfaces+1)
+                                    for w in range(1, swaths+1)
+                                    for t in range(1, tiles+1) ]
+
+class SyntheticTile:
+    """Holds the random bytes for one tile.  Everything written out is
+       derived from self.wells (one bytearray per cycle) and self.passing.
+    """
+    def __init__(self, rng, rows, cols, cycles, pass_rate, dup_rates, far_rate=0):
+        self.num_wells = num_wells = rows * cols
+
+        pass_table = bytes( 1 if b < pass_rate * 256 else 0 for b in range(256) )
+        self.passing = rng.randbytes(num_wells).translate(pass_table)
+        self.wells = [ bytearray(rng.randbytes(num_wells)) for c in range(cycles) ]
+
+        # Plant the duplicates.  Sources must pass the filter or they would
+        # never be examined, and no well takes part in more than one pair so
+        # that the truth is unambiguous.
+        self.planted = []
+        used = set()
+        for level, rate in enumerate(dup_rates, 1):
+            for n in range(int(rate * num_wells)):
+                src = rng.randrange(num_wells)
+                if src in used or not self.passing[src]:
+                    continue
+                candidates = [ w for w in neighbours(src, level, rows, cols) if w not in used ]
+                if not candidates:
+                    continue
+                dst = rng.choice(candidates)
+                for cyc in self.wells:
+                    cyc[dst] = cyc[src]
+                used.update((src, dst))
+                self.planted.append([src, dst, level])
+
+        # And the ones that could be anywhere, as for pad hopping.
+        for n in range(int(far_rate * num_wells)):
+            src, dst = rng.randrange(num_wells), rng.randrange(num_wells)
+            if src in used or dst in used or src == dst or not self.passing[src]:
+                continue
+            for cyc in self.wells:
+                cyc[dst] = cyc[src]
+            used.update((src, dst))
+            self.planted.append([src, dst, 0])
+
+    def seq(self, well, start=0, end=None):
+        """The sequence that the reader should return for this well.
+        """
+        return ''.join( BASE_OF[c[well]] for c in self.wells[start:end] )
+
+    def filter_bytes(self):
+        return struct.pack('<III', 0, 3, self.num_wells) + self.passing
+
+    def bcl_bytes(self, cycle):
+        return struct.pack('<I', self.num_wells) + self.wells[cycle].translate(BCL_TABLE)
+
+    def cbcl_block(self, cycle, excluded):
+        """Returns (num_wells_in_block, packed_bytes) for one cycle.
+           Two wells per byte with the first in the low nibble.
+        """
+        nibbles = self.wells[cycle].translate(NIBBLE_TABLE)
+        if excluded:
+            nibbles = bytes(compress(nibbles, self.passing))
+        count = len(nibbles)
+        if count % 2:
+            nibbles += b'\0'
+        low = nibbles[0::2]
+        high = nibbles[1::2].translate(SHIFT4_TABLE)
+        packed = ( int.from_bytes(low, 'little') | int.from_bytes(high, 'little') ).to_bytes(len(low), 'little')
+        return count, packed
+
+def write_slocs(filename, rows, cols):
+    with open(filename, 'wb') as fh:
+        fh.write(struct.pack('<ifI', 1, 1.0, rows * cols))
+        for x, y in well_coords(rows, cols):
+            fh.write(struct.pack('<ff', (x - 1000) / 10.0, (y - 1000) / 10.0))
+
+def write_targets(filename, rows, cols, sample_size, levels=5, seed=13):
+    """Writes a targets file in the same format as prepare_cluster_indexes.py,
+       but working out the neighbours from the known geometry rather than
+       by scanning the s.locs file, which is much quicker.
+    """
+    rng = random.Random(seed)
+    with open(filename, 'w') as fh:
+        for centre in rng.sample(range(rows * cols), sample_size):
+            print(centre, file=fh)
+            for level in range(1, levels+1):
+                print(",".join(map(str, neighbours(centre, level, rows, cols))), file=fh)
+
+def write_cbcl(filename, blocks, excluded, compresslevel=1):
+    """blocks is a list of (tile_number, wells, packed_bytes)
+    """
+    bins = [(0, 2), (1, 12), (2, 23), (3, 37)]
+    zipped = [ (t, n, len(data), gzip.compress(data, compresslevel=compresslevel)) for t, n, data in blocks ]
+    header_size = 12 + len(bins) * 8 + 4 + len(zipped) * 16 + 1
+
+    with open(filename, 'wb') as fh:
+        fh.write(struct.pack('<HIBBI', 1, header_size, 2, 2, len(bins)))
+        for b in bins:
+            fh.write(struct.pack('<II', *b))
+        fh.write(struct.pack('<I', len(zipped)))
+        for t, n, usize, zdata in zipped:
+            fh.write(struct.pack('<IIII', t, n, usize, len(zdata)))
+        fh.write(bytes([int(excluded)]))
+        for t, n, usize, zdata in zipped:
+            fh.write(zdata)
+
+def write_runinfo(filename, run_id, instrument, flowcell, lanes, surfaces, swaths, tiles, reads):
+    tile_lines = [ "          <Tile>%i_%s</Tile>" % (l, t)
+                   for l in lanes for t in tile_names(surfaces, swaths, tiles) ]
+    read_lines = [ '      <Read Number="%i" NumCycles="%i" IsIndexedRead="N" />' % (n, c)
+                   for n, c in enumerate(reads, 1) ]
+    with open(filename, 'w') as fh:
+        print('<?xml version="1.0"?>', file=fh)
+        print('<RunInfo Version="5">', file=fh)
+        print('  <Run Id="%s" Number="1">' % run_id, file=fh)
+        print('    <Flowcell>%s</Flowcell>' % flowcell, file=fh)
+        print('    <Instrument>%s</Instrument>' % instrument, file=fh)
+        print('    <Reads>', *read_lines, '    </Reads>', sep="\n", file=fh)
+        print('    <FlowcellLayout LaneCount="%i" SurfaceCount="%i" SwathCount="%i" TileCount="%i">' % (
+                                     max(lanes), surfaces,           swaths,         tiles), file=fh)
+        print('      <TileSet TileNamingConvention="FourDigit">', file=fh)
+        print('        <Tiles>', *tile_lines, '        </Tiles>', sep="\n", file=fh)
+        print('      </TileSet>', file=fh)
+        print('    </FlowcellLayout>', file=fh)
+        print('  </Run>', file=fh)
+        print('</RunInfo>', file=fh)
+
+def make_run( location, preset='hiseq_4000', lanes=(1,), surfaces=None, swaths=None, tiles=None,
+              rows=60, cols=200, cycles=60, pass_rate=0.7, dup_rates=(0.01, 0.005, 0.002),
+              far_rate=0, seed=13, fmt=None, compresslevel=1, keep=None ):
+    """Writes a run to location, which must not already contain a run.
+       Any of the preset settings may be overridden.  Returns the truth dict,
+       which is also saved as truth.json:
+         { "1_1101": [[src, dst, level], ...], ... }
+       If keep is a dict, the SyntheticTile objects are saved in it with the
+       same keys, so you can see what sequences the reader ought to return.
+    """
+    settings = dict(PRESETS[preset])
+    for k, v in dict(surfaces=surfaces, swaths=swaths, tiles=tiles, fmt=fmt).items():
+        if v is not None:
+            settings[k] = v
+    rng = random.Random(seed)
+
+    flowcell = 'HSYNTH%03iXX' % (seed % 1000)
+    run_id = '000101_%s_0001_A%s' % (settings['instrument'], flowcell)
+    all_tiles = tile_names(settings['surfaces'], settings['swaths'], settings['tiles'])
+
+    intensities = os.path.join(location, 'Data', 'Intensities')
+    os.makedirs(os.path.join(intensities, 'BaseCalls'))
+    write_runinfo( os.path.join(location, 'RunInfo.xml'), run_id, settings['instrument'], flowcell,
+                   lanes, settings['surfaces'], settings['swaths'], settings['tiles'],
+                   reads = [cycles] )
+    write_slocs(os.path.join(intensities, 's.locs'), rows, cols)
+
+    truth = dict()
+    for lane in lanes:
+        lane_dir = os.path.join(intensities, 'BaseCalls', 'L%03i' % lane)
+        for c in range(cycles):
+            os.makedirs(os.path.join(lane_dir, 'C%i.1' % (c+1)))
+
+        # Generate the tiles one surface at a time, since a CBCL file holds a
+        # whole surface.  For BCL we could go tile by tile but there's no need.
+        for surface in range(1, settings['surfaces']+1):
+            surface_tiles = [ t for t in all_tiles if t[0] == str(surface) ]
+            syn_tiles = dict()
+            for t in surface_tiles:
+                syn_tiles[t] = st = SyntheticTile(rng, rows, cols, cycles, pass_rate, dup_rates, far_rate)
+                truth['%i_%s' % (lane, t)] = st.planted
+                if keep is not None:
+                    keep['%i_%s' % (lane, t)] = st
+
+                with open(os.path.join(lane_dir, 's_%i_%s.filter' % (lane, t)), 'wb') as fh:
+                    fh.write(st.filter_bytes())
+
+                if settings['fmt'] == 'bcl.gz':
+                    for c in range(cycles):
+                        bcl_file = os.path.join(lane_dir, 'C%i.1' % (c+1), 's_%i_%s.bcl.gz' % (lane, t))
+                        with gzip.open(bcl_file, 'wb', compresslevel=compresslevel) as fh:
+                            fh.write(st.bcl_bytes(c))
+                elif settings['fmt'] == 'bcl':
+                    for c in range(cycles):
+                        bcl_file = os.path.join(lane_dir, 'C%i.1' % (c+1), 's_%i_%s.bcl' % (lane, t))
+                        with open(bcl_file, 'wb') as fh:
+                            fh.write(st.bcl_bytes(c))
+
+            if settings['fmt'] == 'cbcl':
+                for c in range(cycles):
+                    excluded = c >= UNEXCLUDED_CYCLES
+                    blocks = [ (int(t),) + syn_tiles[t].cbcl_block(c, excluded) for t in surface_tiles ]
+                    write_cbcl( os.path.join(lane_dir, 'C%i.1' % (c+1), 'L%03i_%i.cbcl' % (lane, surface)),
+                                blocks, excluded, compresslevel )
+
+    with open(os.path.join(location, 'truth.json'), 'w') as fh:
+        json.dump(truth, fh, indent=1, sort_keys=True)
+
+    return truth
+
+def parse_args(args=None):
+    description = """Writes a synthetic run folder with planted well duplicates, for testing
+    and benchmarking the well duplicates code without needing real data.
+    """
+    parser = ArgumentParser(description=description, formatter_class=ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("-o", "--output", required=True,
+                        help="Directory to create for the run.")
+    parser.add_argument("-p", "--preset", default="hiseq_4000", choices=sorted(PRESETS),
+                        help="Instrument type to mimic.")
+    parser.add_argument("--fmt", choices=["bcl.gz", "bcl", "cbcl"],
+                        help="File format, if not the one the preset uses.  Plain .bcl is" +
+                             " what some older instruments and archived runs have.")
+    parser.add_argument("-i", "--lanes", default="1",
+                        help="Comma-separated list of lanes to write.")
+    parser.add_argument("--tiles", type=int,
+                        help="Tiles per swath, if not the preset number.")
+    parser.add_argument("--swaths", type=int,
+                        help="Swaths per surface, if not the preset number.")
+    parser.add_argument("--surfaces", type=int,
+                        help="Number of surfaces, if not the preset number.")
+    parser.add_argument("--rows", type=int, default=60,
+                        help="Rows of wells per tile.")
+    parser.add_argument("--cols", type=int, default=200,
+                        help="Wells per row.  Keep this below 4000 or prepare_cluster_indexes.py" +
+                             " will not search far enough to find all the neighbours.")
+    parser.add_argument("-c", "--cycles", type=int, default=60,
+                        help="Number of cycles.")
+    parser.add_argument("--pass_rate", type=float, default=0.7,
+                        help="Fraction of wells passing the filter.")
+    parser.add_argument("--dup_rates", default="0.01,0.005,0.002",
+                        help="Comma-separated duplicate rates for levels 1, 2, 3...")
+    parser.add_argument("--far_rate", type=float, default=0,
+                        help="Rate of duplicates planted anywhere on the tile, not just nearby.")
+    parser.add_argument("-s", "--seed", type=int, default=13,
+                        help="Random seed.")
+    parser.add_argument("--compresslevel", type=int, default=1,
+                        help="gzip level for .bcl.gz files.")
+
+    return parser.parse_args(args)
+
+def main():
+    args = parse_args()
+
+    truth = make_run( args.output,
+                      preset = args.preset,
+                      lanes = [int(l) for l in args.lanes.split(',')],
+                      surfaces = args.surfaces, swaths = args.swaths, tiles = args.tiles,
+                      rows = args.rows, cols = args.cols, cycles = args.cycles,
+                      pass_rate = args.pass_rate,
+                      dup_rates = [float(d) for d in args.dup_rates.split(',')],
+                      far_rate = args.far_rate,
+                      seed = args.seed,
+                      fmt = args.fmt,
+                      compresslevel = args.compresslevel )
+
+    print("Wrote %i tiles with %i planted duplicates to %s" % (
+                 len(truth), sum(len(v) for v in truth.values()), args.output), file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Writes metrics in the text format read by the Prometheus node-exporter
+textfile collector, so that production runs can be monitored and alerted on.
+See https://github.com/prometheus/node_exporter#textfile-collector
+
+Files are always written to a temporary name and then renamed, as the
+collector may read them at any moment.
+
+Synopsis:
+
+   m = Metrics()
+   m.set('welldup_lane_seconds', 123.4, "Time taken to count a lane", run='XXX', lane=1)
+   m.write('/var/lib/node_exporter/welldup.prom')
+
+The script can also merge several files into one, which is needed because
+the collector objects to the same metric being described in two files:
+
+   metrics.py merge out.prom lane1.prom lane2.prom ...
+"""
+
+import os, sys, re
+from collections import OrderedDict
+
+class Metrics:
+    """A set of gauges and counters, each with any number of labelled samples.
+    """
+    def __init__(self):
+        # name : (type, help)
+        self._meta = OrderedDict()
+        # (name, labels) : value
+        self._samples = OrderedDict()
+
+    def _label_key(self, labels):
+        return tuple( (k, str(v)) for k, v in sorted(labels.items()) )
+
+    def set(self, name, value, help='', mtype='gauge', **labels):
+        """Sets a sample, replacing any previous value with the same labels.
+        """
+        if name not in self._meta or not self._meta[name][1]:
+            self._meta[name] = (mtype, help)
+        self._samples[(name, self._label_key(labels))] = value
+
+    def get(self, name, **labels):
+        return self._samples.get((name, self._label_key(labels)))
+
+    def update(self, other):
+        """Copies all the samples from another Metrics object into this one.
+        """
+        for name, (mtype, help) in other._meta.items():
+            if name not in self._meta or not self._meta[name][1]:
+                self._meta[name] = (mtype, help)
+        self._samples.update(other._samples)
+
+    def render(self):
+        lines = []
+        for name, (mtype, help) in self._meta.items():
+            if help:
+                lines.append("# HELP %s %s" % (name, help.replace('\\', r'\\').replace('\n', r'\n')))
+            lines.append("# TYPE %s %s" % (name, mtype))
+            for (sname, labels), value in self._samples.items():
+                if sname == name:
+                    lines.append("%s%s %s" % (name, _format_labels(labels), _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename):
+        tmp_file = "%s.%i.tmp" % (filename, os.getpid())
+        with open(tmp_file, 'w') as fh:
+            fh.write(self.render())
+        os.replace(tmp_file, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Reads back a file as written by write().  Only the subset of the
+           format that we write is understood.
+        """
+        res = cls()
+        pending_help = dict()
+        with open(filename) as fh:
+            for line in (l.rstrip("\n") for l in fh):
+                mo = re.match(r'# HELP (\S+) (.*)', line)
+                if mo:
+                    pending_help[mo.group(1)] = mo.group(2).replace(r'\n', '\n').replace(r'\\', '\\')
+                    continue
+                mo = re.match(r'# TYPE (\S+) (\S+)', line)
+                if mo:
+                    res._meta[mo.group(1)] = (mo.group(2), pending_help.get(mo.group(1), ''))
+                    continue
+                mo = re.match(r'([a-zA-Z_:][\w:]*)(?:\{(.*)\})? (\S+)$', line)
+                if mo:
+                    labels = dict( (k, _unescape(v)) for k, v in
+                                   re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', mo.group(2) or '') )
+                    value = mo.group(3)
+                    value = int(value) if re.match(r'-?\d+$', value) else float(value)
+                    res._samples[(mo.group(1), res._label_key(labels))] = value
+        return res
+
+def _escape(v):
+    return v.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def _unescape(v):
+    return re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), v)
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels) + '}'
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def main(args):
+    """Minimal CLI for use from shell scripts.
+    """
+    if len(args) >= 2 and args[0] == 'merge':
+        merged = Metrics()
+        for f in args[2:]:
+            try:
+                merged.update(Metrics.load(f))
+            except FileNotFoundError:
+                print("Skipping missing file %s" % f, file=sys.stderr)
+        merged.write(args[1])
+    else:
+        print("Usage: metrics.py merge <out.prom> <in.prom> ...", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
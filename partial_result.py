@@ -0,0 +1,160 @@
+#!python3
+"""
+Partial results for count_well_duplicates.py, so that one run can be split
+over many jobs with --shard and the pieces put back together afterwards with
+'count_well_duplicates.py merge'.
+
+A partial result holds the raw totals for every tile that was done (as
+returned by count_well_duplicates.tile_stats) for each configuration, along
+with the list of tiles the whole lane should have and the key of settings
+that affect the counts (the same key as is used for checkpoints).  The lane
+report only depends on the tile totals, so merging gives exactly the report a
+single job would have printed.
+
+Partials are only merged if the keys and configurations all match, and the
+merge fails if any tile that should be there is missing.
+
+Synopsis:
+
+   tiles = shard_tiles(all_tiles, *parse_shard('3/8'))
+
+   part = PartialResult(configs=[...], shard='3/8')
+   part.add_lane(lane, all_tiles)
+   part.add_tile(lane, tile, [ts, ...])
+   part.save('lane1_shard3.json')
+
+   merged = merge_partials([ PartialResult.load(f) for f in filenames ])
+"""
+
+import os
+import json
+import re
+
+# Bump this if the content of the partial results changes
+PARTIAL_VERSION = 1
+
+def parse_shard(spec):
+    """ Converts 'i/N' to (i, N), with shards numbered from 1.
+    """
+    amatch = re.match(r'^(\d+)/(\d+)$', str(spec).strip())
+    if not amatch:
+        raise ValueError("Shard should be given as i/N, not %r" % spec)
+    shard, shards = int(amatch.group(1)), int(amatch.group(2))
+    if not 1 <= shard <= shards:
+        raise ValueError("Shard %i/%i is out of range" % (shard, shards))
+    return shard, shards
+
+def shard_tiles(tiles, shard, shards):
+    """ Picks every Nth tile, starting with the ith.  Dealing them out like
+        this rather than in blocks spreads each surface and swath over the
+        shards, so the jobs take about the same time.
+    """
+    return list(tiles)[shard-1::shards]
+
+class PartialResult:
+
+    def __init__(self, configs, sampling=None, shard=None):
+        """ configs is a list of JSON-friendly dicts, one per configuration,
+            which must match for partials to be merged.  sampling is None or
+            a dict of the --tile-fraction settings.
+        """
+        self.data = dict( version = PARTIAL_VERSION,
+                          configs = configs,
+                          sampling = sampling,
+                          shard = shard,
+                          lanes = [] )
+
+        # Round-trip via JSON so that loaded settings compare equal, eg. tuples become lists.
+        self.data = json.loads(json.dumps(self.data, sort_keys=True))
+
+    @property
+    def configs(self):
+        return self.data['configs']
+
+    @property
+    def sampling(self):
+        return self.data['sampling']
+
+    @property
+    def lanes(self):
+        """ A list of dicts, each with 'lane', 'tiles' (every tile the lane
+            should have), 'population' (the tiles that were sampled from, when
+            sampling) and 'stats' (a dict of tile stats for each configuration).
+        """
+        return self.data['lanes']
+
+    def get_lane(self, lane):
+        for l in self.lanes:
+            if l['lane'] == lane:
+                return l
+        return None
+
+    def add_lane(self, lane, tiles, population=None):
+        """ Records the tiles the whole lane should have, including those
+            done in other shards.
+        """
+        assert self.get_lane(lane) is None, "Lane %s added twice" % lane
+        self.lanes.append(dict( lane = lane,
+                                tiles = list(tiles),
+                                population = list(population or tiles),
+                                stats = [ dict() for c in self.configs ] ))
+
+    def add_tile(self, lane, tile, all_ts):
+        """ Adds the tile_stats() for each configuration.
+        """
+        for stats, ts in zip(self.get_lane(lane)['stats'], all_ts):
+            stats[str(tile)] = ts
+
+    def save(self, filename):
+        tmp_file = "%s.%i.tmp" % (filename, os.getpid())
+        with open(tmp_file, 'w') as fh:
+            json.dump(self.data, fh, sort_keys=True)
+        os.replace(tmp_file, filename)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as fh:
+            data = json.load(fh)
+        if data.get('version') != PARTIAL_VERSION:
+            raise ValueError("%s is not a version %i partial result" % (filename, PARTIAL_VERSION))
+
+        res = cls(data['configs'], data['sampling'], data['shard'])
+        res.data['lanes'] = data['lanes']
+        return res
+
+def merge_partials(partials):
+    """ Combines a list of PartialResult objects into one, checking that they
+        were made with the same settings and that no tile is missing.
+        Raises ValueError if not.
+    """
+    if not partials:
+        raise ValueError("No partial results to merge")
+
+    merged = PartialResult(partials[0].configs, partials[0].sampling)
+    for part in partials:
+        if part.configs != merged.configs or part.sampling != merged.sampling:
+            raise ValueError("Partial results for shard %s were made with different settings" % part.data['shard'])
+
+        for pl in part.lanes:
+            ml = merged.get_lane(pl['lane'])
+            if ml is None:
+                merged.add_lane(pl['lane'], [], pl['population'])
+                ml = merged.lanes[-1]
+            elif pl['population'] != ml['population']:
+                raise ValueError("Partial results for lane %s disagree on the tiles in the lane" % pl['lane'])
+
+            # With --shard every partial has the full list.  With explicit
+            # tile lists each has its own.
+            ml['tiles'] = sorted(set(ml['tiles']) | set(pl['tiles']))
+
+            for mstats, pstats in zip(ml['stats'], pl['stats']):
+                for tile, ts in pstats.items():
+                    if mstats.setdefault(tile, ts) != ts:
+                        raise ValueError("Partial results for tile %s in lane %s disagree" % (tile, pl['lane']))
+
+    for ml in merged.lanes:
+        for stats in ml['stats']:
+            missing = [ t for t in ml['tiles'] if t not in stats ]
+            if missing:
+                raise ValueError("No results for tile(s) %s in lane %s" % (','.join(missing), ml['lane']))
+    return merged
@@ -0,0 +1,100 @@
+#!python3
+"""
+Reading ahead, so the network filesystem and the CPU are kept busy at once.
+
+Reading a tile means fetching one file per cycle and then inflating and
+decoding it.  Done strictly in turn, the CPU sits idle while each file is
+fetched and the disk sits idle while it is decoded.  A ReadAhead runs the
+fetching in a background thread and hands the results over through a queue.
+The queue is bounded, so once it has depth results waiting the fetcher stops
+and waits, which caps the memory used however slow the decoding is.
+
+Only the fetching goes in the background.  Inflating still happens in the
+calling thread, so the inflater's buffer is not shared between threads.
+
+Synopsis:
+
+   with ReadAhead(read_file, filenames, depth=8) as ra:
+       for filename, data in ra:
+           ...inflate and decode data...
+"""
+
+import queue
+import threading
+
+from profiling import NO_PROFILE
+
+# How many fetched items may be waiting.  For a HiSeq 4000 tile that is about
+# 1.5MB each.
+DEFAULT_DEPTH = 8
+
+# Marks the end of the items in the queue
+_END = object()
+
+class ReadAhead:
+
+    def __init__(self, fetch, items, depth=DEFAULT_DEPTH, profile=NO_PROFILE):
+        """ Starts calling fetch(item) for each item in turn, in a background
+            thread.  Time spent waiting for results is recorded under the phase
+            'wait' in profile.
+        """
+        self.items = list(items)
+        self.profile = profile
+        self._queue = queue.Queue(maxsize=max(1, depth))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(fetch,), daemon=True)
+        self._thread.start()
+
+    def _put(self, res):
+        """ Blocks while the queue is full, unless we are told to stop.
+            Returns False if we were.
+        """
+        while not self._stop.is_set():
+            try:
+                self._queue.put(res, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self, fetch):
+        for item in self.items:
+            if self._stop.is_set():
+                return
+            try:
+                res = (item, fetch(item), None)
+            except BaseException as e:
+                # Hand the error over to be raised in the calling thread
+                res = (item, None, e)
+            if not self._put(res) or res[2] is not None:
+                return
+        self._put((_END, None, None))
+
+    def __iter__(self):
+        """ Yields (item, result) in the original order.
+        """
+        while True:
+            with self.profile.phase('wait'):
+                item, value, exc = self._queue.get()
+            if item is _END:
+                return
+            if exc is not None:
+                raise exc
+            yield item, value
+
+    def close(self):
+        """ Stops the fetching early, and waits for the thread to finish.
+        """
+        self._stop.set()
+        try:
+            while True:
+                self._queue.get_nowait()
+        except queue.Empty:
+            pass
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
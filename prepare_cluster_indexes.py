@@ -11,6 +11,7 @@ import random
 import sys
 import struct
 import math
+from array import array
 # from dump_slocs import yield_coords
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 
@@ -22,6 +23,13 @@ DEF_SEED = 13
 
 DEF_SAMPLE_SIZE = 2500
 
+# For --bands, the fraction of all the wells in the tile that the bands cover
+DEF_BAND_FRACTION = 0.1
+
+# The tile is divided into COVERAGE_GRID x COVERAGE_GRID cells for the
+# spatial coverage figure.
+COVERAGE_GRID = 10
+
 
 def get_random_array(r_max, r_l, seed):
     if seed:
@@ -29,6 +37,59 @@ def get_random_array(r_max, r_l, seed):
     ra = random.sample(range(r_max),r_l)
     return ra
 
+def get_band_array(r_max, r_l, seed, bands, band_fraction=DEF_BAND_FRACTION, span=1.0):
+    """ Like get_random_array but only picks wells from a number of bands, each a
+        run of consecutive well indices.  The wells are numbered along the rows
+        of the tile, so each band is a strip across it.
+        The bands between them cover band_fraction of the wells, and are spaced
+        evenly over the first span of the wells in the tile.  With span < 1 a
+        reader can stop inflating each cycle file part way through.
+    """
+    if seed:
+        random.seed(seed)
+    slice_size = r_max * span / bands
+    width = min( int(r_max * band_fraction / bands), int(slice_size) )
+
+    candidates = []
+    for b in range(bands):
+        start = int(b * slice_size + (slice_size - width) / 2)
+        candidates.extend(range(start, start + width))
+
+    if len(candidates) < r_l:
+        raise ValueError("The bands only hold %i wells, not enough for %i targets" % (len(candidates), r_l))
+    return random.sample(candidates, r_l)
+
+def sampling_report(slocs_fh, max_clusters, coord_dict, grid=COVERAGE_GRID):
+    """ Says what the targets in coord_dict will cost to read and how well they
+        cover the tile.  Returns a dict with:
+          inflate_fraction - the fraction of each cycle file that must be inflated
+                             to get to the last well needed by any target
+          coverage - the fraction of the cells in a grid x grid division of the
+                     tile that hold at least one target centre, out of those that
+                     hold any wells at all
+    """
+    last_well = max( max([key] + [ w for l in levs for w in l ]) for key, levs in coord_dict.items() )
+
+    slocs_fh.seek(12)
+    locs = array('f', slocs_fh.read(max_clusters * 8))
+    if sys.byteorder != 'little':
+        locs.byteswap()
+    xs, ys = locs[0::2], locs[1::2]
+    min_x, min_y = min(xs), min(ys)
+    cell_w = (max(xs) - min_x) / grid or 1
+    cell_h = (max(ys) - min_y) / grid or 1
+
+    def cell(n):
+        return ( min(int((xs[n] - min_x) / cell_w), grid - 1),
+                 min(int((ys[n] - min_y) / cell_h), grid - 1) )
+
+    # Every 16th well is plenty to see which cells have any wells in them
+    all_cells = set(cell(n) for n in range(0, max_clusters, 16))
+    target_cells = set(cell(n) for n in coord_dict)
+
+    return dict( inflate_fraction = (last_well + 1) / max_clusters,
+                 coverage = len(target_cells) / len(all_cells) )
+
 def get_distance(x1, y1, x2, y2):
 
     dist = math.sqrt((x2-x1)**2+(y2-y1)**2)
@@ -93,6 +154,15 @@ def parse_args():
                         help="Seed for the random read selection")
     parser.add_argument("-n", "--sample_size", dest="sample_size", type=int, default=DEF_SAMPLE_SIZE,
                         help="number of n random clusters")
+    parser.add_argument("--bands", type=int,
+                        help="Only pick clusters from this many strips across the tile, rather than from" +
+                             " anywhere. This makes the reads cheaper if used with --span.")
+    parser.add_argument("--band-fraction", type=float, default=DEF_BAND_FRACTION,
+                        help="Fraction of the wells in the tile covered by all the --bands together.")
+    parser.add_argument("--span", type=float, default=1.0,
+                        help="Spread the --bands over just this fraction of the tile, from the start of" +
+                             " the well numbering. Reading then stops after this fraction of each file," +
+                             " at the expense of leaving part of the tile unsampled.")
 
     return parser.parse_args()
 
@@ -140,7 +210,11 @@ def main():
     # generate random list depending on MAX_CLUSTERS and sample_size
     # default sequencer is hiseq_4000
 
-    random_sample = get_random_array(MAX_CLUSTERS, args.sample_size, args.seed)
+    if args.bands:
+        random_sample = get_band_array( MAX_CLUSTERS, args.sample_size, args.seed,
+                                        args.bands, args.band_fraction, args.span )
+    else:
+        random_sample = get_random_array(MAX_CLUSTERS, args.sample_size, args.seed)
 
     log(random_sample)
 
@@ -166,7 +240,13 @@ def main():
         for l in coord_dict[key]:
             print(",".join( map(str,l) ))
 
+    # So you can see what the sampling costs in I/O and what it gains in coverage
+    report = sampling_report(slocs_fh, MAX_CLUSTERS, coord_dict)
+    log("Fraction of each file to inflate: %.3f" % report['inflate_fraction'])
+    log("Spatial coverage (%ix%i grid): %.3f" % (COVERAGE_GRID, COVERAGE_GRID, report['coverage']))
+
     slocs_fh.close()
 
 
-main()
+if __name__ == '__main__':
+    main()
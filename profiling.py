@@ -0,0 +1,119 @@
+#!python3
+"""
+Timers and counters for working out where the time goes when counting well
+duplicates.  The BCL reader and the counting loop record time spent in named
+phases (reading files, inflating, decoding, comparing...) along with counts of
+bytes read, bytes inflated, comparisons made and so on.
+
+When profiling is off, code is handed NO_PROFILE which does nothing, so the
+only overhead is an empty 'with' block per phase.  Phases are only ever timed
+per file or per tile, never per well.
+
+Synopsis:
+
+   prof = Profile()
+   with prof.phase('inflate'):
+       data = gzip.decompress(zdata)
+   prof.count('bytes_inflated', len(data))
+
+   write_record(sys.stderr, prof.as_dict(lane=1, tile='1101'))
+"""
+
+import sys
+import json
+import time
+import resource
+from contextlib import nullcontext
+from collections import defaultdict
+
+def peak_rss_kb():
+    """Peak resident set size of this process so far.  Note that on Linux
+       ru_maxrss is in kilobytes but on a Mac it is in bytes.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+class Profile:
+    """Accumulates wall time, CPU time and call counts per phase, plus any
+       number of named counters.
+    """
+    enabled = True
+
+    def __init__(self):
+        self.wall = defaultdict(float)
+        self.cpu = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def add(self, other):
+        """Adds the totals from another Profile into this one, eg. to make
+           a lane total from the tiles.
+        """
+        for name in other.calls:
+            self.wall[name] += other.wall[name]
+            self.cpu[name] += other.cpu[name]
+            self.calls[name] += other.calls[name]
+        for name, n in other.counters.items():
+            self.counters[name] += n
+
+    def as_dict(self, **extra):
+        res = dict(extra)
+        res['phases'] = { name: dict( wall = round(self.wall[name], 6),
+                                      cpu = round(self.cpu[name], 6),
+                                      calls = self.calls[name] )
+                          for name in sorted(self.calls) }
+        res['counters'] = dict(sorted(self.counters.items()))
+        res['peak_rss_kb'] = peak_rss_kb()
+        return res
+
+class _Phase:
+    """Context manager returned by Profile.phase()
+    """
+    __slots__ = ['prof', 'name', 'wall', 'cpu']
+
+    def __init__(self, prof, name):
+        self.prof = prof
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        prof = self.prof
+        prof.wall[self.name] += time.perf_counter() - self.wall
+        prof.cpu[self.name] += time.process_time() - self.cpu
+        prof.calls[self.name] += 1
+
+class NullProfile:
+    """Stands in for a Profile when profiling is off.
+    """
+    enabled = False
+    _null_phase = nullcontext()
+
+    def phase(self, name):
+        return self._null_phase
+
+    def count(self, name, n=1):
+        pass
+
+    def add(self, other):
+        pass
+
+NO_PROFILE = NullProfile()
+
+def write_record(fh, record):
+    """Writes one record as a line of JSON and flushes, so the output can be
+       watched as it is produced.
+    """
+    print(json.dumps(record, sort_keys=True), file=fh)
+    fh.flush()
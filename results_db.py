@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+"""
+An SQLite database of well duplicate results, so that trends over many runs
+can be looked at without finding and parsing thousands of report files.
+
+count_well_duplicates.py --results-db FILE adds each lane as it is done, and
+'results_db.py import' loads old reports (the {n}targets_lane{N}.txt files,
+in text or JSON format) so the history can be filled in.
+
+There are three tables:
+
+  * runs         - run name, date, instrument and flowcell
+  * results      - one row per lane (with tile 'all') or tile, for each set
+                   of parameters, with the number of targets and the overall
+                   and Picard-equivalent duplication
+  * level_stats  - the wells, dups, hits, acco and acci for each level of
+                   each row in results
+
+Adding the same run, lane, tile and parameters again replaces the old row.
+Reports imported from text do not say what edit distance and cycles were
+used, so these are left NULL.  The run date, instrument and flowcell come
+from the run name (eg. 150715_K00169_0016_BH3FGFBBXX) unless they are given.
+
+Synopsis:
+
+   results_db.py import welldups.sqlite /path/to/runqc/WellDuplicates/*
+   results_db.py lanes welldups.sqlite --instrument K00169 --since 2017-01-01
+   results_db.py instruments welldups.sqlite --since 2017-01-01
+
+or from Python:
+
+   with ResultsDB('welldups.sqlite') as db:
+       for row in db.lane_results(instrument='K00169', sample_size=2500):
+           print(row['run'], row['lane'], row['picard_v1'])
+"""
+__AUTHORS__ = ['Tim Booth']
+__VERSION__ = 0.1
+
+import os, sys, re
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+from count_well_duplicates import STAT_KEYS, picard_estimates
+
+# Bump this if the schema changes
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE runs (
+    run_id      INTEGER PRIMARY KEY,
+    run         TEXT NOT NULL UNIQUE,
+    run_date    TEXT,
+    instrument  TEXT,
+    flowcell    TEXT
+);
+CREATE INDEX runs_instrument ON runs (instrument, run_date);
+CREATE INDEX runs_date ON runs (run_date);
+CREATE INDEX runs_flowcell ON runs (flowcell);
+
+CREATE TABLE results (
+    result_id     INTEGER PRIMARY KEY,
+    run_id        INTEGER NOT NULL REFERENCES runs (run_id),
+    lane          TEXT NOT NULL,
+    tile          TEXT NOT NULL,
+    sample_size   INTEGER NOT NULL,
+    levels        INTEGER NOT NULL,
+    edit_distance INTEGER,
+    hamming       INTEGER,
+    cycles        TEXT,
+    tile_count    INTEGER NOT NULL,
+    targets       INTEGER NOT NULL,
+    overall       REAL NOT NULL,
+    picard_v1     REAL NOT NULL,
+    picard_v2     REAL NOT NULL,
+    source        TEXT,
+    added         TEXT NOT NULL
+);
+CREATE UNIQUE INDEX results_key ON results ( run_id, lane, tile, sample_size, levels,
+                                             ifnull(edit_distance, -1), ifnull(hamming, -1),
+                                             ifnull(cycles, '') );
+
+CREATE TABLE level_stats (
+    result_id  INTEGER NOT NULL REFERENCES results (result_id) ON DELETE CASCADE,
+    level      INTEGER NOT NULL,
+    wells      INTEGER NOT NULL,
+    dups       INTEGER NOT NULL,
+    hits       INTEGER NOT NULL,
+    acco       INTEGER NOT NULL,
+    acci       INTEGER NOT NULL,
+    PRIMARY KEY (result_id, level)
+);
+"""
+
+def parse_run_name(run):
+    """ Gets (run_date, instrument, flowcell) from a run name like
+        150715_K00169_0016_BH3FGFBBXX, with None for anything not found.
+    """
+    amatch = re.match(r'^(\d\d)(\d\d)(\d\d)_([^_]+)_\d+_[AB]?([^_]+)$', run)
+    if not amatch:
+        return None, None, None
+    return ( '20%s-%s-%s' % amatch.group(1, 2, 3), amatch.group(4), amatch.group(5) )
+
+def format_cycles(cycles):
+    """ The inverse of count_well_duplicates.parse_cycles()
+    """
+    return ','.join( '%i-%i' % (s, e) for s, e in cycles )
+
+class ResultsDB:
+
+    def __init__(self, filename):
+        """ Opens the database, creating it if need be.
+        """
+        self.filename = filename
+        self.conn = sqlite3.connect(filename)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA foreign_keys = ON")
+
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version == 0:
+            with self.conn:
+                self.conn.executescript(SCHEMA)
+                self.conn.execute("PRAGMA user_version = %i" % SCHEMA_VERSION)
+        elif version != SCHEMA_VERSION:
+            raise RuntimeError("%s has schema version %i, not %i" % (filename, version, SCHEMA_VERSION))
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add_run(self, run, run_date=None, instrument=None, flowcell=None):
+        """ Adds the run if it is not there, or fills in any details given.
+            Returns the run_id.
+        """
+        guess = parse_run_name(run)
+        run_date, instrument, flowcell = [ a or g for a, g in zip([run_date, instrument, flowcell], guess) ]
+
+        with self.conn:
+            self.conn.execute( "INSERT OR IGNORE INTO runs (run) VALUES (?)", (run,) )
+            self.conn.execute( "UPDATE runs SET run_date = ifnull(?, run_date), instrument = ifnull(?, instrument)," +
+                               " flowcell = ifnull(?, flowcell) WHERE run = ?",
+                               (run_date, instrument, flowcell, run) )
+        return self.conn.execute("SELECT run_id FROM runs WHERE run = ?", (run,)).fetchone()[0]
+
+    def add_lane(self, run, lane, stats, sample_size, params=None, source=None):
+        """ Adds the results for a lane, as from LaneAggregator.stats(), with
+            a row for the lane and one for each of stats['tiles'].  params
+            may have edit_distance, hamming and cycles.  Returns the number
+            of rows added.
+        """
+        run_id = self.add_run(run)
+        params = params or dict()
+        rows = [ ('all', stats, stats['tile_count']) ]
+        rows.extend( (str(ts['tile']), ts, 1) for ts in stats.get('tiles') or [] )
+
+        with self.conn:
+            for tile, ts, tile_count in rows:
+                self._add_row(run_id, str(lane), tile, ts, tile_count, stats['levels'], sample_size, params, source)
+        return len(rows)
+
+    def _add_row(self, run_id, lane, tile, ts, tile_count, levels, sample_size, params, source):
+        key = dict( run_id = run_id, lane = lane, tile = tile, sample_size = sample_size, levels = levels,
+                    edit_distance = params.get('edit_distance'),
+                    hamming = None if params.get('hamming') is None else int(params['hamming']),
+                    cycles = params.get('cycles') )
+
+        # Remove any old row for the same thing, and its level_stats
+        self.conn.execute( "DELETE FROM results WHERE run_id = :run_id AND lane = :lane AND tile = :tile" +
+                           " AND sample_size = :sample_size AND levels = :levels" +
+                           " AND edit_distance IS :edit_distance AND hamming IS :hamming AND cycles IS :cycles",
+                           key )
+
+        estimates = picard_estimates(ts['targets'], ts['dups'], ts['acci'])
+        row = dict( key, tile_count = tile_count, targets = ts['targets'], source = source,
+                    added = time.strftime('%Y-%m-%d %H:%M:%S'), **estimates )
+        cursor = self.conn.execute( "INSERT INTO results (%s) VALUES (%s)" % (
+                                        ', '.join(row), ', '.join(':' + k for k in row) ), row )
+        self.conn.executemany( "INSERT INTO level_stats (result_id, level, %s) VALUES (?, ?, %s)" % (
+                                    ', '.join(STAT_KEYS), ', '.join('?' for k in STAT_KEYS) ),
+                               [ [cursor.lastrowid, lev+1] + [ ts[k][lev] for k in STAT_KEYS ]
+                                 for lev in range(levels) ] )
+
+    def lane_results(self, run=None, instrument=None, flowcell=None, since=None, until=None,
+                     sample_size=None, lane=None, level=1):
+        """ Returns the lane totals matching all of the arguments given, in
+            order of run date, as a list of dicts.  since and until are dates
+            as 'YYYY-MM-DD', inclusive.  The figures for the given level are
+            added as dups, wells, acci etc.
+        """
+        where, args = self._filters( run=run, instrument=instrument, flowcell=flowcell,
+                                     since=since, until=until, sample_size=sample_size, lane=lane )
+        sql = ( "SELECT runs.run, runs.run_date, runs.instrument, runs.flowcell, results.lane," +
+                " results.sample_size, results.levels, results.edit_distance, results.hamming, results.cycles," +
+                " results.tile_count, results.targets, results.overall, results.picard_v1, results.picard_v2," +
+                " level_stats.level, %s" % ', '.join('level_stats.' + k for k in STAT_KEYS) +
+                " FROM results JOIN runs USING (run_id)" +
+                " LEFT JOIN level_stats ON level_stats.result_id = results.result_id AND level_stats.level = ?" +
+                " WHERE results.tile = 'all'" + ''.join(' AND ' + w for w in where) +
+                " ORDER BY runs.run_date, runs.run, results.lane" )
+        return [ dict(r) for r in self.conn.execute(sql, [level] + args) ]
+
+    def tile_results(self, run, lane, sample_size=None, level=1):
+        """ Returns the results for each tile in the lane, in order of tile.
+        """
+        where, args = self._filters(run=run, lane=lane, sample_size=sample_size)
+        sql = ( "SELECT results.tile, results.edit_distance, results.hamming, results.cycles, results.targets, results.overall, results.picard_v1, results.picard_v2," +
+                " %s" % ', '.join('level_stats.' + k for k in STAT_KEYS) +
+                " FROM results JOIN runs USING (run_id)" +
+                " JOIN level_stats ON level_stats.result_id = results.result_id AND level_stats.level = ?" +
+                " WHERE results.tile != 'all'" + ''.join(' AND ' + w for w in where) +
+                " ORDER BY results.tile" )
+        return [ dict(r) for r in self.conn.execute(sql, [level] + args) ]
+
+    def instrument_summary(self, since=None, until=None, sample_size=None):
+        """ Returns the number of runs and lanes and the mean and highest
+            duplication for each instrument, as a list of dicts.
+        """
+        where, args = self._filters(since=since, until=until, sample_size=sample_size)
+        sql = ( "SELECT runs.instrument, count(DISTINCT runs.run_id) AS runs, count(*) AS lanes," +
+                " min(runs.run_date) AS first_run, max(runs.run_date) AS last_run," +
+                " avg(results.overall) AS mean_overall, max(results.overall) AS max_overall," +
+                " avg(results.picard_v1) AS mean_picard_v1, max(results.picard_v1) AS max_picard_v1" +
+                " FROM results JOIN runs USING (run_id)" +
+                " WHERE results.tile = 'all'" + ''.join(' AND ' + w for w in where) +
+                " GROUP BY runs.instrument ORDER BY runs.instrument" )
+        return [ dict(r) for r in self.conn.execute(sql, args) ]
+
+    def _filters(self, **kwargs):
+        """ Turns the query arguments into SQL conditions.
+        """
+        columns = dict( run = "runs.run = ?", instrument = "runs.instrument = ?", flowcell = "runs.flowcell = ?",
+                        since = "runs.run_date >= ?", until = "runs.run_date <= ?",
+                        sample_size = "results.sample_size = ?", lane = "results.lane = ?" )
+        where, args = [], []
+        for k, v in kwargs.items():
+            if v is not None:
+                where.append(columns[k])
+                args.append(str(v) if k == 'lane' else v)
+        return where, args
+
+def parse_report(lines):
+    """ Reads a report from count_well_duplicates.py, in text or JSON format.
+        Returns a list of (lane, sample_size, stats) for each lane, with stats
+        as from LaneAggregator.stats(), including any tiles that were reported.
+        The estimates are worked out again from the numbers.
+    """
+    lanes = OrderedDict()
+    current = None
+
+    def new_lane(lane):
+        return lanes.setdefault(lane, dict( sample_size = None, summary = None, tiles = [] ))
+
+    for line in lines:
+        line = line.rstrip('\n')
+
+        if line.startswith('{'):
+            res = json.loads(line)
+            lane = new_lane(str(res['lane']))
+            lane['sample_size'] = res['sample_size']
+            lane['summary'] = res
+            lane['tiles'] = res.get('tiles', [])
+            continue
+
+        amatch = re.match(r'^Lane: (\S+)\tTile: (\S+)\tTargets: (\d+)/(\d+)', line)
+        if amatch:
+            lane = new_lane(amatch.group(1))
+            lane['sample_size'] = int(amatch.group(4))
+            current = dict( tile = amatch.group(2), targets = int(amatch.group(3)), **{ k: [] for k in STAT_KEYS } )
+            lane['tiles'].append(current)
+            continue
+
+        amatch = re.match(r'^LaneSummary: (\S+)\tTiles: (\d+)\tTargets: (\d+)/(\d+)', line)
+        if amatch:
+            lane = new_lane(amatch.group(1))
+            tile_count = int(amatch.group(2))
+            if tile_count:
+                lane['sample_size'] = int(amatch.group(4)) // tile_count
+            current = dict( tile_count = tile_count, targets = int(amatch.group(3)), **{ k: [] for k in STAT_KEYS } )
+            lane['summary'] = current
+            continue
+
+        if line.startswith('Level: ') and current is not None:
+            # Drop the fractions in the summary lines
+            fields = dict( f.split(': ') for f in re.sub(r' \([^)]*\)', '', line).split('\t') if f )
+            for k, heading in zip(STAT_KEYS, ['Wells', 'Dups', 'Hit', 'AccO', 'AccI']):
+                current[k].append(int(fields[heading]))
+            continue
+
+        # Anything else, such as the estimates or ==> filename <== lines from
+        # the all_lanes files, ends the block.
+        current = None
+
+    res = []
+    for lane_id, lane in lanes.items():
+        stats = lane['summary']
+        if stats is None:
+            # No summary, so add up the tiles
+            stats = dict( tile_count = len(lane['tiles']),
+                          targets = sum(ts['targets'] for ts in lane['tiles']) )
+            for k in STAT_KEYS:
+                stats[k] = [ sum(c) for c in zip(*(ts[k] for ts in lane['tiles'])) ]
+        stats = dict( stats, levels = len(stats['wells']), tiles = lane['tiles'] )
+        stats.update(picard_estimates(stats['targets'], stats['dups'], stats['acci']))
+        res.append((lane_id, lane['sample_size'], stats))
+    return res
+
+def find_reports(paths):
+    """ Yields the report files in or under the given paths.  Files are
+        taken as they are, and directories are searched for
+        {n}targets_lane{N}.txt files.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for f in sorted(filenames):
+                if re.match(r'^\d+targets_lane\d+\.(txt|json)$', f):
+                    yield os.path.join(dirpath, f)
+
+def import_report(db, filename, run=None):
+    """ Loads one report file into the database.  The run is named after the
+        directory the file is in, unless given, and if that directory has a
+        datadir link to the run (as the Snakefiles make) the instrument and
+        flowcell are taken from its RunInfo.xml.  Returns the number of rows
+        added.
+    """
+    run_dir = os.path.dirname(os.path.abspath(filename))
+    run = run or os.path.basename(run_dir)
+
+    run_info = os.path.join(run_dir, 'datadir', 'RunInfo.xml')
+    if os.path.exists(run_info):
+        from run_layout import RunLayout
+        layout = RunLayout(os.path.join(run_dir, 'datadir'))
+        db.add_run( run, run_date = parse_run_name(layout.run_id or '')[0],
+                    instrument = layout.instrument, flowcell = layout.flowcell )
+
+    with open(filename) as fh:
+        lanes = parse_report(fh)
+
+    rows = 0
+    for lane, sample_size, stats in lanes:
+        # The file name says the sample size if the report does not
+        if sample_size is None:
+            amatch = re.match(r'^(\d+)targets', os.path.basename(filename))
+            sample_size = int(amatch.group(1)) if amatch else 0
+        rows += db.add_lane(run, lane, stats, sample_size, source=os.path.abspath(filename))
+    return rows
+
+def print_table(rows, out=None):
+    """ Prints a list of dicts as TSV.
+    """
+    if not rows:
+        return
+    print(*rows[0].keys(), sep='\t', file=out)
+    for row in rows:
+        print(*( '' if v is None else '%.6f' % v if isinstance(v, float) else v for v in row.values() ),
+              sep='\t', file=out)
+
+def main():
+    args = parse_args()
+
+    with ResultsDB(args.db) as db:
+        if args.command == 'import':
+            for filename in find_reports(args.paths):
+                try:
+                    rows = import_report(db, filename)
+                    print("%s: %i rows" % (filename, rows), file=sys.stderr)
+                except Exception as e:
+                    # Carry on with the rest
+                    print("%s: %s" % (filename, e), file=sys.stderr)
+        elif args.command == 'lanes':
+            print_table(db.lane_results( run = args.run, instrument = args.instrument, flowcell = args.flowcell,
+                                         since = args.since, until = args.until,
+                                         sample_size = args.sample_size, level = args.level ))
+        elif args.command == 'tiles':
+            print_table(db.tile_results(args.run, args.lane, sample_size=args.sample_size, level=args.level))
+        elif args.command == 'instruments':
+            print_table(db.instrument_summary(since=args.since, until=args.until, sample_size=args.sample_size))
+
+def parse_args():
+    description = """Keeps the results of count_well_duplicates.py in an SQLite database
+    for looking at trends across runs and instruments.
+    """
+    parser = ArgumentParser(description=description, formatter_class=ArgumentDefaultsHelpFormatter)
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+
+    imp = sub.add_parser('import', help="Load report files, or all the reports under some directories.")
+    imp.add_argument('db')
+    imp.add_argument('paths', nargs='+')
+
+    lanes = sub.add_parser('lanes', help="List the results for each lane.")
+    lanes.add_argument('db')
+    lanes.add_argument('--run')
+    lanes.add_argument('--instrument')
+    lanes.add_argument('--flowcell')
+
+    tiles = sub.add_parser('tiles', help="List the results for each tile in a lane.")
+    tiles.add_argument('db')
+    tiles.add_argument('run')
+    tiles.add_argument('lane')
+
+    inst = sub.add_parser('instruments', help="Summarise the results for each instrument.")
+    inst.add_argument('db')
+
+    for p in [lanes, tiles, inst]:
+        p.add_argument('-n', '--sample_size', type=int,
+                       help="Only results for this sample size.")
+    for p in [lanes, inst]:
+        p.add_argument('--since', help="First run date, as YYYY-MM-DD.")
+        p.add_argument('--until', help="Last run date, as YYYY-MM-DD.")
+    for p in [lanes, tiles]:
+        p.add_argument('-l', '--level', type=int, default=1,
+                       help="Which level to give the figures for.")
+
+    parser.add_argument("--version", action="version", version=str(__VERSION__))
+
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    main()
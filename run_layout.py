@@ -0,0 +1,218 @@
+#!python3
+"""
+Where everything is in a run folder, worked out once per run rather than once
+per tile.
+
+RunInfo.xml gives the lanes, the tiles and the number of cycles in each read.
+The BaseCalls directory for a lane is listed once, the first time that lane is
+wanted, to find the .filter files and the cycle directories.  Each cycle
+directory is likewise listed once, when first needed, and this also tells us
+what format (.bcl.gz, plain .bcl or .cbcl) that cycle is in.  Before this, every
+tile did its own listdir() of the lane and tried opening each possible file on
+every cycle, which on Lustre or Isilon adds up to a lot of round trips.
+
+If there is no RunInfo.xml the lanes and tiles are taken from the directory
+listings instead.
+
+Synopsis:
+
+   layout = RunLayout("/your/run/dir")
+   for lane in layout.lanes:
+       for tile in layout.tiles(lane):
+           fmt, path = layout.lane(lane).cycle_file(tile, 0)
+"""
+
+import os, re
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+
+def lane_number(lane):
+    """ Lanes may be given as 1, '1' or 'L001'
+    """
+    return int(str(lane).lstrip('L'))
+
+def parse_cycles(spec):
+    """ Converts a --cycles setting like "20-45,65-90" into a list of (start, end) tuples.
+    """
+    #Minimal validation - user will get cryptic messages on bad values
+    return [ (int(s), int(e)) for r in spec.split(',') for s, e in (r.split('-'),) ]
+
+def filter_tiles(tiles, tile_id):
+    """ Picks out the tiles matching the comma-separated patterns in tile_id, checking
+        that each pattern matches something.
+    """
+    filtered_tiles = []
+    for tpat in tile_id.split(','):
+        t_match = [t for t in tiles if re.match('^'+tpat+'$', t)]
+        assert t_match, "%s matches no tile identifiers in this run" % tpat
+        filtered_tiles.extend(t_match)
+    return sorted(set(filtered_tiles))
+
+class RunLayout:
+
+    def __init__(self, location="."):
+        self.location = location
+        self.basecalls_dir = os.path.join(location, "Data", "Intensities", "BaseCalls")
+
+        self.run_id = None
+        self.instrument = None
+        self.flowcell = None
+        self.read_cycles = []
+        self._run_tiles = OrderedDict()
+        self._lane_dirs = None
+        self._lanes = dict()
+
+        run_info = os.path.join(location, "RunInfo.xml")
+        if os.path.exists(run_info):
+            self._parse_run_info(run_info)
+
+    def _parse_run_info(self, filename):
+        root = ET.parse(filename).getroot()
+        run = root.find("Run")
+
+        self.run_id = run.get("Id")
+        self.instrument = run.findtext("Instrument")
+        self.flowcell = run.findtext("Flowcell")
+        self.read_cycles = [ int(r.get("NumCycles")) for r in run.findall("Reads/Read") ]
+
+        # Newer RunInfo.xml files list every tile as LANE_TILE.  Note they are
+        # not in order.
+        for te in run.findall(".//Tiles/Tile"):
+            lane, tile = te.text.split('_')
+            self._run_tiles.setdefault(int(lane), []).append(tile)
+
+        # Older ones just give the shape of the flowcell.
+        fl = run.find("FlowcellLayout")
+        if not self._run_tiles and fl is not None:
+            tiles = [ "%i%i%02i" % (surface, swath, tile)
+                      for surface in range(1, int(fl.get("SurfaceCount")) + 1)
+                      for swath in range(1, int(fl.get("SwathCount")) + 1)
+                      for tile in range(1, int(fl.get("TileCount")) + 1) ]
+            for lane in range(1, int(fl.get("LaneCount")) + 1):
+                self._run_tiles[lane] = tiles
+
+        for lane in self._run_tiles:
+            self._run_tiles[lane] = sorted(self._run_tiles[lane])
+
+    @property
+    def lane_dirs(self):
+        """ Names of the lane directories under BaseCalls, eg. ['L001', 'L002']
+        """
+        if self._lane_dirs is None:
+            self._lane_dirs = sorted( d for d in os.listdir(self.basecalls_dir)
+                                      if re.match(r'L\d\d\d$', d) )
+        return self._lane_dirs
+
+    @property
+    def lanes(self):
+        """ Lane numbers, from RunInfo.xml if possible.
+        """
+        if self._run_tiles:
+            return list(self._run_tiles)
+        return [ lane_number(d) for d in self.lane_dirs ]
+
+    def tiles(self, lane):
+        """ Tile names for the lane, in order, from RunInfo.xml if possible.
+        """
+        if self._run_tiles:
+            return self._run_tiles.get(lane_number(lane), [])
+        return self.lane(lane).tiles()
+
+    @property
+    def last_tile(self):
+        """ The highest tile number, as wanted by count_well_duplicates.py --stype
+        """
+        return max( t for lane in self.lanes for t in self.tiles(lane) )
+
+    def lane(self, lane):
+        """ Gets the LaneLayout for a lane, scanning the directory the first time.
+        """
+        lane = lane_number(lane)
+        if lane not in self._lanes:
+            self._lanes[lane] = LaneLayout(os.path.join(self.basecalls_dir, 'L%03i' % lane))
+        return self._lanes[lane]
+
+class LaneLayout:
+    """ The files in one lane's BaseCalls directory.
+
+        The listings are kept, but if a file is not found the directory is
+        listed again before giving up, so that a long-lived layout (as in
+        WellDupCounter or dup_server.py) sees files written since.
+    """
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.name = os.path.basename(os.path.normpath(data_dir))
+        self._cycle_listings = dict()
+        self._scan_lane()
+
+    def _scan_lane(self):
+        # Map each tile to the prefix for its files, which is taken from the
+        # .filter file (eg. s_1_1101.filter -> s_1_1101) as on some machines
+        # the BCL and filter files live side by side in the lane directory.
+        self.prefixes = dict()
+        self.filter_files = dict()
+        cycles = []
+        for f in os.listdir(self.data_dir):
+            amatch = re.match(r'(.+_(\d+))\.filter$', f)
+            if amatch:
+                self.prefixes[amatch.group(2)] = amatch.group(1)
+                self.filter_files[amatch.group(2)] = os.path.join(self.data_dir, f)
+                continue
+            amatch = re.match(r'C(\d+)\.1$', f)
+            if amatch:
+                cycles.append(int(amatch.group(1)))
+
+        # Should be 308 for HiSeq 4000
+        self.num_cycles = len(cycles)
+
+    def tiles(self):
+        return sorted(self.filter_files)
+
+    def filter_file(self, tile):
+        if str(tile) not in self.filter_files:
+            self._scan_lane()
+        try:
+            return self.filter_files[str(tile)]
+        except KeyError:
+            raise RuntimeError("Cannot find a .filter file for tile %s" % tile)
+
+    def cbcl_filename(self, tile):
+        """ The CBCL filename is in the format "L00{lane}_{surface}", where the
+            surface is the first digit of the tile name.
+        """
+        return "%s_%s.cbcl" % (self.name, str(tile)[0])
+
+    def cycle_listing(self, cycle, refresh=False):
+        """ The set of files in the directory for a cycle (counting from 0).
+            This is listed just once, unless refresh is set.
+        """
+        if refresh or cycle not in self._cycle_listings:
+            cycle_dir = os.path.join(self.data_dir, 'C%i.1' % (cycle + 1))
+            self._cycle_listings[cycle] = frozenset(os.listdir(cycle_dir))
+        return self._cycle_listings[cycle]
+
+    def cycle_file(self, tile, cycle):
+        """ Finds the data for the tile on a cycle (counting from 0).  Returns a
+            tuple (format, path) where format is 'bcl.gz', 'bcl' or 'cbcl'.  The
+            format is decided for each cycle separately, as a run may have a
+            mixture.
+        """
+        self.filter_file(tile)
+        prefix = self.prefixes[str(tile)]
+        candidates = [ ('bcl.gz', prefix + '.bcl.gz'),
+                       ('bcl',    prefix + '.bcl'),
+                       ('cbcl',   self.cbcl_filename(tile)) ]
+
+        # If the run is still being written the file may have turned up since
+        # the directory was listed, so look again before giving up.
+        for refresh in [False, True]:
+            listing = self.cycle_listing(cycle, refresh=refresh)
+            for fmt, filename in candidates:
+                if filename in listing:
+                    return fmt, os.path.join(self.data_dir, 'C%i.1' % (cycle + 1), filename)
+
+        raise FileNotFoundError( "No .bcl.gz, .bcl or .cbcl file for tile %s in %s" %
+                                 (tile, os.path.join(self.data_dir, 'C%i.1' % (cycle + 1))) )
+
+    def cycle_format(self, tile, cycle):
+        return self.cycle_file(tile, cycle)[0]
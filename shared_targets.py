@@ -0,0 +1,193 @@
+#!python3
+"""
+A read-only copy of the targets that any number of worker processes can use
+without each having its own.
+
+An AllTargets holds a Target object and some lists for every target, plus a
+dict of every well, which for 100k targets comes to hundreds of MB.  With the
+default fork start method on Linux the workers inherit this without any
+pickling, but as each worker goes through the targets the reference counts
+are updated, so the pages holding them get copied one by one and each worker
+ends up with most of a copy of its own.  With the spawn or forkserver methods
+(the default on macOS, and in newer Pythons) the whole lot would be pickled to
+every worker.  Either way the memory goes up with the number of workers.
+
+SharedTargets.export() writes the targets once into a file as flat arrays:
+
+  * starts - where each level of each target begins in wells, with the
+             centre as level 0, so target t level l is
+             wells[starts[t*levels + l] : starts[t*levels + l + 1]]
+  * wells  - the well indices of every target, in order
+  * unique - every well index needed, sorted, ready to pass to get_seqs()
+
+and memory-maps it.  By default the file goes in /dev/shm, so it is really in
+shared memory.  Pickling a SharedTargets only passes the filename, and
+unpickling maps the same file, so starting a worker costs nothing and all the
+workers share the one copy.  The arrays are memoryviews on the mapping, so
+looking up a target does not copy anything.
+
+The objects yielded on iteration behave like Target objects as far as the
+counting code is concerned.
+
+Synopsis:
+
+   with SharedTargets.export(load_targets('targets.list')) as targets:
+       pool = Pool(8, initializer=..., initargs=(targets,))
+       ...
+"""
+
+import os
+import mmap
+import struct
+import weakref
+import tempfile
+from array import array
+
+MAGIC = b'WDTARG01'
+
+# Magic, number of targets, levels, total wells, unique wells, padded to keep
+# the arrays aligned.
+HEADER = struct.Struct('<8sqqqq')
+HEADER_SIZE = 64
+
+# The arrays are all 32-bit, which is plenty for well numbers
+ITEM = 'i'
+
+def default_directory():
+    """ /dev/shm if there is one, else the usual temporary directory.
+    """
+    return '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+class SharedTargets:
+
+    def __init__(self, filename, owner=False):
+        """ Maps a file made by export().  If owner is True, the file is
+            removed by close(), or at exit if close() is never called.
+        """
+        self.filename = filename
+        self.owner = owner
+        self._remove = weakref.finalize(self, _remove_file, filename) if owner else None
+
+        with open(filename, 'rb') as fh:
+            self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self._n, self.levels, n_wells, n_unique = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            self._mmap.close()
+            raise ValueError("%s is not a shared targets file" % filename)
+
+        itemsize = array(ITEM).itemsize
+        sizes = [ self._n * self.levels + 1, n_wells, n_unique ]
+        self._views = []
+        pos = HEADER_SIZE
+        for size in sizes:
+            view = memoryview(self._mmap)[pos:pos + size * itemsize]
+            self._views.append(view)
+            self._views.append(view.cast(ITEM))
+            pos += size * itemsize
+        self._starts, self._wells, self._unique = self._views[1::2]
+
+    @classmethod
+    def export(cls, targets, directory=None):
+        """ Writes targets (an AllTargets) to a new file and maps it.  The file
+            is removed when the returned object is closed.
+        """
+        levels = targets.levels or 0
+        starts = array(ITEM, [0])
+        wells = array(ITEM)
+        for target in targets:
+            for level in range(levels):
+                wells.extend(target.get_indices(level))
+                starts.append(len(wells))
+        unique = array(ITEM, sorted(set(wells)))
+
+        fd, filename = tempfile.mkstemp(prefix='welldup_targets_', suffix='.bin',
+                                        dir=directory or default_directory())
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(HEADER.pack(MAGIC, len(targets), levels, len(wells), len(unique)).ljust(HEADER_SIZE, b'\0'))
+                for a in [starts, wells, unique]:
+                    a.tofile(fh)
+
+            return cls(filename, owner=True)
+        except BaseException:
+            # Don't leave a half-written file in /dev/shm, eg. if it is full
+            _remove_file(filename)
+            raise
+
+    def __getstate__(self):
+        # Only the filename goes over to the worker, which never owns the file
+        return dict(filename=self.filename)
+
+    def __setstate__(self, state):
+        self.__init__(state['filename'])
+
+    def __len__(self):
+        return self._n
+
+    def __iter__(self):
+        return ( SharedTarget(self, n) for n in range(self._n) )
+
+    def get_target(self, n):
+        return SharedTarget(self, n)
+
+    def _level(self, n, level):
+        i = n * self.levels + level
+        return self._wells[self._starts[i]:self._starts[i + 1]]
+
+    def get_all_indices(self, level=None):
+        """ As for AllTargets.  With no level, this is the list of wells
+            worked out when the file was written.
+        """
+        if level is None:
+            return self._unique
+        return [ w for n in range(self._n) for w in self._level(n, level) ]
+
+    def close(self):
+        """ Unmaps the file, and removes it if we made it.  Any target
+            indices still held by the caller keep the mapping alive until they
+            are dropped.
+        """
+        if self._mmap is None:
+            return
+        for view in reversed(self._views):
+            view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass
+        self._mmap = None
+        if self._remove:
+            self._remove()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _remove_file(filename):
+    try:
+        os.unlink(filename)
+    except FileNotFoundError:
+        pass
+
+class SharedTarget:
+    """ One target in a SharedTargets, with the same methods as a Target.
+    """
+    __slots__ = ('_targets', '_n')
+
+    def __init__(self, targets, n):
+        self._targets = targets
+        self._n = n
+
+    def get_indices(self, level=None):
+        if level is None:
+            return [ w for l in range(self._targets.levels) for w in self._targets._level(self._n, l) ]
+        return self._targets._level(self._n, level)
+
+    def get_centre(self):
+        return self._targets._level(self._n, 0)[0]
+
+    def get_levels(self):
+        return self._targets.levels
@@ -0,0 +1,257 @@
+#!python3
+"""
+A cache of cycle file data on a local disk, so that running several analyses
+on the same run (different sample sizes, re-runs after failures...) doesn't
+keep going back to the shared sequencer filesystem for the same bytes.
+
+What is cached is exactly the byte ranges that get read: the whole of a
+.bcl.gz file, but only the block for the tiles wanted from a .cbcl file.  Each
+range is stored as one file in the cache directory, named by a hash of the
+source path, offset and length, with a line of JSON at the top saying where it
+came from.  Ranges smaller than min_bytes (16K by default), such as the CBCL
+headers and tile offsets, are read straight from the source, since a cache
+file and its checks for every few bytes would cost more than they save.
+
+A cached range is only used if:
+
+  * the source file still has the same size and modification time
+  * the data still has the CRC32 recorded when it was saved
+
+otherwise it is thrown away and read again.  When the cache grows beyond its
+size limit the least recently used ranges are removed (using the file
+modification time, which is updated on every hit) until it is back under 90%
+of the limit.  Files are written under a temporary name and then renamed, so
+several processes can share one cache directory.
+
+Plain uncompressed .bcl files are memory-mapped rather than read, so they are
+not staged.
+
+Synopsis:
+
+   cache = StagingCache('/tmp/welldup_stage', max_bytes=parse_size('50G'))
+   with cache.open('/seqdata/run/.../s_1_1101.bcl.gz') as fh:
+       data = fh.read()
+"""
+
+import os
+import re
+import json
+import zlib
+import threading
+from hashlib import sha1
+
+from profiling import NO_PROFILE
+
+# Bump this if the format of the cache files changes
+STAGE_VERSION = 1
+
+# Reads smaller than this are not staged
+MIN_STAGE_BYTES = 16 * 1024
+
+# Evict down to this fraction of max_bytes, so we don't evict on every write
+LOW_WATER = 0.9
+
+SIZE_UNITS = dict(K=1024, M=1024**2, G=1024**3, T=1024**4)
+
+def parse_size(size):
+    """ Converts eg. '500M' or '2G' or '1000' to a number of bytes.
+    """
+    amatch = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$', str(size), re.IGNORECASE)
+    if not amatch:
+        raise ValueError("Cannot understand size %r" % size)
+    return int(float(amatch.group(1)) * SIZE_UNITS.get(amatch.group(2).upper(), 1))
+
+class StagingCache:
+
+    def __init__(self, directory, max_bytes, min_bytes=MIN_STAGE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_bytes = min_bytes
+        self._lock = threading.RLock()
+
+        os.makedirs(directory, exist_ok=True)
+        self.total_bytes = sum(size for path, size, mtime in self._entries())
+
+    def _entries(self):
+        """ Yields (path, size, mtime) for everything in the cache.
+        """
+        for f in os.listdir(self.directory):
+            if f.endswith('.stage'):
+                path = os.path.join(self.directory, f)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    # Another process got rid of it
+                    continue
+                yield path, st.st_size, st.st_mtime
+
+    def entry_filename(self, source, offset, length):
+        key = "%s\0%s\0%s" % (source, offset, length)
+        return os.path.join(self.directory, sha1(key.encode()).hexdigest() + '.stage')
+
+    def open(self, path, profile=NO_PROFILE):
+        """ Returns a read-only file-like object for path.  Every read() on it
+            is served from the cache if possible.
+        """
+        return StagedFile(self, path, profile)
+
+    def source_info(self, path):
+        """ The real path and os.stat() of a source file.
+        """
+        source = os.path.realpath(path)
+        return source, os.stat(source)
+
+    def read(self, path, offset=0, length=None, profile=NO_PROFILE, source_info=None):
+        """ Reads length bytes (or to the end if length is None) from offset
+            in path, using the cache if possible.
+            source_info saves looking up the source file again, if you already
+            have it from source_info().  Less than min_bytes is just read from
+            the source.
+        """
+        source, st = source_info or self.source_info(path)
+        if self.is_small(st, offset, length):
+            profile.count('stage_skipped')
+            with open(source, 'rb') as fh:
+                fh.seek(offset)
+                return fh.read(-1 if length is None else length)
+
+        meta = dict( version = STAGE_VERSION,
+                     source = source,
+                     offset = offset,
+                     length = length,
+                     size = st.st_size,
+                     mtime_ns = st.st_mtime_ns )
+        entry = self.entry_filename(source, offset, length)
+
+        data = self._load(entry, meta)
+        if data is not None:
+            profile.count('stage_hits')
+            profile.count('bytes_from_stage', len(data))
+            return data
+
+        profile.count('stage_misses')
+        with open(source, 'rb') as fh:
+            fh.seek(offset)
+            data = fh.read(-1 if length is None else length)
+
+        self._save(entry, meta, data)
+        return data
+
+    def is_small(self, st, offset, length):
+        """ True if the range is too small to be worth staging.
+        """
+        return (st.st_size - offset if length is None else length) < self.min_bytes
+
+    def _load(self, entry, meta):
+        """ Returns the cached data, or None if it is missing or not valid.
+        """
+        try:
+            with open(entry, 'rb') as fh:
+                saved = json.loads(fh.readline().decode())
+                data = fh.read()
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            saved, data = None, None
+
+        if ( saved is None or
+             dict((k, saved.get(k)) for k in meta) != meta or
+             saved.get('crc32') != zlib.crc32(data) ):
+            # Stale or damaged, so get rid of it.
+            self._remove(entry)
+            return None
+
+        # Mark it as recently used
+        try:
+            os.utime(entry)
+        except FileNotFoundError:
+            pass
+        return data
+
+    def _save(self, entry, meta, data):
+        header = json.dumps(dict(meta, crc32=zlib.crc32(data)), sort_keys=True).encode() + b'\n'
+        size = len(header) + len(data)
+        if size > self.max_bytes:
+            return
+
+        tmp_file = "%s.%i.%i.tmp" % (entry, os.getpid(), threading.get_ident())
+        with open(tmp_file, 'wb') as fh:
+            fh.write(header)
+            fh.write(data)
+        os.replace(tmp_file, entry)
+
+        with self._lock:
+            self.total_bytes += size
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def _remove(self, entry):
+        try:
+            size = os.stat(entry).st_size
+            os.unlink(entry)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self.total_bytes -= size
+
+    def evict(self, target=None):
+        """ Removes the least recently used entries until the cache is no bigger
+            than target, which defaults to LOW_WATER * max_bytes.  The total is
+            re-counted first as other processes may be using the cache.
+        """
+        if target is None:
+            target = self.max_bytes * LOW_WATER
+
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        self.total_bytes = sum(size for path, size, mtime in entries)
+        for path, size, mtime in entries:
+            if self.total_bytes <= target:
+                break
+            self._remove(path)
+
+class StagedFile:
+    """ Just enough of a file object for the BCL reader.
+    """
+    def __init__(self, cache, path, profile=NO_PROFILE):
+        self.cache = cache
+        self.path = path
+        self.profile = profile
+        self.pos = 0
+        # Opened for the first small read, and kept for the rest
+        self._fh = None
+
+        # The source is only checked once, however many reads there are.
+        self.source_info = cache.source_info(path)
+
+    def read(self, size=-1):
+        length = None if size is None or size < 0 else size
+        if self.cache.is_small(self.source_info[1], self.pos, length):
+            self.profile.count('stage_skipped')
+            if not self._fh:
+                self._fh = open(self.source_info[0], 'rb')
+            self._fh.seek(self.pos)
+            data = self._fh.read(-1 if length is None else length)
+        else:
+            data = self.cache.read( self.path, self.pos, length,
+                                    profile = self.profile, source_info = self.source_info )
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        assert whence == os.SEEK_SET
+        self.pos = offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if self._fh:
+            self._fh.close()
+            self._fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
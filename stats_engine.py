@@ -0,0 +1,103 @@
+#!python3
+"""
+Array versions of the calculations behind count_well_duplicates.output_writer,
+using numpy.  The results are exactly the same as the pure Python code, which
+is still used if numpy is not installed.
+
+The counts for a tile are held as two (targets x levels) integer arrays,
+tally and length, so:
+
+   wells = length summed over targets
+   dups  = tally summed over targets
+   hits  = (tally > 0) summed over targets
+   acco  = (tally > 0) or-accumulated from level 1 outwards, then summed
+   acci  = (tally > 0) or-accumulated from the outer level inwards, then summed
+
+For a whole lane the arrays are (tiles x targets x levels), with tiles that
+have fewer valid targets padded out with zeros.  A padded target has no wells
+and no dups so it adds nothing to any of the sums, but the real number of
+targets per tile has to be kept separately.
+"""
+
+from itertools import chain
+
+import numpy as np
+
+STAT_KEYS = ['wells', 'dups', 'hits', 'acco', 'acci']
+
+def tile_arrays(tile_counts, levels):
+    """ Converts the list of [ (TALLY, LENGTH), ... ] per target, as returned by
+        count_tile_dups(), into a pair of (targets x levels) arrays.
+    """
+    if not tile_counts:
+        return np.zeros((0, levels), dtype=np.int64), np.zeros((0, levels), dtype=np.int64)
+
+    # np.fromiter on the flattened values is a lot quicker than np.array on the nested lists
+    width = len(tile_counts[0])
+    counts = np.fromiter( chain.from_iterable(chain.from_iterable(tile_counts)),
+                          dtype = np.int64,
+                          count = len(tile_counts) * width * 2 ).reshape(len(tile_counts), width, 2)
+    return counts[:, :levels, 0], counts[:, :levels, 1]
+
+def lane_arrays(lane_dupl, levels):
+    """ Makes dense (tiles x targets x levels) tally and length arrays for the
+        whole lane.  Returns (tiles, n_targets, tally, length) where tiles is
+        the sorted list of tile names and n_targets the number of real targets
+        in each.
+    """
+    tiles = sorted(lane_dupl.keys())
+    n_targets = np.array([ len(lane_dupl[t]) for t in tiles ], dtype=np.int64)
+    max_targets = int(n_targets.max()) if len(tiles) else 0
+
+    tally = np.zeros((len(tiles), max_targets, levels), dtype=np.int64)
+    length = np.zeros((len(tiles), max_targets, levels), dtype=np.int64)
+    for n, tile in enumerate(tiles):
+        t_tally, t_length = tile_arrays(lane_dupl[tile], levels)
+        tally[n, :len(t_tally)] = t_tally
+        length[n, :len(t_length)] = t_length
+
+    return tiles, n_targets, tally, length
+
+def reduce_counts(tally, length):
+    """ Does the sums over the targets axis, which is the second-last axis, so
+        this works on one tile or on a whole lane.  Returns a dict of arrays.
+    """
+    hit = tally > 0
+    return dict( wells = length.sum(axis=-2),
+                 dups = tally.sum(axis=-2),
+                 hits = hit.sum(axis=-2),
+                 acco = np.logical_or.accumulate(hit, axis=-1).sum(axis=-2),
+                 acci = np.logical_or.accumulate(hit[..., ::-1], axis=-1)[..., ::-1].sum(axis=-2) )
+
+def tile_stats(tile_counts, levels):
+    """ Same as count_well_duplicates.tile_stats()
+    """
+    sums = reduce_counts(*tile_arrays(tile_counts, levels))
+
+    res = dict(targets = len(tile_counts))
+    for k in STAT_KEYS:
+        res[k] = sums[k].tolist()
+    return res
+
+def lane_stats(lane_dupl, levels):
+    """ Returns the per-tile stats and lane totals in the same form as
+        LaneAggregator.stats(), apart from the Picard estimates which are
+        left to the caller.
+    """
+    tiles, n_targets, tally, length = lane_arrays(lane_dupl, levels)
+    sums = reduce_counts(tally, length)
+
+    res = dict( levels = levels,
+                tile_count = len(tiles),
+                tiles = [],
+                targets = int(n_targets.sum()) )
+    for k in STAT_KEYS:
+        res[k] = sums[k].sum(axis=0).tolist() if len(tiles) else [0] * levels
+
+    for n, tile in enumerate(tiles):
+        ts = dict(tile=tile, targets=int(n_targets[n]))
+        for k in STAT_KEYS:
+            ts[k] = sums[k][n].tolist()
+        res['tiles'].append(ts)
+
+    return res
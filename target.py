@@ -1,6 +1,7 @@
 #!python3
 
-from itertools import chain
+from itertools import chain, islice
+from hashlib import sha1
 from collections import defaultdict
 
 def load_targets(filename, levels=None, limit=None):
@@ -97,6 +98,17 @@ class AllTargets:
             #Scan all targets and flatten the list (standard Python-ism)
             return [ y for x in self for y in x.get_indices(level) ]
 
+    def fingerprint(self, limit=None, levels=None):
+        """Returns a hex digest that identifies exactly this set of targets,
+           in this order, so results from different runs of the script can be
+           checked for compatibility.  limit and levels work as for load_targets,
+           so you can fingerprint just the subset that would have been loaded.
+        """
+        h = sha1()
+        for target in islice(self, limit):
+            h.update(repr(target.coords[:levels]).encode())
+        return h.hexdigest()
+
     def get_from_index(self, index):
 
         res = []
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import tempfile
+import unittest
+
+try:
+    sys.path.insert(0,'.')
+    from checkpoint import TileCheckpoints
+except:
+    #If this fails, you is probably running the tests wrongly
+    print("****",
+          "You want to run these tests from the top-level source folder by using:",
+          "  python3 -m unittest test.test_checkpoint",
+          "or even",
+          "  python3 -m unittest discover",
+          "****",
+          sep="\n")
+    raise
+
+TILE_STATS = dict( targets = 4,
+                   wells = [24, 44, 60],
+                   dups = [5, 3, 1],
+                   hits = [2, 3, 1],
+                   acco = [2, 3, 3],
+                   acci = [3, 3, 1] )
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.ckdir = os.path.join(self.tmpdir.name, 'ck')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_save_load(self):
+        ckpt = TileCheckpoints(self.ckdir, run='/some/run', levels=3, cycles=[(20, 70)])
+
+        self.assertIsNone(ckpt.load(1, 1101))
+        ckpt.save(1, 1101, TILE_STATS)
+
+        # Only the one file, with no temp file left over
+        self.assertEqual(len(os.listdir(self.ckdir)), 1)
+
+        # A new object with the same settings sees the checkpoint, even with
+        # the lane as a string.
+        ckpt2 = TileCheckpoints(self.ckdir, run='/some/run', levels=3, cycles=[(20, 70)])
+        self.assertEqual(ckpt2.load('1', '1101'), TILE_STATS)
+        self.assertIsNone(ckpt2.load(2, 1101))
+        self.assertIsNone(ckpt2.load(1, 1102))
+
+    def test_key_mismatch(self):
+        TileCheckpoints(self.ckdir, run='/some/run', levels=3).save(1, 1101, TILE_STATS)
+
+        self.assertIsNone(TileCheckpoints(self.ckdir, run='/some/run', levels=2).load(1, 1101))
+        self.assertIsNone(TileCheckpoints(self.ckdir, run='/other/run', levels=3).load(1, 1101))
+
+    def test_corrupt(self):
+        ckpt = TileCheckpoints(self.ckdir, run='/some/run', levels=3)
+        ckpt.save(1, 1101, TILE_STATS)
+
+        with open(ckpt.filename(1, 1101), 'r+') as fh:
+            fh.truncate(20)
+
+        self.assertIsNone(ckpt.load(1, 1101))
+
+if __name__ == '__main__':
+    unittest.main()
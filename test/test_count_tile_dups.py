@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import sys
+import tempfile
+import unittest
+
+try:
+    sys.path.insert(0,'.')
+    import Levenshtein
+    import count_well_duplicates
+    from count_well_duplicates import ( count_tile_dups, count_tile_dups_multi,
+                                        CountConfig, parse_config, read_tile_seqs, QUAL_FLAG )
+    from profiling import Profile
+    from make_synthetic_run import make_run, write_targets
+    from bcl_direct_reader import BCLReader
+    from target import load_targets
+except:
+    #If this fails, you is probably running the tests wrongly
+    print("****",
+          "You want to run these tests from the top-level source folder by using:",
+          "  python3 -m unittest test.test_count_tile_dups",
+          "or even",
+          "  python3 -m unittest discover",
+          "****",
+          sep="\n")
+    raise
+
+ROWS, COLS, CYCLES = 40, 100, 30
+
+class TestCountTileDups(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        count_well_duplicates.log = lambda *a: None
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            make_run( tmpdir + '/run', surfaces=1, swaths=1, tiles=1,
+                      rows=ROWS, cols=COLS, cycles=CYCLES, dup_rates=(0.05, 0.03, 0.02) )
+            write_targets(tmpdir + '/targets.list', ROWS, COLS, 200, levels=4)
+
+            cls.targets = load_targets(tmpdir + '/targets.list')
+            tile = BCLReader(tmpdir + '/run').get_tile(1, 1101)
+            cls.seq_objs = [ tile.get_seqs(cls.targets.get_all_indices(), 1, CYCLES) ]
+
+            # And just the wells of the targets whose centre passed
+            cls.profile = Profile()
+            tile = BCLReader(tmpdir + '/run').get_tile(1, 1101, profile=cls.profile)
+            cls.pruned_seq_objs = read_tile_seqs(tile, cls.targets, [(1, CYCLES)])
+
+    def test_parse_config(self):
+        base = CountConfig(None, 2, False, 3, 2500)
+
+        self.assertEqual(parse_config('e1:e=1', base), CountConfig('e1', 1, False, 3, 2500))
+        self.assertEqual(parse_config('big:n=10000,l=5,hamming', base), CountConfig('big', 2, True, 5, 10000))
+        self.assertEqual(parse_config('same', base), base._replace(name='same'))
+        self.assertRaises(AssertionError, parse_config, 'x:q=1', base)
+        self.assertRaises(AssertionError, parse_config, 'bad/name:e=1', base)
+
+    def test_multi_matches_single(self):
+        configs = [ CountConfig('main', 2, False, 4, 200),
+                    CountConfig('any', CYCLES, False, 4, 200),
+                    CountConfig('ham', 3, True, 2, 200),
+                    CountConfig('n50', 2, False, 3, 50) ]
+
+        multi = count_tile_dups_multi(self.targets, self.seq_objs, configs)
+
+        for c, res in zip(configs, multi):
+            sub_targets = list(self.targets)[:c.sample_size]
+            single = count_tile_dups( sub_targets, self.seq_objs, c.level, c.edit_distance,
+                                      Levenshtein.hamming if c.hamming else Levenshtein.distance )
+            self.assertEqual(res, single, c.name)
+
+        # Make sure the test is meaningful. The planted dups are exact copies but with
+        # a threshold of the read length everything is a dup.
+        self.assertNotEqual(multi[0], multi[1])
+        self.assertEqual(multi[1][0][0], (6, 6))
+        self.assertGreater(sum(t[0][0] for t in multi[0]), 0)
+
+    def test_beyond_sample(self):
+        # Targets past every sample size are not looked at, so their
+        # sequences may as well be missing
+        class Unread:
+            def __getitem__(self, i):
+                if i != QUAL_FLAG:
+                    raise AssertionError("Sequence read for a target beyond the sample")
+                return True
+        configs = [ CountConfig('n50', 2, False, 3, 50), CountConfig('n20', 1, True, 2, 20) ]
+        seq_objs = [ { w: Unread() for t in self.targets for w in t.get_indices() } ]
+        seq_objs[0].update( (w, self.seq_objs[0][w]) for t in list(self.targets)[:50]
+                                                     for w in t.get_indices() )
+
+        got = count_tile_dups_multi(self.targets, seq_objs, configs)
+        self.assertEqual(got, count_tile_dups_multi(list(self.targets)[:50], self.seq_objs, configs))
+
+    def test_pruned_matches_full(self):
+        configs = [ CountConfig('main', 2, False, 4, 200), CountConfig('n50', 1, True, 2, 50) ]
+
+        self.assertEqual( count_tile_dups_multi(self.targets, self.pruned_seq_objs, configs),
+                          count_tile_dups_multi(self.targets, self.seq_objs, configs) )
+
+        # Some centres failed, so only the wells of the other targets were read
+        passed = [ t for t in self.targets if self.seq_objs[0][t.get_centre()][QUAL_FLAG] ]
+        self.assertLess(len(passed), len(self.targets))
+        self.assertEqual( set(self.pruned_seq_objs[0]), set(w for t in passed for w in t.get_indices()) )
+
+        pruned = len(self.seq_objs[0]) - len(self.pruned_seq_objs[0])
+        self.assertGreater(pruned, 0)
+        self.assertEqual(self.profile.counters['wells_pruned'], pruned)
+        self.assertEqual(self.profile.counters['wells_requested'], len(self.pruned_seq_objs[0]))
+
+if __name__ == '__main__':
+    unittest.main()
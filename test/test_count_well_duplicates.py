@@ -3,11 +3,13 @@
 import sys
 import re
 import io
+import json
 import unittest
 from unittest.mock import patch
 
 try:
-    from count_well_duplicates import output_writer, TALLY, LENGTH
+    from count_well_duplicates import output_writer, lane_stats, LaneAggregator, TALLY, LENGTH
+    from count_well_duplicates import stype_tiles, filter_tiles
 except:
     #If this fails, you is probably running the tests wrongly
     print("****",
@@ -50,6 +52,10 @@ LaneSummary: 1   Tiles: 1   Targets: 4/4
 Level: 1   Wells: 24   Dups: 5 (0.20833)   Hit: 2 (0.50000)   AccO: 2 (0.50000)   AccI: 3 (0.75000)
 Level: 2   Wells: 44   Dups: 3 (0.06818)   Hit: 3 (0.75000)   AccO: 3 (0.75000)   AccI: 3 (0.75000)
 Level: 3   Wells: 60   Dups: 1 (0.01667)   Hit: 1 (0.25000)   AccO: 3 (0.75000)   AccI: 1 (0.25000)
+
+Overall duplication (Acc/Targets): 75.00%
+Picard-equivalent duplication v1:  56.25%
+Picard-equivalent duplication v2:  62.50%
 """
 
 BAD_TILE_LANE = {'1209':  [ ] }  #No valid targets.
@@ -70,6 +76,10 @@ LaneSummary: 1   Tiles: 2   Targets: 4/8
 Level: 1   Wells: 24   Dups: 5 (0.20833)   Hit: 2 (0.50000)   AccO: 2 (0.50000)   AccI: 3 (0.75000)
 Level: 2   Wells: 44   Dups: 3 (0.06818)   Hit: 3 (0.75000)   AccO: 3 (0.75000)   AccI: 3 (0.75000)
 Level: 3   Wells: 60   Dups: 1 (0.01667)   Hit: 1 (0.25000)   AccO: 3 (0.75000)   AccI: 1 (0.25000)
+
+Overall duplication (Acc/Targets): 75.00%
+Picard-equivalent duplication v1:  56.25%
+Picard-equivalent duplication v2:  62.50%
 """
 
 # If we just ask for 2 levels?
@@ -82,12 +92,20 @@ Level: 2   Wells: 44   Dups: 3   Hit: 3   AccO: 3   AccI: 3
 LaneSummary: 1   Tiles: 1   Targets: 4/4
 Level: 1   Wells: 24   Dups: 5 (0.20833)   Hit: 2 (0.50000)   AccO: 2 (0.50000)   AccI: 3 (0.75000)
 Level: 2   Wells: 44   Dups: 3 (0.06818)   Hit: 3 (0.75000)   AccO: 3 (0.75000)   AccI: 3 (0.75000)
+
+Overall duplication (Acc/Targets): 75.00%
+Picard-equivalent duplication v1:  54.55%
+Picard-equivalent duplication v2:  60.94%
 """
 
 # Empty output when the lane is totally bad and no targets are read at all.
 EXPECTED_OUT_4 = """
 Lane: 1   Tile: 1222   Targets: 0/4
 LaneSummary: 1   Tiles: 1   Targets: 0/4
+
+Overall duplication (Acc/Targets): 0.00%
+Picard-equivalent duplication v1:  0.00%
+Picard-equivalent duplication v2:  0.00%
 """
 
 class TestCountWellDuplicates(unittest.TestCase):
@@ -112,8 +130,8 @@ class TestCountWellDuplicates(unittest.TestCase):
 
         output_writer(1, 4, BAD_TILE_LANE, verbose=0)
 
-        #Basically we expect to see just the last 4 lines
-        self._rescmp(mock_stdout, EXPECTED_OUT_2, -4)
+        #Basically we expect to see just the last 8 lines
+        self._rescmp(mock_stdout, EXPECTED_OUT_2, -8)
 
     @patch('sys.stdout', new_callable=io.StringIO)
     def test_output_writer_limited_levels(self, mock_stdout):
@@ -131,6 +149,74 @@ class TestCountWellDuplicates(unittest.TestCase):
 
         self._rescmp(mock_stdout, EXPECTED_OUT_4)
 
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_output_writer_json(self, mock_stdout):
+
+        output_writer(1, 4, BAD_TILE_LANE, verbose=1, fmt='json')
+        res = json.loads(mock_stdout.getvalue())
+
+        self.assertEqual(res['lane'], 1)
+        self.assertEqual(res['targets'], 4)
+        self.assertEqual([ t['tile'] for t in res['tiles'] ], ['1208', '1209'])
+        self.assertEqual(res['tiles'][1]['wells'], [0, 0, 0])
+        self.assertEqual(res['wells'], [24, 44, 60])
+        self.assertEqual(res['dups'], [5, 3, 1])
+        self.assertEqual(res['hits'], [2, 3, 1])
+        self.assertEqual(res['acco'], [2, 3, 3])
+        self.assertEqual(res['acci'], [3, 3, 1])
+        self.assertAlmostEqual(res['overall'], 0.75)
+        self.assertAlmostEqual(res['picard_v1'], 0.5625)
+        self.assertAlmostEqual(res['picard_v2'], 0.625)
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_output_writer_tsv(self, mock_stdout):
+
+        output_writer(1, 4, LANE_DUPL, verbose=1, fmt='tsv')
+        output_writer(2, 4, LANE_DUPL, verbose=0, fmt='tsv', header=False)
+        rows = [ l.split("\t") for l in mock_stdout.getvalue().rstrip("\n").split("\n") ]
+
+        self.assertEqual(rows[0][:4], ['lane', 'tile', 'level', 'targets'])
+        #Header plus 3 levels for the tile then 3 for each lane summary
+        self.assertEqual(len(rows), 1 + 3 + 3 + 3)
+        self.assertEqual(rows[1], ['1', '1208', '1', '4', '24', '5', '2', '2', '3', '', '', ''])
+        self.assertEqual(rows[4], ['1', 'all', '1', '4', '24', '5', '2', '2', '3',
+                                   '0.750000', '0.562500', '0.625000'])
+        self.assertEqual(rows[4][1:], rows[7][1:])
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_lane_aggregator(self, mock_stdout):
+
+        agg = LaneAggregator(1, 4, 3, verbose=1)
+        agg.add_tile('1208', LANE_DUPL['1208'])
+
+        #The tile is reported straight away
+        self._rescmp(mock_stdout, EXPECTED_OUT_2, 0, 4)
+
+        agg.add_tile('1209', [])
+        agg.finish()
+
+        self._rescmp(mock_stdout, EXPECTED_OUT_2)
+
+    def test_no_dups(self):
+
+        #This used to give a divide-by-zero error
+        res = lane_stats({'1101': [ [ (0, 6), (0, 12) ] ] * 3 })
+        self.assertEqual(res['wells'], [18, 36])
+        self.assertEqual(res['picard_v1'], 0.0)
+
+    def test_stype_tiles(self):
+
+        tiles = stype_tiles('hiseq_4000')
+        self.assertEqual(len(tiles), 112)
+        self.assertEqual(tiles[:2], ['1101', '1102'])
+        self.assertEqual(tiles[-1], '2228')
+        self.assertEqual(len(stype_tiles('2478')), 624)
+
+        self.assertEqual(filter_tiles(tiles, '1.0[1-3],22..'), ['1101', '1102', '1103', '1201', '1202', '1203'] +
+                                                                 tiles[-28:])
+        with self.assertRaises(AssertionError):
+            filter_tiles(tiles, '3...')
+
     def _rescmp(self, ioobj, astring, start=0, end=None):
         """This just helps you to compare the thing that got printed
            out with the string that holds the expected result.
@@ -140,8 +226,8 @@ class TestCountWellDuplicates(unittest.TestCase):
         lines1 = ioobj.getvalue().rstrip("\n").split("\n")
 
         #The string we expected, ignoring leading newline
-        #and swapping consecutive spaces for tabs.
-        lines2 = [ re.sub('\s\s+', '\t', s) for s in astring.lstrip().rstrip("\n").split("\n") ]
+        #and swapping runs of 3 or more spaces for tabs.
+        lines2 = [ re.sub('\s\s\s+', '\t', s) for s in astring.lstrip().rstrip("\n").split("\n") ]
         lines2 = lines2[start:end]
 
         #And now we can compare!
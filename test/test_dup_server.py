@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import socket
+import tempfile
+import threading
+import unittest
+import unittest.mock
+from urllib.request import urlopen
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+
+try:
+    sys.path.insert(0,'.')
+    from make_synthetic_run import make_run, write_targets
+    from bcl_direct_reader import BCLReader
+    from count_well_duplicates import WellDupCounter, CountConfig
+    from dup_server import DupService, LRUCache, make_server
+except:
+    #If this fails, you is probably running the tests wrongly
+    print("****",
+          "You want to run these tests from the top-level source folder by using:",
+          "  python3 -m unittest test.test_dup_server",
+          "or even",
+          "  python3 -m unittest discover",
+          "****",
+          sep="\n")
+    raise
+
+ROWS, COLS, CYCLES = 30, 60, 20
+
+class TestDupServer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.run_dir = os.path.join(cls.tmpdir.name, 'run')
+        make_run(cls.run_dir, surfaces=1, swaths=1, tiles=2, rows=ROWS, cols=COLS, cycles=CYCLES)
+        cls.targets_file = os.path.join(cls.tmpdir.name, 'targets.list')
+        write_targets(cls.targets_file, ROWS, COLS, 100, levels=4)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def setUp(self):
+        for name in ['dup_server.log', 'count_well_duplicates.log']:
+            patcher = unittest.mock.patch(name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def start_server(self, **kwargs):
+        server = make_server(DupService(), **kwargs)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        def stop():
+            server.shutdown()
+            thread.join()
+            server.server_close()
+        self.addCleanup(stop)
+        return server
+
+    def query(self, server, path, **params):
+        url = 'http://localhost:%i%s?%s' % (server.server_port, path, urlencode(params))
+        with urlopen(url) as resp:
+            return json.load(resp)
+
+    def expected(self, config, cycles):
+        with WellDupCounter(self.run_dir, self.targets_file, config, cycles=cycles) as counter:
+            return [ dict(lane=r.lane, sample_size=min(100, config.sample_size), **r.stats[0])
+                     for r in counter.run() ]
+
+    def test_lru(self):
+        cache = LRUCache(2)
+        for k in [1, 2, 1, 3, 1, 2]:
+            cache.get(k, lambda: k * 10)
+        self.assertEqual(list(cache.items.items()), [(1, 10), (2, 20)])
+        self.assertEqual(cache.status(), dict(size=2, maxsize=2, hits=2, misses=4))
+
+    def test_count(self):
+        server = self.start_server(port=0)
+        query = dict(run=self.run_dir, targets=self.targets_file, cycles='0-10,12-20', tiles=1)
+
+        res = self.query(server, '/count', l=3, n=100, **query)
+        self.assertEqual(res['lanes'], self.expected(CountConfig(None, 2, False, 3, 100), [(0, 10), (12, 20)]))
+
+        # Other settings on the same tiles do not read anything
+        with unittest.mock.patch.object(BCLReader, 'get_tile') as get_tile:
+            res = self.query(server, '/count', l=2, e=1, n=50, hamming=1, **query)
+            get_tile.assert_not_called()
+        self.assertEqual(res['lanes'], self.expected(CountConfig(None, 1, True, 2, 50), [(0, 10), (12, 20)]))
+
+        status = self.query(server, '/status')
+        self.assertEqual(status['queries'], 2)
+        self.assertEqual(status['caches']['seqs'], dict(size=4, maxsize=64, hits=4, misses=4))
+
+        self.query(server, '/clear')
+        self.assertEqual(self.query(server, '/status')['caches']['seqs']['size'], 0)
+
+    def test_tile_opened_once(self):
+        # Each tile is opened just once for all the ranges of cycles
+        server = self.start_server(port=0)
+        get_tile = BCLReader.get_tile
+        with unittest.mock.patch.object(BCLReader, 'get_tile', autospec=True, side_effect=get_tile) as spy:
+            self.query(server, '/count', run=self.run_dir, targets=self.targets_file, cycles='0-5,5-10,12-20')
+        self.assertEqual(sorted( c.args[2] for c in spy.call_args_list ), ['1101', '1102'])
+
+    def test_bad_query(self):
+        server = self.start_server(port=0)
+        for path, params in [ ('/count', dict(run=self.run_dir)),
+                              ('/count', dict(run=self.run_dir, targets=self.targets_file, l=5)),
+                              ('/count', dict(run=self.run_dir, targets=self.targets_file, tile='9999')),
+                              ('/nothing', dict()) ]:
+            with self.assertRaises(HTTPError) as cm:
+                self.query(server, path, **params)
+            self.assertIn(cm.exception.code, [400, 404])
+            self.assertIn('error', json.load(cm.exception))
+
+    def test_unix_socket(self):
+        socket_path = os.path.join(self.tmpdir.name, 'welldup.sock')
+        self.start_server(socket_path=socket_path)
+
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.connect(socket_path)
+            sock.sendall(b'GET /status HTTP/1.0\r\n\r\n')
+            resp = b''.join(iter(lambda: sock.recv(4096), b''))
+        head, _, body = resp.partition(b'\r\n\r\n')
+        self.assertTrue(head.startswith(b'HTTP/1.0 200'))
+        self.assertEqual(json.loads(body)['queries'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import tempfile
+import unittest
+import unittest.mock
+
+try:
+    sys.path.insert(0,'.')
+    import numpy as np
+    import Levenshtein
+    from exhaustive import NeighbourScan, load_slocs, popcount, hamming, BASE_BITS, BASES_PER_WORD
+    from make_synthetic_run import make_run
+    from bcl_direct_reader import BCLReader
+    from target import AllTargets
+    from prepare_cluster_indexes import MAX_DISTS
+    from count_well_duplicates import read_tile_seqs, count_tile_dups, tile_stats
+except:
+    #If this fails, you is probably running the tests wrongly
+    print("****",
+          "You want to run these tests from the top-level source folder by using:",
+          "  python3 -m unittest test.test_exhaustive",
+          "or even",
+          "  python3 -m unittest discover",
+          "****",
+          sep="\n")
+    raise
+
+ROWS, COLS, CYCLES = 30, 60, 20
+LEVELS = 3
+
+def all_targets(slocs):
+    """ Makes every well a target, finding the neighbours by brute force.
+    """
+    x, y = load_slocs(slocs)
+    targets = AllTargets()
+    for well in range(len(x)):
+        dist = np.sqrt((x - x[well]) ** 2 + (y - y[well]) ** 2)
+        targets.add_target( [[well]] +
+                            [ np.nonzero((dist > MAX_DISTS[l]) & (dist <= MAX_DISTS[l+1]))[0].tolist()
+                              for l in range(LEVELS) ] )
+    return targets
+
+class TestExhaustive(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        for preset in ['hiseq_4000', 'novaseq']:
+            make_run( os.path.join(cls.tmpdir.name, preset), preset=preset,
+                      surfaces=1, swaths=1, tiles=1, rows=ROWS, cols=COLS, cycles=CYCLES,
+                      dup_rates=(0.05, 0.02, 0.01) )
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def test_popcount(self):
+        a = np.array([0, 1, 0b1011, 2**64 - 1], dtype=np.uint64)
+        self.assertEqual(popcount(a).tolist(), [0, 1, 3, 64])
+
+    def test_long_reads(self):
+        # Reads of 256 bases or more, which differ at every base, are not dups.
+        # Odd and even wells are all C or all A, so with a window of 258 bases
+        # only wells an even distance apart are dups, which is the same as for
+        # a single base with edit distance 0.
+        run = os.path.join(self.tmpdir.name, 'hiseq_4000')
+        slocs = run + '/Data/Intensities/s.locs'
+        codes = (np.arange(ROWS * COLS) % 2 + 1).astype(np.uint64)
+        one_word = sum( codes << np.uint64(BASE_BITS * k) for k in range(BASES_PER_WORD) )
+        long_words = np.array([ one_word ] * (258 // BASES_PER_WORD + 1), dtype=np.uint64)
+        long_words[-1] &= np.uint64((1 << (BASE_BITS * (258 % BASES_PER_WORD))) - 1)
+
+        self.assertEqual(hamming(long_words, [0], [1]).tolist(), [258])
+        self.assertEqual(hamming(long_words, [0], [2]).tolist(), [0])
+
+        got = NeighbourScan(slocs, LEVELS, 2).count(long_words)
+        expected = NeighbourScan(slocs, LEVELS, 0).count(codes.reshape(1, -1))
+        self.assertEqual(got[0].tolist(), expected[0].tolist())
+        self.assertEqual(got[1].tolist(), expected[1].tolist())
+
+    def test_offsets(self):
+        run = os.path.join(self.tmpdir.name, 'hiseq_4000')
+        scan = NeighbourScan(run + '/Data/Intensities/s.locs', LEVELS, 2)
+        self.assertEqual(scan.num_wells, ROWS * COLS)
+
+        # The immediate neighbours along the row and in the rows either side
+        self.assertIn(1, scan.offsets)
+        self.assertLess(max(scan.offsets), ROWS * COLS)
+
+    def test_every_well(self):
+        # Same answer as the sampled counting with every well as a target
+        cycles = [ (0, 10), (12, CYCLES) ]
+        for preset in ['hiseq_4000', 'novaseq']:
+            run = os.path.join(self.tmpdir.name, preset)
+            slocs = run + '/Data/Intensities/s.locs'
+            targets = all_targets(slocs)
+
+            with unittest.mock.patch('count_well_duplicates.log'):
+                seq_objs = read_tile_seqs(BCLReader(run).get_tile(1, '1101'), targets, cycles)
+                counts = count_tile_dups(targets, seq_objs, LEVELS, 2, Levenshtein.hamming)
+            expected = tile_stats(counts, LEVELS)
+
+            scan = NeighbourScan(slocs, LEVELS, 2)
+            got = scan.tile_stats(BCLReader(run).get_tile(1, '1101'), cycles)
+            self.assertEqual(got, expected, preset)
+            self.assertGreater(got['dups'][0], 0)
+
+    def test_wrong_slocs(self):
+        run = os.path.join(self.tmpdir.name, 'hiseq_4000')
+        scan = NeighbourScan(run + '/Data/Intensities/s.locs', LEVELS, 2)
+        scan.num_wells -= 1
+        with self.assertRaises(ValueError):
+            scan.read_tile(BCLReader(run).get_tile(1, '1101'), [ (0, CYCLES) ])
+
+if __name__ == '__main__':
+    unittest.main()
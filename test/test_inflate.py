@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import gzip
+import random
+import unittest
+import unittest.mock
+
+try:
+    sys.path.insert(0,'.')
+    from inflate import Inflater, get_backend, available_backends, BACKEND_ENV
+except:
+    #If this fails, you is probably running the tests wrongly
+    print("****",
+          "You want to run these tests from the top-level source folder by using:",
+          "  python3 -m unittest test.test_inflate",
+          "or even",
+          "  python3 -m unittest discover",
+          "****",
+          sep="\n")
+    raise
+
+def random_bytes(size, seed=1):
+    # Low entropy, like base calls, so it actually compresses
+    rng = random.Random(seed)
+    return bytes( rng.choice(b'ACGT\x00') for n in range(size) )
+
+class TestInflate(unittest.TestCase):
+
+    def test_inflate(self):
+        inf = Inflater(chunk_size=1000)
+        data = random_bytes(12345)
+
+        self.assertEqual(bytes(inf.inflate(gzip.compress(data))), data)
+        self.assertEqual(bytes(inf.inflate(gzip.compress(b''))), b'')
+
+        # Several gzip members, as gzip.decompress() allows
+        self.assertEqual(bytes(inf.inflate(gzip.compress(data) + gzip.compress(b'xyz'))), data + b'xyz')
+
+    def test_reuse(self):
+        inf = Inflater(chunk_size=1000)
+        zdata = [ gzip.compress(random_bytes(5000, seed=s)) for s in range(5) ]
+
+        first = inf.inflate(zdata[0])
+        buffer_id = id(inf.buffer)
+        first.release()
+
+        # Once sized from the gzip trailer, the buffer is never re-allocated
+        for z in zdata:
+            self.assertEqual(bytes(inf.inflate(z)), gzip.decompress(z))
+        self.assertEqual(inf.reallocations, 1)
+        self.assertEqual(id(inf.buffer), buffer_id)
+
+    def test_grow_with_view(self):
+        # The trailer size is no help with multiple members, so the buffer has
+        # to grow, and the old view should survive this.
+        inf = Inflater(chunk_size=1000)
+        small = random_bytes(500)
+        big = random_bytes(20000)
+
+        old = inf.inflate(gzip.compress(small))
+        self.assertEqual(bytes(inf.inflate(gzip.compress(big) + gzip.compress(b'x'))), big + b'x')
+        self.assertEqual(bytes(old), small)
+        self.assertGreater(inf.reallocations, 1)
+
+    def test_limit(self):
+        inf = Inflater(chunk_size=1000)
+        data = random_bytes(12345)
+        zdata = gzip.compress(data)
+
+        # At least what was asked for, but no more than one more chunk
+        res = bytes(inf.inflate(zdata, limit=2500))
+        self.assertEqual(res, data[:len(res)])
+        self.assertGreaterEqual(len(res), 2500)
+        self.assertLess(len(res), 3500)
+
+        self.assertEqual(bytes(inf.inflate(zdata, limit=99999)), data)
+
+    def test_truncated(self):
+        zdata = gzip.compress(random_bytes(5000))
+
+        with self.assertRaises(EOFError):
+            Inflater().inflate(zdata[:-20])
+
+    def test_backends(self):
+        # Every backend that is installed must give the same result.  zlib is
+        # always there.
+        self.assertIn('zlib', available_backends())
+        zdata = gzip.compress(random_bytes(50000)) + gzip.compress(b'ACGT')
+        for name in available_backends():
+            with self.subTest(backend=name):
+                inf = Inflater(chunk_size=1000, backend=name)
+                self.assertEqual(inf.backend, name)
+                self.assertEqual(bytes(inf.inflate(zdata)), gzip.decompress(zdata))
+
+    def test_get_backend(self):
+        self.assertEqual(get_backend('zlib')[0], 'zlib')
+        with self.assertRaises(ValueError):
+            get_backend('pigz')
+
+        with unittest.mock.patch.dict(os.environ, {BACKEND_ENV: 'zlib'}):
+            self.assertEqual(Inflater().backend, 'zlib')
+        with unittest.mock.patch.dict(os.environ, {BACKEND_ENV: 'auto'}):
+            self.assertEqual(Inflater().backend, available_backends()[0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import tempfile
+import unittest
+
+try:
+    sys.path.insert(0,'.')
+    import numpy as np
+    from long_range import LongRangeScan, choose_parts, part_keys, bucket_pairs, sum_stats
+    from exhaustive import hamming, BASE_BITS, BASES_PER_WORD
+    from make_synthetic_run import make_run
+    from bcl_direct_reader import BCLReader
+except:
+    #If this fails, you is probably running the tests wrongly
+    print("****",
+          "You want to run these tests from the top-level source folder by using:",
+          "  python3 -m unittest test.test_long_range",
+          "or even",
+          "  python3 -m unittest discover",
+          "****",
+          sep="\n")
+    raise
+
+ROWS, COLS, CYCLES = 30, 60, 20
+
+def pack(seqs):
+    """ Packs lists of base codes into words, as exhaustive.read_tile_words() does.
+    """
+    bases = len(seqs[0])
+    words = np.zeros(((bases - 1) // BASES_PER_WORD + 1, len(seqs)), dtype=np.uint64)
+    for n, seq in enumerate(seqs):
+        for k, code in enumerate(seq):
+            words[k // BASES_PER_WORD, n] |= np.uint64(code << (BASE_BITS * (k % BASES_PER_WORD)))
+    return words
+
+def brute_force_pairs(words, wells, edit_distance):
+    res = set()
+    for i, a in enumerate(wells):
+        mismatched = hamming(words, a, wells[i+1:])
+        res.update( (int(a), int(b)) for b in wells[i+1:][mismatched <= edit_distance] )
+    return res
+
+class TestLongRange(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.run_dir = os.path.join(cls.tmpdir.name, 'run')
+        cls.truth = make_run( cls.run_dir, surfaces=1, swaths=1, tiles=1, rows=ROWS, cols=COLS, cycles=CYCLES,
+                              far_rate=0.01 )
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def test_choose_parts(self):
+        # Long reads just need one part more than the edit distance
+        self.assertEqual(choose_parts(50, 2, 4000000), 3)
+        # Short reads need more, so the keys are long enough
+        self.assertEqual(choose_parts(20, 2, 4000000), 6)
+        self.assertEqual(choose_parts(3, 2, 4000000), 3)
+
+    def test_edits(self):
+        # Reads with up to 2 changes are found, wherever the changes are
+        rng = np.random.RandomState(13)
+        seqs = [ list(rng.randint(1, 5, size=30)) for n in range(40) ]
+        for n in range(10):
+            copy = list(seqs[n])
+            for k in rng.choice(30, size=n % 4, replace=False):
+                copy[k] = copy[k] % 4 + 1
+            seqs.append(copy)
+        words = pack(seqs)
+        wells = np.arange(len(seqs))
+
+        for parts in [3, 4, 6]:
+            found = set()
+            for keys in part_keys(words, 30, parts, 2):
+                a, b, crowded = bucket_pairs(keys, wells)
+                found.update(zip(a.tolist(), b.tolist()))
+            expected = brute_force_pairs(words, wells, 2)
+            self.assertEqual(expected, { (n, n + 40) for n in range(10) if n % 4 <= 2 })
+            self.assertTrue(expected <= found, parts)
+
+    def test_crowded(self):
+        keys = np.array([5, 1, 5, 5, 2, 1], dtype=np.uint64)
+        a, b, crowded = bucket_pairs(keys, np.arange(6), max_bucket=2)
+        self.assertEqual(list(zip(a, b)), [(1, 5)])
+        self.assertEqual(sorted(crowded), [0, 2, 3])
+
+    def test_buckets(self):
+        # Every pair in every bucket, once, with buckets of several sizes
+        keys = np.array([7, 3, 7, 9, 3, 7, 1, 7, 3, 9], dtype=np.uint64)
+        a, b, crowded = bucket_pairs(keys, np.arange(10) + 100)
+        expected = { (p, q) for p in range(10) for q in range(p + 1, 10) if keys[p] == keys[q] }
+        got = [ tuple(sorted((p - 100, q - 100))) for p, q in zip(a.tolist(), b.tolist()) ]
+        self.assertEqual(len(got), len(expected))
+        self.assertEqual(set(got), expected)
+        self.assertEqual(len(crowded), 0)
+
+    def test_long_reads(self):
+        # Reads of 256 bases or more that share a part are not dups just because
+        # the mismatches wrap round.
+        scan = LongRangeScan(self.run_dir + '/Data/Intensities/s.locs', edit_distance=2, levels=3)
+        rng = np.random.RandomState(7)
+        seqs = [ list(rng.randint(1, 5, size=600)) for n in range(scan.num_wells) ]
+        seqs[1] = seqs[0][:344] + [ code % 4 + 1 for code in seqs[0][344:] ]
+        seqs[3] = seqs[2][:598] + [ code % 4 + 1 for code in seqs[2][598:] ]
+        words = pack(seqs)
+
+        self.assertEqual(hamming(words, [0, 2], [1, 3]).tolist(), [256, 2])
+        a, b, crowded = scan.find_pairs(words, np.ones(scan.num_wells, dtype=bool), 600)
+        self.assertEqual(list(zip(a.tolist(), b.tolist())), [(2, 3)])
+
+    def test_tile(self):
+        cycles = [ (0, 10), (12, CYCLES) ]
+        scan = LongRangeScan(self.run_dir + '/Data/Intensities/s.locs', edit_distance=2, levels=3)
+        words, passing = scan.read_tile(BCLReader(self.run_dir).get_tile(1, '1101'), cycles)
+
+        # Same pairs as comparing every passing well with every other
+        a, b, crowded = scan.find_pairs(words, passing, 18)
+        self.assertEqual(crowded, 0)
+        self.assertEqual(set(zip(a.tolist(), b.tolist())),
+                         brute_force_pairs(words, np.nonzero(passing)[0], 2))
+
+        # And the far duplicates are counted as distant
+        far = [ (min(s, d), max(s, d)) for s, d, level in self.truth['1_1101']
+                if level == 0 and passing[d] ]
+        self.assertTrue(far)
+        ts = scan.stats(words, passing, 18)
+        self.assertGreaterEqual(sum(ts['pairs'][3:]), len(far))
+        self.assertEqual(sum(ts['pairs']), len(a))
+        self.assertEqual(ts['wells'], int(passing.sum()))
+        self.assertEqual(ts['dup_wells'], ts['local_wells'] + ts['distant_wells'])
+
+        # Summing a lane
+        lane = sum_stats([ts, ts])
+        self.assertEqual(lane['pairs'], [ 2 * p for p in ts['pairs'] ])
+        self.assertEqual(lane['wells'], 2 * ts['wells'])
+
+    def test_well_pairs(self):
+        # With every well sampled, the counts are exact
+        scan = LongRangeScan(self.run_dir + '/Data/Intensities/s.locs', edit_distance=2, levels=3,
+                             pair_samples=ROWS * COLS)
+        passing = np.ones(ROWS * COLS, dtype=bool)
+        self.assertEqual(sum(scan.well_pairs(passing)), ROWS * COLS * (ROWS * COLS - 1) // 2)
+
+if __name__ == '__main__':
+    unittest.main()
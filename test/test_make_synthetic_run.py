@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import gzip
+import struct
+import tempfile
+import unittest
+import unittest.mock
+
+try:
+    sys.path.insert(0,'.')
+    from make_synthetic_run import make_run, neighbours, UNEXCLUDED_CYCLES
+    from bcl_direct_reader import BCLReader
+    from profiling import Profile
+    import prepare_cluster_indexes
+except:
+    #If this fails, you is probably running the tests wrongly
+    print("****",
+          "You want to run these tests from the top-level source folder by using:",
+          "  python3 -m unittest test.test_make_synthetic_run",
+          "or even",
+          "  python3 -m unittest discover",
+          "****",
+          sep="\n")
+    raise
+
+ROWS, COLS, CYCLES = 30, 60, 30
+
+class TestMakeSyntheticRun(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.tiles = dict()
+        cls.truth = dict()
+        for preset in ['hiseq_4000', 'novaseq']:
+            cls.tiles[preset] = dict()
+            cls.truth[preset] = make_run( cls.tmpdir.name + '/' + preset, preset=preset,
+                                          surfaces=1, swaths=1, tiles=2,
+                                          rows=ROWS, cols=COLS, cycles=CYCLES,
+                                          keep=cls.tiles[preset] )
+
+        # Uncompressed BCL, with every third cycle then gzipped to make a mixed run.
+        cls.tiles['bcl'] = dict()
+        make_run( cls.tmpdir.name + '/bcl', fmt='bcl',
+                  surfaces=1, swaths=1, tiles=2,
+                  rows=ROWS, cols=COLS, cycles=CYCLES,
+                  keep=cls.tiles['bcl'] )
+        for c in range(1, CYCLES+1, 3):
+            plain = cls.tmpdir.name + '/bcl/Data/Intensities/BaseCalls/L001/C%i.1/s_1_1102.bcl' % c
+            with open(plain, 'rb') as in_fh, gzip.open(plain + '.gz', 'wb') as out_fh:
+                out_fh.write(in_fh.read())
+            os.unlink(plain)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def test_read_bcl(self):
+        syn_tile = self.tiles['hiseq_4000']['1_1102']
+        tile = BCLReader(self.tmpdir.name + '/hiseq_4000').get_tile(1, 1102)
+
+        self.assertEqual(tile.num_clusters, ROWS * COLS)
+        self.assertEqual(tile.num_cycles, CYCLES)
+
+        wells = range(0, ROWS * COLS, 7)
+        res = tile.get_seqs(wells, start=5, end=25)
+        for w in wells:
+            self.assertEqual(res[w], (syn_tile.seq(w, 5, 25), bool(syn_tile.passing[w])))
+
+    def test_read_cbcl(self):
+        syn_tile = self.tiles['novaseq']['1_1102']
+        tile = BCLReader(self.tmpdir.name + '/novaseq').get_tile(1, 1102)
+
+        self.assertEqual(tile.num_clusters, ROWS * COLS)
+
+        # Read across the point where the excluded blocks start.  Wells that
+        # failed the filter come back as N from then on.
+        wells = range(0, ROWS * COLS, 7)
+        res = tile.get_seqs(wells, start=20, end=CYCLES)
+        for w in wells:
+            expected = syn_tile.seq(w, 20, CYCLES)
+            if not syn_tile.passing[w]:
+                cut = UNEXCLUDED_CYCLES - 20
+                expected = expected[:cut] + 'N' * (len(expected) - cut)
+            self.assertEqual(res[w], (expected, bool(syn_tile.passing[w])))
+
+    def test_read_plain_bcl(self):
+        # Tile 1101 is all plain .bcl, 1102 has a mixture.
+        for t in ['1101', '1102']:
+            syn_tile = self.tiles['bcl']['1_' + t]
+            prof = Profile()
+            tile = BCLReader(self.tmpdir.name + '/bcl').get_tile(1, t, profile=prof)
+
+            wells = [0, 1, 1000, ROWS * COLS - 1]
+            res = tile.get_seqs(wells, start=2, end=CYCLES)
+            for w in wells:
+                self.assertEqual(res[w], (syn_tile.seq(w, 2, CYCLES), bool(syn_tile.passing[w])))
+
+            # The mapped cycles are never inflated
+            gz_cycles = 0 if t == '1101' else len(range(3, CYCLES, 3))
+            self.assertEqual(prof.counters.get('bytes_inflated', 0), gz_cycles * (4 + ROWS * COLS))
+            self.assertEqual(prof.counters['bytes_mapped'], (CYCLES - 2 - gz_cycles) * (4 + ROWS * COLS))
+
+    def test_early_stop(self):
+        # With all the wells near the start of the tile, there is no need to
+        # inflate the whole of every file.
+        wells = range(0, ROWS * COLS // 3, 5)
+        for preset in ['hiseq_4000', 'novaseq']:
+            syn_tile = self.tiles[preset]['1_1101']
+            prof = Profile()
+            reader = BCLReader(self.tmpdir.name + '/' + preset)
+            # The files are so small that one normal chunk would be all of it
+            reader.inflater.chunk_size = 100
+            tile = reader.get_tile(1, 1101, profile=prof)
+
+            res = tile.get_seqs(wells, start=0, end=10)
+            for w in wells:
+                self.assertEqual(res[w][0], syn_tile.seq(w, 0, 10))
+            self.assertLess(prof.counters['bytes_inflated'], 10 * ROWS * COLS // 2)
+
+    def test_band_sampling(self):
+        slocs = self.tmpdir.name + '/hiseq_4000/Data/Intensities/s.locs'
+
+        # Two bands of 90 wells, in the middle of each quarter of the tile
+        sample = prepare_cluster_indexes.get_band_array(ROWS * COLS, 50, 13, 2, band_fraction=0.1, span=0.5)
+        self.assertEqual(len(set(sample)), 50)
+        self.assertTrue(all( 180 <= w < 270 or 630 <= w < 720 for w in sample ))
+
+        with self.assertRaises(ValueError):
+            prepare_cluster_indexes.get_band_array(ROWS * COLS, 500, 13, 2, band_fraction=0.1)
+
+        with open(slocs, 'rb') as fh:
+            report = prepare_cluster_indexes.sampling_report(fh, ROWS * COLS, { w: [[w]] for w in sample })
+            self.assertLess(report['coverage'], 0.5)
+            self.assertLess(report['inflate_fraction'], 0.5)
+
+            # Sampling the whole tile covers it, but the very last well makes
+            # the whole file needed.
+            sample = prepare_cluster_indexes.get_random_array(ROWS * COLS, 400, 13)
+            everywhere = { w: [[w]] for w in sample }
+            everywhere[sample[0]] = [[ROWS * COLS - 1]]
+            report = prepare_cluster_indexes.sampling_report(fh, ROWS * COLS, everywhere)
+            self.assertEqual(report['inflate_fraction'], 1.0)
+            self.assertGreater(report['coverage'], 0.9)
+
+    def test_planted_dups(self):
+        planted = self.truth['hiseq_4000']['1_1101']
+        self.assertTrue(planted)
+
+        levels_seen = set()
+        for src, dst, level in planted:
+            levels_seen.add(level)
+            self.assertIn(dst, neighbours(src, level, ROWS, COLS))
+        self.assertEqual(levels_seen, {1, 2, 3})
+
+        syn_tile = self.tiles['hiseq_4000']['1_1101']
+        tile = BCLReader(self.tmpdir.name + '/hiseq_4000').get_tile(1, 1101)
+        res = tile.get_seqs([ w for p in planted for w in p[:2] ])
+        for src, dst, level in planted:
+            self.assertEqual(res[src][0], res[dst][0])
+            self.assertTrue(res[src][1])
+
+    def test_slocs_matches_neighbours(self):
+        # prepare_cluster_indexes should find the same wells as our lattice arithmetic
+        # for a well in the middle of the tile.
+        centre = (ROWS // 2) * COLS + COLS // 2
+        with open(self.tmpdir.name + '/hiseq_4000/Data/Intensities/s.locs', 'rb') as fh:
+            self.assertEqual(struct.unpack('<ifI', fh.read(12))[2], ROWS * COLS)
+            fh.seek(12 + centre * 8)
+            t = struct.unpack('<ff', fh.read(8))
+
+            with unittest.mock.patch('prepare_cluster_indexes.log'):
+                all_levs = prepare_cluster_indexes.get_indexes( centre,
+                                                                int(t[0] * 10.0 + 1000.5),
+                                                                int(t[1] * 10.0 + 1000.5),
+                                                                fh )
+
+        self.assertEqual([len(l) for l in all_levs[:4]], [6, 12, 18, 24])
+        for lev, wells in enumerate(all_levs, 1):
+            self.assertEqual(sorted(wells), sorted(neighbours(centre, lev, ROWS, COLS)))
+
+if __name__ == '__main__':
+    unittest.main()
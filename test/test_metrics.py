@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import tempfile
+import unittest
+
+try:
+    sys.path.insert(0,'.')
+    from metrics import Metrics, main as metrics_main
+except:
+    #If this fails, you is probably running the tests wrongly
+    print("****",
+          "You want to run these tests from the top-level source folder by using:",
+          "  python3 -m unittest test.test_metrics",
+          "or even",
+          "  python3 -m unittest discover",
+          "****",
+          sep="\n")
+    raise
+
+class TestMetrics(unittest.TestCase):
+
+    def test_render(self):
+        m = Metrics()
+        m.set('welldup_lane_seconds', 12.5, "Time per lane", run='run1', lane=1)
+        m.set('welldup_lane_seconds', 20.0, run='run1', lane=2)
+        m.set('welldup_run_success', 1, "Did it work?", run='a "quoted" name')
+
+        self.assertEqual(m.render().split("\n"), [
+            '# HELP welldup_lane_seconds Time per lane',
+            '# TYPE welldup_lane_seconds gauge',
+            'welldup_lane_seconds{lane="1",run="run1"} 12.5',
+            'welldup_lane_seconds{lane="2",run="run1"} 20.0',
+            '# HELP welldup_run_success Did it work?',
+            '# TYPE welldup_run_success gauge',
+            'welldup_run_success{run="a \\"quoted\\" name"} 1',
+            '' ])
+
+    def test_write_load_merge(self):
+        m1 = Metrics()
+        m1.set('welldup_lane_seconds', 12.5, "Time per lane", lane=1)
+        m1.set('welldup_run_success', 1, "Did it work?")
+        m2 = Metrics()
+        m2.set('welldup_lane_seconds', 20.0, "Time per lane", lane=2)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            m1.write(tmpdir + '/1.prom')
+            m2.write(tmpdir + '/2.prom')
+
+            # No temp files left over
+            self.assertEqual(sorted(os.listdir(tmpdir)), ['1.prom', '2.prom'])
+
+            m1_loaded = Metrics.load(tmpdir + '/1.prom')
+            self.assertEqual(m1_loaded.render(), m1.render())
+            self.assertEqual(m1_loaded.get('welldup_run_success'), 1)
+
+            metrics_main(['merge', tmpdir + '/all.prom', tmpdir + '/1.prom', tmpdir + '/2.prom'])
+            merged = Metrics.load(tmpdir + '/all.prom')
+
+        self.assertEqual(merged.get('welldup_lane_seconds', lane=1), 12.5)
+        self.assertEqual(merged.get('welldup_lane_seconds', lane=2), 20.0)
+        self.assertEqual(merged.render().count('# TYPE welldup_lane_seconds'), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import io
+import tempfile
+import unittest
+from unittest.mock import patch
+
+try:
+    sys.path.insert(0,'.')
+    from partial_result import PartialResult, merge_partials, parse_shard, shard_tiles
+    from count_well_duplicates import output_writer, tile_stats, write_partial_report
+except:
+    #If this fails, you is probably running the tests wrongly
+    print("****",
+          "You want to run these tests from the top-level source folder by using:",
+          "  python3 -m unittest test.test_partial_result",
+          "or even",
+          "  python3 -m unittest discover",
+          "****",
+          sep="\n")
+    raise
+
+# Four tiles with a few targets each, and three levels.
+LANE_DUPL = { '1101' : [ [ ( 0, 6), ( 0,12), ( 0,18) ],
+                         [ ( 2, 6), ( 1,10), ( 0,12) ] ],
+              '1102' : [ [ ( 3, 6), ( 1,10), ( 1,12) ] ],
+              '2101' : [ ],
+              '2102' : [ [ ( 0, 6), ( 1,12), ( 0,18) ],
+                         [ ( 1, 6), ( 0,12), ( 2,18) ] ] }
+
+CONFIGS = [ dict(name=None, sample_size=4, key=dict(run='/some/run', levels=3, cycles=[(20, 70)])) ]
+
+def make_partials(shards):
+    """ Splits LANE_DUPL up as count_well_duplicates.py --shard would.
+    """
+    tiles = sorted(LANE_DUPL)
+    res = []
+    for shard in range(1, shards + 1):
+        part = PartialResult(CONFIGS, shard='%i/%i' % (shard, shards))
+        part.add_lane('1', tiles)
+        for tile in shard_tiles(tiles, shard, shards):
+            part.add_tile('1', tile, [tile_stats(LANE_DUPL[tile], 3)])
+        res.append(part)
+    return res
+
+class TestPartialResult(unittest.TestCase):
+
+    def test_parse_shard(self):
+        self.assertEqual(parse_shard('3/8'), (3, 8))
+        for bad in ['0/8', '9/8', '3', 'a/b']:
+            with self.assertRaises(ValueError):
+                parse_shard(bad)
+
+    def test_shard_tiles(self):
+        tiles = [ str(t) for t in range(1101, 1111) ]
+        shards = [ shard_tiles(tiles, i, 3) for i in range(1, 4) ]
+        self.assertEqual(shards[0], ['1101', '1104', '1107', '1110'])
+        self.assertEqual(sorted(sum(shards, [])), tiles)
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_merge_report(self, mock_stdout):
+        # The merged report is exactly what a single job would print
+        for fmt in ['text', 'json', 'tsv']:
+            output_writer('1', 4, LANE_DUPL, 3, verbose=True, fmt=fmt)
+            expected = mock_stdout.getvalue()
+            mock_stdout.seek(0) ; mock_stdout.truncate()
+
+            write_partial_report(merge_partials(make_partials(3)), verbose=True, fmt=fmt)
+            self.assertEqual(mock_stdout.getvalue(), expected)
+            mock_stdout.seek(0) ; mock_stdout.truncate()
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'shard1.json')
+            part = make_partials(2)[0]
+            part.save(filename)
+            self.assertEqual(os.listdir(tmpdir), ['shard1.json'])
+
+            loaded = PartialResult.load(filename)
+            self.assertEqual(loaded.data, part.data)
+
+    def test_missing(self):
+        with self.assertRaisesRegex(ValueError, '1102,2102'):
+            merge_partials(make_partials(2)[:1])
+
+    def test_mismatch(self):
+        parts = make_partials(2)
+        other = PartialResult([ dict(CONFIGS[0], key=dict(CONFIGS[0]['key'], levels=2)) ])
+        with self.assertRaises(ValueError):
+            merge_partials(parts + [other])
+
+        # The same tile twice is fine, so long as the results agree
+        parts.append(make_partials(2)[1])
+        self.assertEqual(len(merge_partials(parts).lanes), 1)
+
+        parts[-1].lanes[0]['stats'][0]['1102']['targets'] += 1
+        with self.assertRaises(ValueError):
+            merge_partials(parts)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import tempfile
+import threading
+import unittest
+
+try:
+    sys.path.insert(0,'.')
+    from prefetch import ReadAhead
+    from make_synthetic_run import make_run
+    from bcl_direct_reader import BCLReader
+    from profiling import Profile
+except:
+    #If this fails, you is probably running the tests wrongly
+    print("****",
+          "You want to run these tests from the top-level source folder by using:",
+          "  python3 -m unittest test.test_prefetch",
+          "or even",
+          "  python3 -m unittest discover",
+          "****",
+          sep="\n")
+    raise
+
+ROWS, COLS, CYCLES = 20, 30, 12
+
+class TestReadAhead(unittest.TestCase):
+
+    def test_order(self):
+        with ReadAhead(lambda n: n * n, range(20), depth=3) as ra:
+            self.assertEqual(list(ra), [ (n, n * n) for n in range(20) ])
+
+    def test_backpressure(self):
+        # The fetcher should never get more than depth items ahead, plus the
+        # one it is holding while waiting for room in the queue.
+        fetched = []
+        ra = ReadAhead(fetched.append, range(20), depth=3)
+        deadline = time.time() + 5
+        while len(fetched) < 4 and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        self.assertEqual(len(fetched), 4)
+
+        for n, (item, res) in enumerate(ra):
+            self.assertLessEqual(len(fetched), n + 5)
+        ra.close()
+        self.assertEqual(len(fetched), 20)
+
+    def test_error(self):
+        def fetch(n):
+            if n == 3:
+                raise OSError("Stale file handle")
+            return n
+
+        got = []
+        with self.assertRaises(OSError):
+            with ReadAhead(fetch, range(10)) as ra:
+                for item, res in ra:
+                    got.append(res)
+        self.assertEqual(got, [0, 1, 2])
+
+    def test_close_early(self):
+        ra = ReadAhead(lambda n: n, range(1000), depth=2)
+        next(iter(ra))
+        ra.close()
+        self.assertFalse(ra._thread.is_alive())
+
+class TestTilePrefetch(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        for preset in ['hiseq_4000', 'novaseq']:
+            make_run( cls.tmpdir.name + '/' + preset, preset=preset,
+                      surfaces=1, swaths=1, tiles=1,
+                      rows=ROWS, cols=COLS, cycles=CYCLES )
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def test_prefetch(self):
+        wells = range(0, ROWS * COLS, 3)
+        for preset in ['hiseq_4000', 'novaseq']:
+            reader = BCLReader(self.tmpdir.name + '/' + preset)
+            expected = [ reader.get_tile(1, 1101).get_seqs(wells, 0, 5),
+                         reader.get_tile(1, 1101).get_seqs(wells, 7, 12) ]
+
+            prof = Profile()
+            tile = reader.get_tile(1, 1101, profile=prof)
+            tile.prefetch(list(range(0, 5)) + list(range(7, 12)), depth=2)
+            self.assertEqual(tile.get_seqs(wells, 0, 5), expected[0])
+            self.assertEqual(tile.get_seqs(wells, 7, 12), expected[1])
+
+            # All the reads were done in the background, and added to the profile
+            self.assertIsNone(tile._read_ahead)
+            self.assertEqual(prof.calls['read'], 10)
+            self.assertEqual(prof.calls['wait'], 10)
+
+    def test_prefetch_mismatch(self):
+        # Asking for different cycles than were prefetched still works.
+        wells = range(0, ROWS * COLS, 5)
+        reader = BCLReader(self.tmpdir.name + '/hiseq_4000')
+        expected = reader.get_tile(1, 1101).get_seqs(wells, 2, 8)
+
+        tile = reader.get_tile(1, 1101)
+        tile.prefetch(range(0, CYCLES))
+        self.assertEqual(tile.get_seqs(wells, 2, 8), expected)
+        self.assertIsNone(tile._read_ahead)
+        self.assertEqual(threading.active_count(), 1)
+
+if __name__ == '__main__':
+    unittest.main()
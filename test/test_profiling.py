@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import sys
+import io
+import json
+import tempfile
+import unittest
+
+try:
+    sys.path.insert(0,'.')
+    from profiling import Profile, NO_PROFILE, write_record
+    from make_synthetic_run import make_run
+    from bcl_direct_reader import BCLReader
+except:
+    #If this fails, you is probably running the tests wrongly
+    print("****",
+          "You want to run these tests from the top-level source folder by using:",
+          "  python3 -m unittest test.test_profiling",
+          "or even",
+          "  python3 -m unittest discover",
+          "****",
+          sep="\n")
+    raise
+
+class TestProfiling(unittest.TestCase):
+
+    def test_phases_and_counters(self):
+        prof = Profile()
+        for n in range(3):
+            with prof.phase('inflate'):
+                pass
+        prof.count('bytes_inflated', 100)
+        prof.count('bytes_inflated', 23)
+
+        other = Profile()
+        with other.phase('inflate'):
+            pass
+        other.count('comparisons')
+        prof.add(other)
+
+        res = prof.as_dict(lane=1)
+        self.assertEqual(res['lane'], 1)
+        self.assertEqual(res['phases']['inflate']['calls'], 4)
+        self.assertEqual(res['counters'], dict(bytes_inflated=123, comparisons=1))
+        self.assertGreater(res['peak_rss_kb'], 0)
+
+        # Output is one line of JSON per record
+        fh = io.StringIO()
+        write_record(fh, res)
+        self.assertEqual(json.loads(fh.getvalue()), res)
+
+    def test_null_profile(self):
+        with NO_PROFILE.phase('anything'):
+            NO_PROFILE.count('stuff', 10)
+        NO_PROFILE.add(Profile())
+        self.assertFalse(NO_PROFILE.enabled)
+
+    def test_tile_counters(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            make_run(tmpdir + '/run', surfaces=1, swaths=1, tiles=1, rows=20, cols=50, cycles=12)
+
+            prof = Profile()
+            tile = BCLReader(tmpdir + '/run').get_tile(1, 1101, profile=prof)
+            tile.get_seqs(range(0, 1000, 3), start=2, end=10)
+
+        self.assertEqual(prof.calls['inflate'], 8)
+        self.assertEqual(prof.calls['filter_load'], 1)
+        self.assertEqual(prof.counters['bytes_inflated'], 8 * (4 + 20 * 50))
+        self.assertEqual(prof.counters['wells_requested'], 334)
+        self.assertGreater(prof.counters['bytes_read'], 12 + 20 * 50)
+
+if __name__ == '__main__':
+    unittest.main()
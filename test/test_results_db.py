@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import io
+import tempfile
+import unittest
+import unittest.mock
+
+try:
+    sys.path.insert(0,'.')
+    from make_synthetic_run import make_run, write_targets
+    from count_well_duplicates import WellDupCounter, CountConfig
+    from results_db import ResultsDB, parse_report, parse_run_name, import_report, find_reports
+except:
+    #If this fails, you is probably running the tests wrongly
+    print("****",
+          "You want to run these tests from the top-level source folder by using:",
+          "  python3 -m unittest test.test_results_db",
+          "or even",
+          "  python3 -m unittest discover",
+          "****",
+          sep="\n")
+    raise
+
+ROWS, COLS, CYCLES = 30, 60, 20
+
+RUN = '150715_K00169_0016_BH3FGFBBXX'
+
+class TestResultsDB(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.run_dir = os.path.join(cls.tmpdir.name, 'run')
+        make_run(cls.run_dir, surfaces=1, swaths=1, tiles=2, rows=ROWS, cols=COLS, cycles=CYCLES)
+        cls.targets = os.path.join(cls.tmpdir.name, 'targets.list')
+        write_targets(cls.targets, ROWS, COLS, 50, levels=3)
+
+        # The results for the lane, and the text report of the same
+        with unittest.mock.patch('count_well_duplicates.log'):
+            with WellDupCounter(cls.run_dir, cls.targets, CountConfig(None, 2, False, 3, 50),
+                                cycles=[(0, CYCLES)], quiet=True) as counter:
+                cls.expected = list(counter.run())[0].stats[0]
+
+                cls.report = io.StringIO()
+                for res in counter.iter_lanes(fmt='text', outputs=[cls.report]):
+                    pass
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def setUp(self):
+        self.db = ResultsDB(':memory:')
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_parse_run_name(self):
+        self.assertEqual(parse_run_name(RUN), ('2015-07-15', 'K00169', 'H3FGFBBXX'))
+        self.assertEqual(parse_run_name('not_a_run'), (None, None, None))
+
+    def test_parse_report(self):
+        # Reading back the text report gives the same figures
+        lanes = parse_report(self.report.getvalue().splitlines())
+        self.assertEqual(len(lanes), 1)
+        lane, sample_size, stats = lanes[0]
+        self.assertEqual((lane, sample_size), ('1', 50))
+
+        for k in ['targets', 'tile_count', 'levels', 'wells', 'dups', 'hits', 'acco', 'acci']:
+            self.assertEqual(stats[k], self.expected[k], k)
+        for k in ['overall', 'picard_v1', 'picard_v2']:
+            self.assertAlmostEqual(stats[k], self.expected[k], places=6)
+        self.assertEqual([ ts['tile'] for ts in stats['tiles'] ], ['1101', '1102'])
+
+    def test_add_lane(self):
+        params = dict(edit_distance=2, hamming=False, cycles='0-20')
+        # A row for the lane and one per tile
+        self.assertEqual(self.db.add_lane(RUN, 1, self.expected, 50, params), 3)
+
+        rows = self.db.lane_results(instrument='K00169')
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['run_date'], '2015-07-15')
+        self.assertEqual(rows[0]['dups'], self.expected['dups'][0])
+        self.assertEqual(rows[0]['acci'], self.expected['acci'][0])
+        self.assertAlmostEqual(rows[0]['picard_v1'], self.expected['picard_v1'])
+
+        # The same again replaces the old row, but other settings are kept apart
+        self.db.add_lane(RUN, 1, self.expected, 50, params)
+        self.assertEqual(len(self.db.lane_results()), 1)
+        self.db.add_lane(RUN, 1, self.expected, 50, dict(params, edit_distance=1))
+        self.assertEqual(len(self.db.lane_results()), 2)
+        self.assertEqual(self.db.conn.execute("SELECT count(*) FROM level_stats").fetchone()[0], 18)
+
+        self.assertEqual(self.db.lane_results(since='2016-01-01'), [])
+        self.assertEqual(self.db.lane_results(level=3)[0]['wells'], self.expected['wells'][2])
+        self.assertEqual(self.db.instrument_summary()[0]['lanes'], 2)
+
+    def test_import(self):
+        # A work directory named for the run, as the Snakefile makes
+        workdir = os.path.join(self.tmpdir.name, 'WellDuplicates', RUN)
+        os.makedirs(workdir, exist_ok=True)
+        with open(os.path.join(workdir, '50targets_lane1.txt'), 'w') as fh:
+            fh.write(self.report.getvalue())
+
+        reports = list(find_reports([os.path.dirname(workdir)]))
+        self.assertEqual(len(reports), 1)
+        self.assertEqual(import_report(self.db, reports[0]), 3)
+
+        rows = self.db.lane_results(run=RUN, sample_size=50)
+        self.assertEqual(len(rows), 1)
+        self.assertIsNone(rows[0]['edit_distance'])
+        self.assertEqual(rows[0]['targets'], self.expected['targets'])
+
+        tiles = self.db.tile_results(RUN, 1)
+        self.assertEqual([ t['tile'] for t in tiles ], ['1101', '1102'])
+        self.assertEqual(sum( t['dups'] for t in tiles ), self.expected['dups'][0])
+
+        # Importing again changes nothing
+        import_report(self.db, reports[0])
+        self.assertEqual(self.db.conn.execute("SELECT count(*) FROM results").fetchone()[0], 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import tempfile
+import unittest
+import unittest.mock
+
+try:
+    sys.path.insert(0,'.')
+    from run_layout import RunLayout, LaneLayout, lane_number
+    from make_synthetic_run import make_run
+    from bcl_direct_reader import BCLReader
+except:
+    #If this fails, you is probably running the tests wrongly
+    print("****",
+          "You want to run these tests from the top-level source folder by using:",
+          "  python3 -m unittest test.test_run_layout",
+          "or even",
+          "  python3 -m unittest discover",
+          "****",
+          sep="\n")
+    raise
+
+ROWS, COLS, CYCLES = 10, 20, 6
+
+class TestRunLayout(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        for preset in ['hiseq_4000', 'novaseq']:
+            make_run( cls.tmpdir.name + '/' + preset, preset=preset, lanes=(1, 2),
+                      surfaces=2, swaths=1, tiles=3,
+                      rows=ROWS, cols=COLS, cycles=CYCLES )
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def test_lane_number(self):
+        self.assertEqual([ lane_number(l) for l in [3, '3', 'L003'] ], [3, 3, 3])
+
+    def test_run_info(self):
+        layout = RunLayout(self.tmpdir.name + '/hiseq_4000')
+
+        self.assertEqual(layout.lanes, [1, 2])
+        self.assertEqual(layout.tiles(1), ['1101', '1102', '1103', '2101', '2102', '2103'])
+        self.assertEqual(layout.tiles('L002'), layout.tiles(1))
+        self.assertEqual(layout.tiles(3), [])
+        self.assertEqual(layout.last_tile, '2103')
+        self.assertEqual(layout.read_cycles, [CYCLES])
+        self.assertEqual(layout.instrument, 'K00166')
+
+    def test_no_run_info(self):
+        # Without RunInfo.xml, the lanes and tiles come from the directories.
+        with unittest.mock.patch('os.path.exists', return_value=False):
+            layout = RunLayout(self.tmpdir.name + '/hiseq_4000')
+
+        self.assertEqual(layout.run_id, None)
+        self.assertEqual(layout.lanes, [1, 2])
+        self.assertEqual(layout.tiles(2), ['1101', '1102', '1103', '2101', '2102', '2103'])
+
+    def test_cycle_files(self):
+        lane = RunLayout(self.tmpdir.name + '/novaseq').lane(2)
+
+        self.assertEqual(lane.num_cycles, CYCLES)
+        fmt, path = lane.cycle_file('2102', 3)
+        self.assertEqual(fmt, 'cbcl')
+        self.assertTrue(path.endswith('/L002/C4.1/L002_2.cbcl'))
+
+        lane = RunLayout(self.tmpdir.name + '/hiseq_4000').lane(1)
+        fmt, path = lane.cycle_file(1101, 0)
+        self.assertEqual(fmt, 'bcl.gz')
+        self.assertTrue(path.endswith('/L001/C1.1/s_1_1101.bcl.gz'))
+
+        with self.assertRaises(RuntimeError):
+            lane.filter_file(1199)
+
+    def test_one_scan(self):
+        # Opening any number of tiles lists the lane directory once, and each
+        # cycle directory once.
+        reader = BCLReader(self.tmpdir.name + '/hiseq_4000')
+        with unittest.mock.patch('os.listdir', wraps=os.listdir) as listdir:
+            for tile in reader.layout.tiles(1):
+                reader.get_tile(1, tile).get_seqs([0, 5, 9], 0, CYCLES)
+
+        self.assertEqual(listdir.call_count, 1 + CYCLES)
+
+    def test_new_files(self):
+        # A file written after the directory was listed is still found
+        lane = RunLayout(self.tmpdir.name + '/hiseq_4000').lane(2)
+        cycle_dir = os.path.join(lane.data_dir, 'C2.1')
+        bcl = os.path.join(cycle_dir, 's_2_1102.bcl.gz')
+        os.rename(bcl, bcl + '.tmp')
+        try:
+            with self.assertRaises(FileNotFoundError):
+                lane.cycle_file('1102', 1)
+        finally:
+            os.rename(bcl + '.tmp', bcl)
+        self.assertEqual(lane.cycle_file('1102', 1), ('bcl.gz', bcl))
+
+        # Likewise a new tile
+        with open(os.path.join(lane.data_dir, 's_2_1199.filter'), 'wb'):
+            pass
+        try:
+            self.assertTrue(lane.filter_file('1199').endswith('s_2_1199.filter'))
+        finally:
+            os.unlink(os.path.join(lane.data_dir, 's_2_1199.filter'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import pickle
+import tempfile
+import unittest
+import unittest.mock
+from multiprocessing import Pool
+
+try:
+    sys.path.insert(0,'.')
+    from shared_targets import SharedTargets
+    from target import load_targets
+    from make_synthetic_run import make_run, write_targets
+    from bcl_direct_reader import BCLReader
+    from run_layout import RunLayout
+    import count_well_duplicates
+    from count_well_duplicates import CountConfig, TileCounter, read_tile_seqs, compare_tile
+except:
+    #If this fails, you is probably running the tests wrongly
+    print("****",
+          "You want to run these tests from the top-level source folder by using:",
+          "  python3 -m unittest test.test_shared_targets",
+          "or even",
+          "  python3 -m unittest discover",
+          "****",
+          sep="\n")
+    raise
+
+TEST_FILE = 'test/small.list'
+
+ROWS, COLS, CYCLES = 30, 60, 20
+
+class TestSharedTargets(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.targets = load_targets(TEST_FILE)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_same_targets(self):
+        with SharedTargets.export(self.targets, self.tmpdir.name) as shared:
+            self.assertEqual(len(shared), len(self.targets))
+            self.assertEqual(shared.levels, self.targets.levels)
+
+            for t, st in zip(self.targets, shared):
+                self.assertEqual(st.get_centre(), t.get_centre())
+                self.assertEqual(st.get_indices(), t.get_indices())
+                for level in range(t.get_levels()):
+                    self.assertEqual(list(st.get_indices(level)), t.get_indices(level))
+
+            self.assertEqual(list(shared.get_all_indices()), sorted(self.targets.get_all_indices()))
+            self.assertEqual(shared.get_all_indices(1), self.targets.get_all_indices(1))
+
+    def test_pickle(self):
+        shared = SharedTargets.export(self.targets, self.tmpdir.name)
+
+        # Only the filename is pickled, and the copy does not own the file
+        data = pickle.dumps(shared)
+        self.assertLess(len(data), 200)
+        copy = pickle.loads(data)
+        self.assertEqual(list(copy.get_all_indices()), list(shared.get_all_indices()))
+        copy.close()
+        self.assertTrue(os.path.exists(shared.filename))
+
+        shared.close()
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+    def test_export_fails(self):
+        # A file that cannot be mapped is not left behind
+        with unittest.mock.patch.object(SharedTargets, '__init__', side_effect=OSError("No space left")):
+            with self.assertRaises(OSError):
+                SharedTargets.export(self.targets, self.tmpdir.name)
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+    def test_worker_pool(self):
+        # Counting tiles in worker processes gives the same as doing it here
+        run = os.path.join(self.tmpdir.name, 'run')
+        make_run(run, surfaces=1, swaths=1, tiles=2, rows=ROWS, cols=COLS, cycles=CYCLES)
+        targets_file = os.path.join(self.tmpdir.name, 'targets.list')
+        write_targets(targets_file, ROWS, COLS, 50, levels=3)
+        targets = load_targets(targets_file)
+
+        configs = [ CountConfig(None, 2, False, 3, 50), CountConfig('e1', 1, True, 2, 20) ]
+        cycles = [ (0, 10), (12, CYCLES) ]
+
+        reader = BCLReader(run)
+        with unittest.mock.patch('count_well_duplicates.log'):
+            expected = [ compare_tile(targets, read_tile_seqs(reader.get_tile(1, tile), targets, cycles), configs)
+                         for tile in ['1101', '1102'] ]
+
+        with SharedTargets.export(targets, self.tmpdir.name) as shared:
+            counter = TileCounter( run, RunLayout(run), shared, configs, cycles,
+                                   stage_size = '1G', prefetch = 2, quiet = True )
+            with Pool(2, initializer=count_well_duplicates.init_worker, initargs=(counter,)) as pool:
+                got = pool.starmap(count_well_duplicates.count_tile_worker, [ (1, '1101'), (1, '1102') ])
+
+        self.assertEqual([ all_ts for all_ts, prof in got ], expected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import tempfile
+import unittest
+
+try:
+    sys.path.insert(0,'.')
+    from staging_cache import StagingCache, parse_size
+    from make_synthetic_run import make_run
+    from bcl_direct_reader import BCLReader
+    from profiling import Profile
+except:
+    #If this fails, you is probably running the tests wrongly
+    print("****",
+          "You want to run these tests from the top-level source folder by using:",
+          "  python3 -m unittest test.test_staging_cache",
+          "or even",
+          "  python3 -m unittest discover",
+          "****",
+          sep="\n")
+    raise
+
+class TestStagingCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.stage_dir = os.path.join(self.tmpdir.name, 'stage')
+        self.source = os.path.join(self.tmpdir.name, 'source.bin')
+        with open(self.source, 'wb') as fh:
+            fh.write(bytes(range(256)) * 40)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_parse_size(self):
+        self.assertEqual(parse_size('1000'), 1000)
+        self.assertEqual(parse_size('2K'), 2048)
+        self.assertEqual(parse_size('1.5G'), 1536 * 1024**2)
+        self.assertEqual(parse_size('10mb'), 10 * 1024**2)
+        with self.assertRaises(ValueError):
+            parse_size('lots')
+
+    def test_read(self):
+        cache = StagingCache(self.stage_dir, 1000000, min_bytes=0)
+        prof = Profile()
+
+        with cache.open(self.source, prof) as fh:
+            self.assertEqual(fh.read(4), bytes([0, 1, 2, 3]))
+            fh.seek(300)
+            self.assertEqual(fh.read(2), bytes([44, 45]))
+            self.assertEqual(len(fh.read()), 256 * 40 - 302)
+        self.assertEqual(prof.counters['stage_misses'], 3)
+        self.assertEqual(len(os.listdir(self.stage_dir)), 3)
+
+        # A new cache object on the same directory sees the same entries
+        cache = StagingCache(self.stage_dir, 1000000, min_bytes=0)
+        self.assertGreater(cache.total_bytes, 256 * 40)
+        self.assertEqual(cache.read(self.source, 300, 2, prof), bytes([44, 45]))
+        self.assertEqual(prof.counters['stage_hits'], 1)
+        self.assertEqual(prof.counters['bytes_from_stage'], 2)
+
+    def test_source_changed(self):
+        cache = StagingCache(self.stage_dir, 1000000, min_bytes=0)
+        self.assertEqual(cache.read(self.source, 0, 4), bytes([0, 1, 2, 3]))
+
+        with open(self.source, 'r+b') as fh:
+            fh.write(b'ACGT')
+        os.utime(self.source, ns=(0, time.time_ns() + 10**9))
+
+        prof = Profile()
+        self.assertEqual(cache.read(self.source, 0, 4, prof), b'ACGT')
+        self.assertEqual(prof.counters['stage_misses'], 1)
+
+    def test_corrupt(self):
+        cache = StagingCache(self.stage_dir, 1000000, min_bytes=0)
+        cache.read(self.source, 0, 100)
+
+        entry = cache.entry_filename(os.path.realpath(self.source), 0, 100)
+        with open(entry, 'r+b') as fh:
+            fh.seek(-1, os.SEEK_END)
+            fh.write(b'X')
+
+        prof = Profile()
+        self.assertEqual(cache.read(self.source, 0, 100, prof), bytes(range(100)))
+        self.assertEqual(prof.counters['stage_misses'], 1)
+
+        # And it was saved again
+        self.assertEqual(cache.read(self.source, 0, 100, prof), bytes(range(100)))
+        self.assertEqual(prof.counters['stage_hits'], 1)
+
+    def test_evict(self):
+        # Room for about 4 entries of 1000 bytes plus the JSON header
+        cache = StagingCache(self.stage_dir, 5000, min_bytes=0)
+        for n in range(4):
+            cache.read(self.source, n * 1000, 1000)
+            entry = cache.entry_filename(os.path.realpath(self.source), n * 1000, 1000)
+            os.utime(entry, (n, n))
+
+        # Touch the first one, so the second is now the least recently used
+        cache.read(self.source, 0, 1000)
+        cache.read(self.source, 4000, 1000)
+
+        self.assertLessEqual(cache.total_bytes, 5000)
+        self.assertTrue(os.path.exists(cache.entry_filename(os.path.realpath(self.source), 0, 1000)))
+        self.assertFalse(os.path.exists(cache.entry_filename(os.path.realpath(self.source), 1000, 1000)))
+
+    def test_small_reads(self):
+        # By default small reads go straight to the source and are not saved
+        cache = StagingCache(self.stage_dir, 1000000, min_bytes=1000)
+        prof = Profile()
+
+        with cache.open(self.source, prof) as fh:
+            self.assertEqual(fh.read(4), bytes([0, 1, 2, 3]))
+            fh.seek(300)
+            self.assertEqual(fh.read(2), bytes([44, 45]))
+            self.assertEqual(len(fh.read(5000)), 5000)
+            self.assertEqual(len(fh.read()), 256 * 40 - 5302)
+        self.assertEqual(cache.read(self.source, 10000, None, prof), bytes(range(16, 256)))
+
+        self.assertEqual(prof.counters['stage_skipped'], 3)
+        self.assertEqual(prof.counters['stage_misses'], 2)
+        self.assertEqual(len(os.listdir(self.stage_dir)), 2)
+
+    def test_bcl_reader(self):
+        wells = range(0, 600, 7)
+        for preset in ['hiseq_4000', 'novaseq']:
+            run = os.path.join(self.tmpdir.name, preset)
+            make_run( run, preset=preset, surfaces=1, swaths=1, tiles=2,
+                      rows=20, cols=30, cycles=10 )
+            expected = BCLReader(run).get_tile(1, 1102).get_seqs(wells)
+
+            cache = StagingCache(self.stage_dir, 10**7, min_bytes=0)
+            for n in range(2):
+                prof = Profile()
+                tile = BCLReader(run, stage=cache).get_tile(1, 1102, profile=prof)
+                self.assertEqual(tile.get_seqs(wells), expected)
+
+            # The second time round nothing came from the source
+            self.assertNotIn('stage_misses', prof.counters)
+            self.assertGreater(prof.counters['stage_hits'], 10)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+import sys
+import io
+import random
+import unittest
+from unittest.mock import patch
+
+try:
+    sys.path.insert(0,'.')
+    import count_well_duplicates
+    from count_well_duplicates import py_tile_stats, lane_stats, output_writer
+    from test.test_count_well_duplicates import LANE_DUPL, BAD_TILE_LANE
+except:
+    #If this fails, you is probably running the tests wrongly
+    print("****",
+          "You want to run these tests from the top-level source folder by using:",
+          "  python3 -m unittest test.test_stats_engine",
+          "or even",
+          "  python3 -m unittest discover",
+          "****",
+          sep="\n")
+    raise
+
+try:
+    import stats_engine
+except ImportError:
+    stats_engine = None
+
+def random_lane(seed, tiles=6, levels=5):
+    """A lane with ragged tiles, one of them empty, and a smattering of dups.
+    """
+    rng = random.Random(seed)
+    lane_dupl = {}
+    for t in range(tiles):
+        targets = 0 if t == 2 else rng.randint(1, 300)
+        lane_dupl['11%02i' % t] = [ [ ( rng.choice([0]*20 + [1, 2, 3]), 6 * (l+1) - rng.randint(0, 2) )
+                                      for l in range(levels) ]
+                                    for n in range(targets) ]
+    return lane_dupl
+
+@unittest.skipUnless(stats_engine, "numpy is not installed")
+class TestStatsEngine(unittest.TestCase):
+
+    def test_tile_stats(self):
+        for seed in range(5):
+            for tile_counts in random_lane(seed).values():
+                self.assertEqual(stats_engine.tile_stats(tile_counts, 5), py_tile_stats(tile_counts, 5))
+                self.assertEqual(stats_engine.tile_stats(tile_counts, 3), py_tile_stats(tile_counts, 3))
+
+    def test_lane_stats(self):
+        for lane_dupl in [ LANE_DUPL, BAD_TILE_LANE, {'1222': []}, random_lane(42) ]:
+            np_res = lane_stats(lane_dupl)
+            with patch.object(count_well_duplicates, 'stats_engine', None):
+                py_res = lane_stats(lane_dupl)
+            self.assertEqual(np_res, py_res)
+
+    def test_lane_arrays(self):
+        tiles, n_targets, tally, length = stats_engine.lane_arrays(BAD_TILE_LANE, 3)
+
+        self.assertEqual(tiles, ['1208', '1209'])
+        self.assertEqual(n_targets.tolist(), [4, 0])
+        self.assertEqual(tally.shape, (2, 4, 3))
+        # The empty tile is all padding
+        self.assertEqual(length[1].sum(), 0)
+
+    def test_output_writer(self):
+        # The report should be the same with or without numpy
+        for verbose in [0, 1]:
+            for fmt in ['text', 'json', 'tsv']:
+                outputs = []
+                for engine in [stats_engine, None]:
+                    with patch.object(count_well_duplicates, 'stats_engine', engine), \
+                         patch('sys.stdout', new_callable=io.StringIO) as mock_stdout:
+                        output_writer(1, 300, random_lane(7), verbose=verbose, fmt=fmt)
+                    outputs.append(mock_stdout.getvalue())
+                self.assertEqual(outputs[0], outputs[1])
+
+if __name__ == '__main__':
+    unittest.main()
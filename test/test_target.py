@@ -34,6 +34,13 @@ class TestTargetReader(unittest.TestCase):
     def setUp(self):
         self.all_targets = load_targets(TEST_FILE)
 
+    def test_fingerprint(self):
+        fp = self.all_targets.fingerprint()
+
+        self.assertEqual(fp, load_targets(TEST_FILE).fingerprint())
+        self.assertNotEqual(fp, load_targets(TEST_FILE, levels=2).fingerprint())
+        self.assertNotEqual(fp, load_targets(TEST_FILE, limit=1).fingerprint())
+
     def test_load_subset(self):
         sub_targets = load_targets(TEST_FILE, levels=2)
 
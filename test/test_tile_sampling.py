@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import sys
+import unittest
+from math import sqrt
+
+try:
+    sys.path.insert(0,'.')
+    from tile_sampling import stratified_order, stratified_sample, strata_sizes, tile_stratum, RatioEstimate
+except:
+    #If this fails, you is probably running the tests wrongly
+    print("****",
+          "You want to run these tests from the top-level source folder by using:",
+          "  python3 -m unittest test.test_tile_sampling",
+          "or even",
+          "  python3 -m unittest discover",
+          "****",
+          sep="\n")
+    raise
+
+# HiSeq 4000 layout
+TILES = [ "%s%02d" % (swath, t) for swath in ['11', '12', '21', '22'] for t in range(1, 29) ]
+
+class TestTileSampling(unittest.TestCase):
+
+    def test_stratified_order(self):
+        order = stratified_order(TILES, seed=1)
+
+        self.assertEqual(sorted(order), sorted(TILES))
+        self.assertEqual(order, stratified_order(TILES, seed=1))
+        self.assertNotEqual(order, stratified_order(TILES, seed=2))
+
+        # Every block of 4 has one tile from each swath
+        for n in range(0, len(order), 4):
+            self.assertEqual(sorted(tile_stratum(t) for t in order[n:n+4]), ['11', '12', '21', '22'])
+
+    def test_ratio_estimate(self):
+        est = RatioEstimate(total_tiles=4)
+        est.add(10, 100)
+        self.assertEqual(est.estimate(), 0.1)
+        self.assertIsNone(est.std_error())
+        self.assertFalse(est.converged(1.0))
+
+        est.add(30, 100)
+        self.assertEqual(est.estimate(), 0.2)
+        # Residuals are -10 and +10, so variance 200, halved by the f.p.c.
+        self.assertAlmostEqual(est.std_error(), sqrt(0.5 * 200 / 2) / 100)
+        self.assertAlmostEqual(est.half_width(), 1.959964 * sqrt(50) / 100, places=5)
+        self.assertTrue(est.converged(0.2))
+        self.assertFalse(est.converged(0.2, min_tiles=3))
+
+        # Once all the tiles are seen there is no sampling error
+        est.add(20, 100)
+        est.add(20, 100)
+        self.assertEqual(est.std_error(), 0.0)
+        self.assertEqual(est.as_dict()['targets_used'], 400)
+
+    def test_stratified_sample(self):
+        sample = stratified_sample(TILES, 0.25, seed=1)
+
+        self.assertEqual(len(sample), 28)
+        self.assertEqual(sample, sorted(sample))
+        self.assertEqual(list(strata_sizes(sample).values()), [7, 7, 7, 7])
+
+        # Always at least one tile
+        self.assertEqual(len(stratified_sample(TILES, 0.001)), 1)
+
+    def test_stratified_estimate(self):
+        # Two strata of 4 tiles.  Stratum 11 has a 10% dup rate and we see
+        # 3 tiles from it, stratum 12 has a 20% rate and we see 2.
+        est = RatioEstimate(total_tiles=8, strata=strata_sizes(TILES[:4] + TILES[28:32]))
+        for tile, hits in [('1101', 10), ('1102', 11), ('1103', 9), ('1201', 19), ('1202', 21)]:
+            est.add(hits, 100, tile)
+
+        # Each stratum counts equally, even though stratum 11 had more tiles sampled
+        self.assertAlmostEqual(est.estimate(), 0.15)
+
+        # The variance only comes from within strata, so is much less
+        # than if the strata were ignored.
+        unstratified = RatioEstimate(total_tiles=8)
+        for h in [10, 11, 9, 19, 21]:
+            unstratified.add(h, 100)
+        self.assertLess(est.std_error(), unstratified.std_error() / 3)
+
+        # (4**2 * 1/4 * 1/3) + (4**2 * 1/2 * 2/2) over 800 targets
+        self.assertAlmostEqual(est.std_error(), sqrt(16 / 12 + 8) / 800)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import io
+import tempfile
+import unittest
+import unittest.mock
+
+try:
+    sys.path.insert(0,'.')
+    from target import load_targets
+    from make_synthetic_run import make_run, write_targets
+    import count_well_duplicates
+    from count_well_duplicates import WellDupCounter, CountConfig, LaneAggregator
+except:
+    #If this fails, you is probably running the tests wrongly
+    print("****",
+          "You want to run these tests from the top-level source folder by using:",
+          "  python3 -m unittest test.test_well_dup_counter",
+          "or even",
+          "  python3 -m unittest discover",
+          "****",
+          sep="\n")
+    raise
+
+ROWS, COLS, CYCLES = 30, 60, 20
+
+class TestWellDupCounter(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.runs = []
+        for seed in [13, 14]:
+            cls.runs.append(os.path.join(cls.tmpdir.name, 'run%i' % seed))
+            make_run( cls.runs[-1], lanes=(1, 2), surfaces=1, swaths=1, tiles=2,
+                      rows=ROWS, cols=COLS, cycles=CYCLES, seed=seed )
+        # A lane with enough tiles that sampling them means something
+        cls.wide_run = os.path.join(cls.tmpdir.name, 'wide')
+        make_run( cls.wide_run, surfaces=2, swaths=2, tiles=4,
+                  rows=ROWS, cols=COLS, cycles=CYCLES )
+        cls.targets_file = os.path.join(cls.tmpdir.name, 'targets.list')
+        write_targets(cls.targets_file, ROWS, COLS, 100, levels=3)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def setUp(self):
+        patcher = unittest.mock.patch('count_well_duplicates.log')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_run(self):
+        configs = [ CountConfig(None, 2, False, 3, 100), CountConfig('e1', 1, True, 2, 50) ]
+        with WellDupCounter(self.runs[0], self.targets_file, configs, cycles=[(0, CYCLES)]) as counter:
+            res = counter.run()
+            self.assertEqual([ r.lane for r in res ], [1, 2])
+            self.assertEqual(res[0].tiles, ['1101', '1102'])
+            self.assertEqual(len(res[0].stats), 2)
+            self.assertEqual([ ts['tile'] for ts in res[0].stats[0]['tiles'] ], ['1101', '1102'])
+            self.assertEqual(res[0].stats[1]['levels'], 2)
+
+            # The same again, and the targets and layout are not loaded again
+            with unittest.mock.patch('count_well_duplicates.load_targets') as lt, \
+                 unittest.mock.patch('count_well_duplicates.RunLayout') as rl:
+                again = counter.run(lanes=['2'], tiles='1102')
+                lt.assert_not_called()
+                rl.assert_not_called()
+            self.assertEqual(again[0].stats[0]['tiles'], res[1].stats[0]['tiles'][1:])
+
+            # Another run with the same targets
+            other = counter.run(run=self.runs[1], lanes=['1'])
+            self.assertNotEqual(other[0].stats[0]['acci'], res[0].stats[0]['acci'])
+
+    def test_processes(self):
+        targets = load_targets(self.targets_file)
+        with WellDupCounter(self.runs[0], targets, cycles=[(0, CYCLES)]) as counter:
+            expected = counter.run()
+        with WellDupCounter(self.runs[0], targets, cycles=[(0, CYCLES)], processes=2, quiet=True) as counter:
+            got = counter.run()
+            # The same workers are used for another run
+            pool = counter.pool
+            other = counter.run(run=self.runs[1])
+            self.assertIs(counter.pool, pool)
+        self.assertEqual([ r.stats for r in got ], [ r.stats for r in expected ])
+        self.assertEqual(len(other), 2)
+
+    def test_adaptive_lane_name(self):
+        # The tiles are visited in the same order however the lane was named
+        with WellDupCounter(self.wide_run, self.targets_file, cycles=[(0, CYCLES)]) as counter:
+            expected = counter.run(adaptive=1.0, min_tiles=4)[0].tiles
+            self.assertEqual(len(expected), 4)
+            for lane in ['1', 'L001']:
+                self.assertEqual(counter.run(lanes=[lane], adaptive=1.0, min_tiles=4)[0].tiles, expected)
+
+    def test_fraction_lane_name(self):
+        # The same tiles are sampled however the lane was named
+        with WellDupCounter(self.wide_run, self.targets_file, cycles=[(0, CYCLES)]) as counter:
+            expected = counter.run(tile_fraction=0.25)[0].tiles
+            self.assertEqual(len(expected), 4)
+            for lane in ['1', 'L001']:
+                self.assertEqual(counter.run(lanes=[lane], tile_fraction=0.25)[0].tiles, expected)
+
+    def test_same_as_main(self):
+        # main() is just a wrapper
+        argv = [ 'count_well_duplicates.py', '-f', self.targets_file, '-r', self.runs[0],
+                 '-n', '100', '-x', '0', '-y', str(CYCLES), '-i', '1' ]
+        with unittest.mock.patch('sys.argv', argv), \
+             unittest.mock.patch('sys.stdout', new_callable=io.StringIO) as mock_stdout:
+            count_well_duplicates.main()
+            expected = mock_stdout.getvalue()
+            mock_stdout.seek(0) ; mock_stdout.truncate()
+
+            counter = WellDupCounter(self.runs[0], self.targets_file, CountConfig(None, 2, False, 3, 100),
+                                     cycles=[(0, CYCLES)])
+            counter.run(lanes=['1'], fmt='text')
+            self.assertEqual(mock_stdout.getvalue(), expected)
+
+    def test_main_cleans_up(self):
+        # If counting fails, main() still stops the workers and removes the shared targets
+        argv = [ 'count_well_duplicates.py', '-f', self.targets_file, '-r', self.runs[0],
+                 '-n', '100', '-x', '0', '-y', str(CYCLES), '-q', '--processes', '2' ]
+        counters = []
+        def failing_lanes(counter, *args, **kwargs):
+            counters.append(counter)
+            counter._get_pool()
+            raise RuntimeError("Tile is broken")
+            yield
+
+        with unittest.mock.patch('sys.argv', argv), \
+             unittest.mock.patch.object(WellDupCounter, 'iter_lanes', failing_lanes):
+            with self.assertRaises(RuntimeError):
+                count_well_duplicates.main()
+
+        self.assertIsNone(counters[0].pool)
+        self.assertIsNone(counters[0].shared_targets)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+#!python3
+"""
+Support for looking at only some of the tiles in a lane and still saying
+something sensible about the whole lane.
+
+Tiles are visited in a stratified random order, so that any prefix of the
+order is spread evenly over the surfaces and swaths of the flowcell (which
+tend to differ from each other more than neighbouring tiles do).
+
+The lane duplication rate is estimated as the total of AccI at level 1
+(ie. targets with a duplicate at any level) over the total targets, which is
+what output_writer reports as "Overall duplication".  Since whole tiles are
+sampled, not individual targets, this is a ratio estimate from a cluster sample
+and the standard error comes from the tile-to-tile variation, not from the
+number of targets.  See eg. Cochran, "Sampling Techniques", section 6.4.
+If the size of each stratum is given, the combined ratio estimate is used
+instead, with each tile weighted by the inverse of its stratum's sampling
+fraction and the variance summed over strata (Cochran section 6.11).
+
+Synopsis:
+
+   est = RatioEstimate(total_tiles=len(tiles), strata=strata_sizes(tiles))
+   for tile in stratified_order(tiles, seed=lane):
+       ...count the tile...
+       est.add(ts['acci'][0], ts['targets'], tile)
+       if est.converged(0.001):
+           break
+   print(est.estimate(), est.half_width())
+"""
+
+import random
+from math import sqrt
+from statistics import NormalDist
+from collections import OrderedDict
+
+def tile_stratum(tile):
+    """ Tiles are named as surface, swath, then a two-digit tile number,
+        so the stratum is all but the last two digits.
+    """
+    return str(tile)[:-2]
+
+def strata_sizes(tiles):
+    """ Counts the tiles in each stratum.
+    """
+    res = OrderedDict()
+    for tile in tiles:
+        stratum = tile_stratum(tile)
+        res[stratum] = res.get(stratum, 0) + 1
+    return res
+
+def stratified_sample(tiles, fraction, seed=None):
+    """ Picks the given fraction of the tiles (at least one), spread as
+        evenly as possible over the strata.  The result is sorted.
+    """
+    wanted = max(1, int(round(len(tiles) * fraction)))
+    return sorted(stratified_order(tiles, seed)[:wanted])
+
+def stratified_order(tiles, seed=None):
+    """ Returns the tiles in an order that is random within each stratum,
+        but takes one tile from each stratum in turn.
+    """
+    rng = random.Random(seed)
+
+    strata = OrderedDict()
+    for tile in sorted(tiles):
+        strata.setdefault(tile_stratum(tile), []).append(tile)
+    for members in strata.values():
+        rng.shuffle(members)
+
+    res = []
+    while strata:
+        # Take the strata in a random order each round, so no one
+        # stratum is always first.
+        names = list(strata)
+        rng.shuffle(names)
+        for name in names:
+            res.append(strata[name].pop())
+            if not strata[name]:
+                del strata[name]
+    return res
+
+class RatioEstimate:
+    """ Running estimate of the fraction of targets that are duplicates,
+        from a sample of whole tiles.
+    """
+    def __init__(self, total_tiles=None, confidence=0.95, strata=None):
+        """ total_tiles is used for the finite population correction, so
+            once every tile is seen the error is zero.
+            strata, if given, is the number of tiles in each stratum as
+            returned by strata_sizes().
+        """
+        self.total_tiles = total_tiles
+        self.confidence = confidence
+        self.strata = strata
+        self.z = NormalDist().inv_cdf(0.5 + confidence / 2)
+        self.hits = []
+        self.targets = []
+        self.tile_strata = []
+
+    def add(self, hits, targets, tile=None):
+        self.hits.append(hits)
+        self.targets.append(targets)
+        self.tile_strata.append(None if tile is None else tile_stratum(tile))
+
+    def tiles(self):
+        return len(self.targets)
+
+    def _by_stratum(self):
+        """ Returns { stratum: [ (hits, targets), ... ] } or None if the
+            stratified estimate can't be used.
+        """
+        if not self.strata or None in self.tile_strata:
+            return None
+        res = OrderedDict()
+        for st, h, t in zip(self.tile_strata, self.hits, self.targets):
+            res.setdefault(st, []).append((h, t))
+        return res
+
+    def estimate(self):
+        by_stratum = self._by_stratum()
+        if by_stratum:
+            # Weight each stratum by N_h / n_h
+            tot_h = sum( self.strata[st] / len(v) * sum(h for h, t in v) for st, v in by_stratum.items() )
+            tot_t = sum( self.strata[st] / len(v) * sum(t for h, t in v) for st, v in by_stratum.items() )
+            return tot_h / tot_t if tot_t else 0.0
+
+        tot = sum(self.targets)
+        return sum(self.hits) / tot if tot else 0.0
+
+    def std_error(self):
+        """ Standard error of the ratio estimate, or None if there are
+            not yet enough tiles to say.
+        """
+        by_stratum = self._by_stratum()
+        # The variance within a stratum needs at least two tiles from it,
+        # otherwise fall back to treating the sample as unstratified.
+        if by_stratum and all(len(v) >= 2 for v in by_stratum.values()):
+            return self._stratified_std_error(by_stratum)
+
+        m = len(self.targets)
+        tot = sum(self.targets)
+        if m < 2 or not tot:
+            return None
+
+        r = self.estimate()
+        mean_targets = tot / m
+        resid_var = sum( (h - r * t) ** 2 for h, t in zip(self.hits, self.targets) ) / (m - 1)
+
+        fpc = 1.0
+        if self.total_tiles:
+            fpc = max(0.0, 1 - m / self.total_tiles)
+
+        return sqrt(fpc * resid_var / m) / mean_targets
+
+    def _stratified_std_error(self, by_stratum):
+        r = self.estimate()
+        var = 0.0
+        tot_t = 0.0
+        for st, v in by_stratum.items():
+            big_n, n = self.strata[st], len(v)
+            resid = [ h - r * t for h, t in v ]
+            mean_resid = sum(resid) / n
+            resid_var = sum( (d - mean_resid) ** 2 for d in resid ) / (n - 1)
+            var += big_n ** 2 * max(0.0, 1 - n / big_n) * resid_var / n
+            tot_t += big_n / n * sum(t for h, t in v)
+
+        return sqrt(var) / tot_t if tot_t else None
+
+    def half_width(self):
+        """ Half the width of the confidence interval, or None as for std_error()
+        """
+        se = self.std_error()
+        return None if se is None else self.z * se
+
+    def converged(self, precision, min_tiles=2):
+        """ True once the confidence interval is within +/- precision.
+        """
+        hw = self.half_width()
+        return self.tiles() >= min_tiles and hw is not None and hw <= precision
+
+    def as_dict(self):
+        return dict( tiles_used = self.tiles(),
+                     tiles_total = self.total_tiles,
+                     targets_used = sum(self.targets),
+                     estimate = self.estimate(),
+                     std_error = self.std_error(),
+                     half_width = self.half_width(),
+                     confidence = self.confidence )